@@ -1,6 +1,29 @@
-def main():
-    print("Hello from clahe-filter!")
+import os
+import sys
+
+# The enhancement modules live next to the web app in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "video":
+        import video_pipeline
+
+        return video_pipeline.main(argv[1:])
+    if argv and argv[0] == "tiled":
+        import tiled
+
+        return tiled.main(argv[1:])
+    if argv and argv[0] == "bench":
+        import bench
+
+        return bench.main(argv[1:])
+
+    import batch
+
+    return batch.main(argv)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
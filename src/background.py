@@ -0,0 +1,229 @@
+"""Idle-time pre-enhancement of the items next to the current one.
+
+After a render, ``BackgroundEnhancer`` waits for the app to go idle, then
+reads the neighbouring items of the dataset into the pixel cache and
+enhances them with the current parameters into ``EnhancedCache``. Switching
+to one of them is then a cache hit that only writes the finished buffer back.
+
+The work is time-sliced: the canvas readback, the color conversion, the
+(tile) histograms and the equalization itself each run in row bands of
+``BAND_ROWS``, with only the LUTs computed in one step, and the job yields
+to the event loop after each band. While a render is in flight the job
+pauses. Changing the parameters cancels the job and drops the results
+computed with the old parameters.
+"""
+import asyncio
+from collections import OrderedDict
+
+import numpy as np
+
+import clahe
+import engine
+
+
+BAND_ROWS = 256
+IDLE_DELAY = 0.3
+NEIGHBOURS = 2
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def params_key(lab, params):
+  """Hashable key of the enhancement parameters (and engine backend) a result depends on"""
+  return (engine.lightness_space(lab), params['method'], round(float(params['clip_limit']), 3), tuple(params['tile_grid']),
+          engine.get_backend())
+
+
+class EnhancedCache:
+  """Byte-budgeted LRU of finished RGBA results keyed by ``(source key, params key)``"""
+
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self._entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, source_key, pkey):
+    rgba = self._entries.get((source_key, pkey))
+    if rgba is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._entries.move_to_end((source_key, pkey))
+    return rgba
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def put(self, source_key, pkey, rgba):
+    key = (source_key, pkey)
+    old = self._entries.pop(key, None)
+    if old is not None:
+      self.nbytes -= old.nbytes
+    self._entries[key] = rgba
+    self.nbytes += rgba.nbytes
+    while self.nbytes > self.max_bytes and len(self._entries) > 1:
+      _, evicted = self._entries.popitem(last=False)
+      self.nbytes -= evicted.nbytes
+
+  def retain(self, pkey):
+    """Drop every result computed with parameters other than ``pkey``"""
+    for key in [key for key in self._entries if key[1] != pkey]:
+      self.nbytes -= self._entries.pop(key).nbytes
+
+  def clear(self):
+    self._entries.clear()
+    self.nbytes = 0
+
+  def stats(self):
+    return {'entries': len(self._entries), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def read_in_bands(height, width, read_rows, band_rows=BAND_ROWS):
+  """Generator copying an ``(H, W, 4)`` uint8 frame from ``read_rows(r0, r1)`` band by band; returns the frame"""
+  rgba = np.empty((height, width, 4), dtype=np.uint8)
+  for r0 in range(0, height, band_rows):
+    r1 = min(r0 + band_rows, height)
+    rgba[r0:r1] = read_rows(r0, r1)
+    yield
+  return rgba
+
+
+def planes_in_bands(cache, entry, lab, band_rows=BAND_ROWS):
+  """Generator deriving the planes of a pixel cache entry band by band; returns ``cache.planes(entry, lab)``"""
+  if not cache.has_planes(entry, lab):
+    space = engine.lightness_space(lab)
+    height = entry.rgba.shape[0]
+    derived = None
+    for r0 in range(0, height, band_rows):
+      r1 = min(r0 + band_rows, height)
+      band = engine.to_planes(entry.rgba[r0:r1], lab)
+      if space is None:
+        band = [band]
+      elif space != engine.LIGHTNESS_LAB:
+        # Only the lightness plane, the rest is the RGBA frame itself
+        band = band[:1]
+      if derived is None:
+        derived = [np.empty((height,) + plane.shape[1:], dtype=plane.dtype) for plane in band]
+      for plane, part in zip(derived, band):
+        plane[r0:r1] = part
+      yield
+    cache.put_planes(entry, lab, tuple(derived) if space == engine.LIGHTNESS_LAB else derived[0])
+  return cache.planes(entry, lab)
+
+
+def enhance_in_bands(cache, entry, lab, method, clip_limit, tile_grid, band_rows=BAND_ROWS):
+  """Generator enhancing a pixel cache entry band by band; returns the RGBA result.
+
+  Gives the same output as the render path (within one level of ``cv2.CLAHE``
+  on the OpenCV backend): the planes and CLAHE tile histograms are taken from
+  (and left in) the pixel cache, and each band is interpolated against the
+  LUTs of the whole plane.
+  """
+  planes = yield from planes_in_bands(cache, entry, lab, band_rows)
+  plane = engine.luminance_plane(planes, lab)
+  height, width = plane.shape
+  if method == engine.METHOD_CLAHE:
+    tile_grid = engine.normalize_tile_grid(tile_grid)
+    state = None
+    if not cache.has_clahe_state(entry, lab, tile_grid):
+      state = yield from clahe.IncrementalClahe.in_bands(plane, tile_grid, band_rows=band_rows)
+    state = cache.clahe_state(entry, lab, tile_grid, state)
+    luts = state.luts(clip_limit)
+
+    def equalize(r0, r1):
+      return clahe.apply_luts(plane[r0:r1], luts, state.tile_size, origin=(r0, 0))
+  else:
+    hist = np.zeros(clahe.HIST_SIZE, dtype=np.int64)
+    for r0 in range(0, height, band_rows):
+      hist += np.bincount(plane[r0:r0 + band_rows].ravel(), minlength=clahe.HIST_SIZE)
+      yield
+    lut = clahe.equalize_hist_lut(hist)
+
+    def equalize(r0, r1):
+      return lut.take(plane[r0:r1])
+  yield
+
+  out = np.empty((height, width, 4), dtype=np.uint8)
+  alpha = entry.rgba[:, :, 3]
+  for r0 in range(0, height, band_rows):
+    r1 = min(r0 + band_rows, height)
+    band = planes[r0:r1] if engine.lightness_space(lab) is None else [plane[r0:r1] for plane in planes]
+    engine.compose(equalize(r0, r1), band, alpha[r0:r1], lab, out[r0:r1])
+    yield
+  return out
+
+
+def load_and_enhance(cache, key, shape, read_rows, lab, method, clip_limit, tile_grid, band_rows=BAND_ROWS):
+  """Generator reading an item into the pixel cache unless it's there, then ``enhance_in_bands``"""
+  entry = cache.get(key)
+  if entry is None:
+    rgba = yield from read_in_bands(*shape, read_rows, band_rows)
+    entry = cache.put(key, rgba)
+  return (yield from enhance_in_bands(cache, entry, lab, method, clip_limit, tile_grid, band_rows))
+
+
+class BackgroundEnhancer:
+  """Pre-enhances neighbouring items while the app is idle"""
+
+  def __init__(self, cache, results, is_busy=lambda: False, idle_delay=IDLE_DELAY, band_rows=BAND_ROWS):
+    self.cache = cache
+    self.results = results
+    self.is_busy = is_busy
+    self.idle_delay = idle_delay
+    self.band_rows = band_rows
+    self._task = None
+    self._pkey = None
+    self.completed = 0
+    self.cancelled = 0
+
+  def invalidate(self, lab, params):
+    """Cancel the job and drop the results if the parameters changed; returns the params key"""
+    pkey = params_key(lab, params)
+    if pkey != self._pkey:
+      self.cancel()
+      self.results.retain(pkey)
+      self._pkey = pkey
+    return pkey
+
+  def schedule(self, items, lab, params):
+    """Replace the queue with ``items`` to enhance with ``params``.
+
+    Each item is ``(source_key, (height, width), read_rows)``, where
+    ``read_rows(r0, r1)`` returns those rows of the RGBA frame.
+    """
+    pkey = self.invalidate(lab, params)
+    self.cancel()
+    items = [item for item in items if (item[0], pkey) not in self.results]
+    if items:
+      self._task = asyncio.ensure_future(self._run(items, lab, params, pkey))
+
+  def cancel(self):
+    if self._task is not None and not self._task.done():
+      self._task.cancel()
+      self.cancelled += 1
+    self._task = None
+
+  async def _idle(self):
+    await asyncio.sleep(self.idle_delay)
+    while self.is_busy():
+      await asyncio.sleep(self.idle_delay)
+
+  async def _run(self, items, lab, params, pkey):
+    for key, shape, read_rows in items:
+      await self._idle()
+      steps = load_and_enhance(self.cache, key, shape, read_rows, lab, params['method'], params['clip_limit'],
+                               params['tile_grid'], self.band_rows)
+      while True:
+        try:
+          next(steps)
+        except StopIteration as done:
+          self.results.put(key, pkey, done.value)
+          self.completed += 1
+          break
+        await asyncio.sleep(0)
+        if self.is_busy():
+          await self._idle()
+
+  def stats(self):
+    return {'completed': self.completed, 'cancelled': self.cancelled, **self.results.stats()}
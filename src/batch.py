@@ -0,0 +1,211 @@
+"""Offline batch enhancement of image directories.
+
+Applies the same enhancement as the app (gray, LAB lightness, global
+equalization or CLAHE) to every image under a directory and mirrors the tree
+into an output directory. Files are streamed through a ``ProcessPoolExecutor``
+where each worker reads, enhances and writes its own file, so I/O of one image
+overlaps with processing of the others; the number of files in flight is
+bounded to keep memory flat on datasets of any size. Outputs that already
+exist are skipped, so an interrupted run can simply be restarted.
+
+With ``--cache-dir`` the enhanced pixels are also kept in a persistent
+``result_store`` keyed by file path, size, mtime and parameters, so later
+runs with other output directories or formats skip the enhancement.
+
+16-bit images (e.g. 12-bit medical or 14-bit thermal TIFFs) are enhanced at
+their own bit depth and written as 16-bit PNG/TIFF; only outputs in 8-bit
+formats get quantized. ``--bits`` gives that bit depth for the whole
+dataset; without it, it is taken from the largest value of each image, so
+e.g. a dark 12-bit image could be treated as 11-bit. Single-channel images are equalized as they are,
+without a round trip through RGBA.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+import engine
+import result_store
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+# Output formats that hold 16-bit samples
+DEEP_EXTENSIONS = ('.png', '.tif', '.tiff')
+PROGRESS_EVERY = 100
+
+
+def list_images(input_dir):
+  """Yield paths of images under ``input_dir`` relative to it, in a stable order"""
+  for root, dirs, files in os.walk(input_dir):
+    dirs.sort()
+    for name in sorted(files):
+      if name.lower().endswith(IMAGE_EXTENSIONS):
+        yield os.path.relpath(os.path.join(root, name), input_dir)
+
+
+def output_path(output_dir, rel_path, ext=None):
+  if ext:
+    rel_path = os.path.splitext(rel_path)[0] + ext
+  return os.path.join(output_dir, rel_path)
+
+
+def to_rgba(img):
+  """Convert an image as read by ``cv2.imread(..., IMREAD_UNCHANGED)`` to RGBA"""
+  if img.ndim == 2:
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2RGBA)
+  if img.shape[2] == 4:
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+  return cv2.cvtColor(img, cv2.COLOR_BGR2RGBA)
+
+
+def from_rgba(rgba, lab, has_alpha, deep=True, bits=None):
+  """Convert an enhanced RGBA frame or plane to what gets written: gray, BGR or BGRA, quantized to 8 bits unless ``deep``"""
+  if not deep:
+    rgba = engine.to_uint8(rgba, bits)
+  if rgba.ndim == 2:
+    return rgba
+  if not lab:
+    return rgba[:, :, 0]
+  if has_alpha:
+    return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+  return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+
+
+# Persistent result store of the worker process, see init_worker
+_store = None
+
+
+def init_worker(cache_dir=None, cache_max_bytes=result_store.DEFAULT_MAX_BYTES):
+  global _store
+  # One OpenCV thread per process, the pool provides the parallelism
+  cv2.setNumThreads(1)
+  if cache_dir:
+    # All workers write to the cache directory, each evicts by what is actually in it
+    _store = result_store.ResultStore(result_store.FileSystemBackend(cache_dir), cache_max_bytes, shared=True)
+
+
+def file_result_key(src_path, params):
+  stat = os.stat(src_path)
+  return result_store.result_key(os.path.abspath(src_path), f"{stat.st_size}-{stat.st_mtime_ns}", **params)
+
+
+def process_file(src_path, dst_path, params):
+  """Worker: read, enhance and write one image. Returns the number of pixels processed"""
+  img = cv2.imread(src_path, cv2.IMREAD_UNCHANGED)
+  if img is None:
+    raise ValueError(f"Could not read image: {src_path}")
+  if img.dtype not in (np.uint8, np.uint16):
+    raise ValueError(f"Unsupported sample type {img.dtype}: {src_path}")
+  if img.ndim == 3 and img.shape[2] == 1:
+    img = img[:, :, 0]
+  has_alpha = img.ndim == 3 and img.shape[2] == 4
+  enhanced = None
+  if _store is not None:
+    key = file_result_key(src_path, params)
+    enhanced = asyncio.run(_store.load(key))
+  if enhanced is None:
+    enhanced = engine.enhance(img if img.ndim == 2 else to_rgba(img), **params)
+    if _store is not None:
+      asyncio.run(_store.save(key, enhanced, params['lab']))
+
+  os.makedirs(os.path.dirname(dst_path) or '.', exist_ok=True)
+  # Write under a temporary name so an interrupted run never leaves a truncated output behind
+  root, ext = os.path.splitext(dst_path)
+  tmp_path = f"{root}.partial{ext}"
+  deep = ext.lower() in DEEP_EXTENSIONS
+  if not cv2.imwrite(tmp_path, from_rgba(enhanced, params['lab'], has_alpha, deep, params.get('bits'))):
+    raise ValueError(f"Could not write image: {dst_path}")
+  os.replace(tmp_path, dst_path)
+  return img.shape[0] * img.shape[1]
+
+
+def run(input_dir, output_dir, params, workers=None, max_in_flight=None, overwrite=False, ext=None, cache_dir=None,
+        cache_max_bytes=result_store.DEFAULT_MAX_BYTES, log=print):
+  """Enhance every image under ``input_dir`` into ``output_dir`` and return a summary dict"""
+  workers = workers or os.cpu_count() or 1
+  max_in_flight = max_in_flight or workers * 2
+  summary = {'processed': 0, 'skipped': 0, 'failed': 0, 'pixels': 0, 'seconds': 0.0, 'images_per_sec': 0.0}
+  start = time.perf_counter()
+
+  def report():
+    summary['seconds'] = time.perf_counter() - start
+    summary['images_per_sec'] = summary['processed'] / summary['seconds'] if summary['seconds'] > 0 else 0.0
+
+  def collect(done):
+    for future in done:
+      rel_path = in_flight.pop(future)
+      try:
+        summary['pixels'] += future.result()
+        summary['processed'] += 1
+      except Exception as e:
+        summary['failed'] += 1
+        log(f"Failed {rel_path}: {e}")
+      if summary['processed'] and summary['processed'] % PROGRESS_EVERY == 0:
+        report()
+        log(f"{summary['processed']} images, {summary['images_per_sec']:.1f} images/sec")
+
+  in_flight = {}
+  with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache_dir, cache_max_bytes)) as pool:
+    for rel_path in list_images(input_dir):
+      dst_path = output_path(output_dir, rel_path, ext)
+      if not overwrite and os.path.exists(dst_path):
+        summary['skipped'] += 1
+        continue
+      if len(in_flight) >= max_in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        collect(done)
+      future = pool.submit(process_file, os.path.join(input_dir, rel_path), dst_path, params)
+      in_flight[future] = rel_path
+    while in_flight:
+      done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+      collect(done)
+
+  report()
+  return summary
+
+
+def build_parser():
+  parser = argparse.ArgumentParser(description="Apply histogram equalization / CLAHE to a directory of images")
+  parser.add_argument('input_dir', help="directory with source images, searched recursively")
+  parser.add_argument('output_dir', help="directory for enhanced images, mirrors the input tree")
+  parser.add_argument('--lab', nargs='?', const=engine.LIGHTNESS_LAB, default=False, choices=engine.LIGHTNESS_SPACES,
+                      help="equalize lightness only and keep colors, in LAB or the given space (default: grayscale)")
+  parser.add_argument('--method', choices=engine.METHODS, default=engine.METHOD_CLAHE, help="equalization method")
+  parser.add_argument('--clip-limit', type=float, default=engine.DEFAULT_CLIP_LIMIT, help="CLAHE clip limit")
+  parser.add_argument('--tile-grid', type=int, default=engine.DEFAULT_TILE_GRID[0], help="CLAHE tiles per side")
+  parser.add_argument('--bits', type=int, default=None, choices=range(8, 17), metavar='{8..16}',
+                      help="bit depth of the data in 16-bit images, e.g. 12 (default: from the largest value of each image)")
+  parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+  parser.add_argument('--max-in-flight', type=int, default=None, help="files submitted at once (default: 2 x workers)")
+  parser.add_argument('--ext', default=None, help="output extension, e.g. .png (default: same as input)")
+  parser.add_argument('--overwrite', action='store_true', help="re-process images whose output already exists")
+  parser.add_argument('--cache-dir', default=None, help="persistent result cache shared across runs (default: none)")
+  parser.add_argument('--cache-max-mb', type=int, default=result_store.DEFAULT_MAX_BYTES // 2 ** 20,
+                      help="size bound of the result cache, least recently used results are evicted")
+  return parser
+
+
+def main(argv=None):
+  args = build_parser().parse_args(argv)
+  params = {
+    'lab': args.lab,
+    'method': args.method,
+    'clip_limit': args.clip_limit,
+    'tile_grid': engine.normalize_tile_grid(args.tile_grid),
+    'bits': args.bits,
+  }
+  summary = run(args.input_dir, args.output_dir, params, workers=args.workers, max_in_flight=args.max_in_flight,
+                overwrite=args.overwrite, ext=args.ext, cache_dir=args.cache_dir,
+                cache_max_bytes=args.cache_max_mb * 2 ** 20)
+  print(f"Processed {summary['processed']} images ({summary['skipped']} skipped, {summary['failed']} failed) "
+        f"in {summary['seconds']:.1f}s: {summary['images_per_sec']:.1f} images/sec")
+  return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
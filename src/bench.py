@@ -0,0 +1,339 @@
+"""Benchmarks of the enhancement hot path.
+
+Runs the same stages as an Apply in the app on synthetic RGBA frames from
+720p to 8K, headless and without Pyodide:
+
+* ``readback``: flat canvas bytes copied into an ``(H, W, 4)`` array;
+* ``convert``: RGBA to the gray plane or the planes of a lightness space;
+* ``equalize``: global equalization or CLAHE of the gray / lightness plane;
+* ``compose``: merge back to RGB (lightness modes) and write RGBA into the
+  pooled output buffer;
+* ``flatten``: the flat view handed to ``ImageData``.
+
+The ``restore`` mode measures ``readback`` and ``flatten`` only. Every stage
+is timed over several repeats and the median is kept; peak memory of one
+pass is measured separately with ``tracemalloc`` so tracing doesn't skew the
+timings. Results are written as JSON, and ``compare`` flags stages that got
+slower (or passes that need more memory) than a baseline by more than a
+threshold.
+
+``lightness`` times the lightness spaces against each other and reports
+how far the results of the cheaper ones are from the LAB result, as CIE76
+color differences (Delta E) over a pixel sample.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import engine
+import numpy_backend
+from buffers import RgbaBufferPool
+
+
+RESOLUTIONS = {
+  '720p': (720, 1280),
+  '1080p': (1080, 1920),
+  '1440p': (1440, 2560),
+  '4k': (2160, 3840),
+  '8k': (4320, 7680),
+}
+MODES = tuple(f"{space}-{method}" for space in ('gray',) + engine.LIGHTNESS_SPACES for method in engine.METHODS) + ('restore',)
+STAGES = ('readback', 'convert', 'equalize', 'compose', 'flatten')
+
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10
+# Stages faster than this are dominated by timer noise and never flagged
+NOISE_FLOOR_MS = 0.5
+LIGHTNESS_RESOLUTIONS = ('1080p', '4k')
+# Pixels sampled for the color differences of the lightness report
+DELTA_E_SAMPLES = 1 << 20
+
+
+def synthetic_frame(height, width, seed=0):
+  """Opaque RGBA frame with smooth gradients plus noise, so histograms look like a photo's"""
+  rng = np.random.default_rng(seed)
+  y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+  x = np.linspace(0.0, 1.0, width, dtype=np.float32)[None, :]
+  rgba = np.empty((height, width, 4), dtype=np.uint8)
+  for channel, (fy, fx) in enumerate(((0.6, 0.3), (0.2, 0.7), (0.5, 0.5))):
+    base = 40.0 + 120.0 * (fy * y + fx * x)
+    rgba[:, :, channel] = np.clip(base + rng.normal(0.0, 12.0, (height, width)), 0, 255)
+  rgba[:, :, 3] = 255
+  return rgba
+
+
+def mode_params(mode):
+  space, method = mode.split('-')
+  return {'lab': False if space == 'gray' else space,
+          'method': engine.METHOD_CLAHE if method == 'clahe' else engine.METHOD_EQUALIZE}
+
+
+class Pipeline:
+  """The stages of one Apply on a fixed frame, callable one at a time"""
+
+  def __init__(self, frame, mode, clip_limit=engine.DEFAULT_CLIP_LIMIT, tile_grid=engine.DEFAULT_TILE_GRID):
+    self.height, self.width = frame.shape[:2]
+    # What a canvas readback hands over: a flat byte buffer
+    self.source = memoryview(bytearray(frame.tobytes()))
+    self.mode = mode
+    self.restore = mode == 'restore'
+    if not self.restore:
+      self.params = mode_params(mode)
+    self.clip_limit = clip_limit
+    self.tile_grid = engine.normalize_tile_grid(tile_grid)
+    self.pool = RgbaBufferPool()
+
+  def stages(self):
+    if self.restore:
+      return ('readback', 'flatten')
+    return STAGES
+
+  def run_stage(self, stage):
+    if stage == 'readback':
+      self.rgba = engine.rgba_from_buffer(self.source, self.height, self.width)
+    elif stage == 'convert':
+      self.planes = engine.to_planes(self.rgba, self.params['lab'])
+    elif stage == 'equalize':
+      plane = engine.luminance_plane(self.planes, self.params['lab'])
+      self.equalized = engine.equalize_plane(plane, self.params['method'], self.clip_limit, self.tile_grid)
+    elif stage == 'compose':
+      out = self.pool.get(self.height, self.width)
+      self.result = engine.compose(self.equalized, self.planes, self.rgba[:, :, 3], self.params['lab'], out)
+    elif stage == 'flatten':
+      self.flat = (self.rgba if self.restore else self.result).reshape(-1)
+    else:
+      raise ValueError(f"Unknown stage: {stage!r}, expected one of {STAGES}")
+
+  def run(self):
+    for stage in self.stages():
+      self.run_stage(stage)
+
+
+def time_case(pipeline, repeat=DEFAULT_REPEAT):
+  """Median milliseconds of every stage over ``repeat`` passes, after one warm-up pass"""
+  pipeline.run()
+  samples = {stage: [] for stage in pipeline.stages()}
+  for _ in range(repeat):
+    for stage in pipeline.stages():
+      start = time.perf_counter()
+      pipeline.run_stage(stage)
+      samples[stage].append((time.perf_counter() - start) * 1000.0)
+  return {stage: statistics.median(values) for stage, values in samples.items()}
+
+
+def peak_bytes(pipeline):
+  """Peak bytes allocated by numpy/OpenCV during one pass, on top of what the pipeline already holds"""
+  tracemalloc.start()
+  try:
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    pipeline.run()
+    return tracemalloc.get_traced_memory()[1] - before
+  finally:
+    tracemalloc.stop()
+
+
+def case_key(resolution, mode):
+  return f"{resolution}/{mode}"
+
+
+def run_meta(repeat, clip_limit, tile_grid):
+  cv2 = engine.get_cv2() if engine.get_backend() == engine.BACKEND_OPENCV else None
+  return {
+    'backend': engine.get_backend(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'opencv': cv2.__version__ if cv2 is not None else None,
+    'machine': platform.machine(),
+    'platform': platform.platform(),
+    'cv2_threads': cv2.getNumThreads() if cv2 is not None else None,
+    'repeat': repeat,
+    'clip_limit': clip_limit,
+    'tile_grid': list(engine.normalize_tile_grid(tile_grid)),
+  }
+
+
+def run(resolutions=tuple(RESOLUTIONS), modes=MODES, repeat=DEFAULT_REPEAT, clip_limit=engine.DEFAULT_CLIP_LIMIT,
+        tile_grid=engine.DEFAULT_TILE_GRID, log=print):
+  """Benchmark every resolution/mode pair and return the report dict"""
+  report = {'meta': run_meta(repeat, clip_limit, tile_grid), 'results': {}}
+  for resolution in resolutions:
+    height, width = RESOLUTIONS[resolution]
+    frame = synthetic_frame(height, width)
+    for mode in modes:
+      pipeline = Pipeline(frame, mode, clip_limit, tile_grid)
+      stages = time_case(pipeline, repeat)
+      result = {
+        'height': height,
+        'width': width,
+        'stages_ms': stages,
+        'total_ms': sum(stages.values()),
+        'peak_bytes': peak_bytes(pipeline),
+      }
+      report['results'][case_key(resolution, mode)] = result
+      log(format_result(case_key(resolution, mode), result))
+  return report
+
+
+def lab_float(rgb):
+  """Float32 CIE LAB of 8-bit RGB, from the exact sRGB / D65 formulas"""
+  v = rgb[..., :3].astype(np.float32) / np.float32(255.0)
+  linear = np.where(v <= 0.04045, v / np.float32(12.92), ((v + np.float32(0.055)) / np.float32(1.055)) ** 2.4)
+  xyz = linear @ numpy_backend.RGB_TO_XYZ.T
+  xyz /= np.array([numpy_backend.WHITE_X, 1.0, numpy_backend.WHITE_Z], dtype=np.float32)
+  f = np.where(xyz > numpy_backend.LAB_EPSILON, np.cbrt(xyz), np.float32(7.787) * xyz + np.float32(16.0 / 116.0))
+  return np.stack((116.0 * f[..., 1] - 16.0, 500.0 * (f[..., 0] - f[..., 1]), 200.0 * (f[..., 1] - f[..., 2])), axis=-1)
+
+
+def perceptual_diff(rgba, reference, max_samples=DELTA_E_SAMPLES):
+  """CIE76 Delta E and mean absolute RGB difference of ``rgba`` against ``reference`` over a strided pixel sample"""
+  step = max(int(np.ceil(np.sqrt(rgba.shape[0] * rgba.shape[1] / max_samples))), 1)
+  a, b = rgba[::step, ::step, :3], reference[::step, ::step, :3]
+  delta_e = np.sqrt(((lab_float(a) - lab_float(b)) ** 2).sum(axis=-1))
+  return {
+    'mean_delta_e': float(delta_e.mean()),
+    'p95_delta_e': float(np.percentile(delta_e, 95)),
+    'max_delta_e': float(delta_e.max()),
+    'mean_abs_rgb': float(np.abs(a.astype(np.int16) - b).mean()),
+  }
+
+
+def lightness_report(resolutions=LIGHTNESS_RESOLUTIONS, method=engine.METHOD_CLAHE, repeat=DEFAULT_REPEAT,
+                     clip_limit=engine.DEFAULT_CLIP_LIMIT, tile_grid=engine.DEFAULT_TILE_GRID, log=print):
+  """Time every lightness space and compare its result with the LAB one; returns the report dict"""
+  report = {'meta': {**run_meta(repeat, clip_limit, tile_grid), 'method': method}, 'results': {}}
+  for resolution in resolutions:
+    height, width = RESOLUTIONS[resolution]
+    frame = synthetic_frame(height, width)
+    reference = None
+    for space in engine.LIGHTNESS_SPACES:
+      pipeline = Pipeline(frame, f"{space}-{method}", clip_limit, tile_grid)
+      stages = time_case(pipeline, repeat)
+      if reference is None:
+        reference = pipeline.result.copy()
+      result = {
+        'height': height,
+        'width': width,
+        'stages_ms': stages,
+        'lightness_ms': sum(stages[stage] for stage in ('convert', 'equalize', 'compose')),
+        **perceptual_diff(pipeline.result, reference),
+      }
+      report['results'][case_key(resolution, space)] = result
+      log(f"{case_key(resolution, space):<14} convert+equalize+compose {result['lightness_ms']:8.2f} ms  "
+          f"Delta E vs LAB mean {result['mean_delta_e']:5.2f} p95 {result['p95_delta_e']:5.2f} "
+          f"max {result['max_delta_e']:6.2f}  RGB mean abs {result['mean_abs_rgb']:5.2f}")
+  return report
+
+
+def format_result(key, result):
+  stages = '  '.join(f"{stage} {ms:7.2f}" for stage, ms in result['stages_ms'].items())
+  return f"{key:<20} total {result['total_ms']:8.2f} ms  peak {result['peak_bytes'] / 2 ** 20:7.1f} MiB  ({stages})"
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, noise_floor_ms=NOISE_FLOOR_MS):
+  """Return the regressions of ``current`` against ``baseline`` as a list of dicts.
+
+  A stage regresses when it is more than ``threshold`` (relative) and
+  ``noise_floor_ms`` (absolute) slower; a case regresses in memory when its
+  peak grows by more than ``threshold``. Cases missing from either report are
+  ignored.
+  """
+  regressions = []
+  for key, base in baseline['results'].items():
+    cur = current['results'].get(key)
+    if cur is None:
+      continue
+    for stage, base_ms in base['stages_ms'].items():
+      cur_ms = cur['stages_ms'].get(stage)
+      if cur_ms is None:
+        continue
+      if cur_ms > base_ms * (1.0 + threshold) and cur_ms - base_ms > noise_floor_ms:
+        regressions.append({'case': key, 'metric': stage, 'baseline': base_ms, 'current': cur_ms,
+                            'change': cur_ms / base_ms - 1.0 if base_ms > 0 else float('inf')})
+    base_peak, cur_peak = base['peak_bytes'], cur['peak_bytes']
+    if cur_peak > base_peak * (1.0 + threshold):
+      regressions.append({'case': key, 'metric': 'peak_bytes', 'baseline': base_peak, 'current': cur_peak,
+                          'change': cur_peak / base_peak - 1.0 if base_peak > 0 else float('inf')})
+  return regressions
+
+
+def load_report(path):
+  with open(path) as f:
+    return json.load(f)
+
+
+def save_report(report, path):
+  with open(path, 'w') as f:
+    json.dump(report, f, indent=2)
+
+
+def build_parser():
+  parser = argparse.ArgumentParser(description="Benchmark the enhancement hot path on synthetic frames")
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  run_parser = commands.add_parser('run', help="run the benchmarks and write a JSON report")
+  run_parser.add_argument('--out', default=None, help="JSON report to write, e.g. a new baseline")
+  run_parser.add_argument('--resolutions', nargs='+', choices=tuple(RESOLUTIONS), default=tuple(RESOLUTIONS))
+  run_parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+  run_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="timed passes per case")
+  run_parser.add_argument('--clip-limit', type=float, default=engine.DEFAULT_CLIP_LIMIT, help="CLAHE clip limit")
+  run_parser.add_argument('--tile-grid', type=int, default=engine.DEFAULT_TILE_GRID[0], help="CLAHE tiles per side")
+  run_parser.add_argument('--backend', choices=engine.BACKENDS, default=engine.get_backend(), help="engine backend")
+  run_parser.add_argument('--threads', type=int, default=None, help="OpenCV threads (default: OpenCV's choice)")
+  run_parser.add_argument('--baseline', default=None, help="compare against this report when done")
+  run_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="relative slowdown to flag")
+
+  lightness_parser = commands.add_parser('lightness', help="time the lightness spaces and report their Delta E to LAB")
+  lightness_parser.add_argument('--out', default=None, help="JSON report to write")
+  lightness_parser.add_argument('--resolutions', nargs='+', choices=tuple(RESOLUTIONS), default=LIGHTNESS_RESOLUTIONS)
+  lightness_parser.add_argument('--method', choices=engine.METHODS, default=engine.METHOD_CLAHE, help="equalization method")
+  lightness_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="timed passes per case")
+  lightness_parser.add_argument('--clip-limit', type=float, default=engine.DEFAULT_CLIP_LIMIT, help="CLAHE clip limit")
+  lightness_parser.add_argument('--tile-grid', type=int, default=engine.DEFAULT_TILE_GRID[0], help="CLAHE tiles per side")
+  lightness_parser.add_argument('--backend', choices=engine.BACKENDS, default=engine.get_backend(), help="engine backend")
+
+  compare_parser = commands.add_parser('compare', help="compare a report against a baseline")
+  compare_parser.add_argument('baseline', help="baseline JSON report")
+  compare_parser.add_argument('current', help="JSON report to check")
+  compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="relative slowdown to flag")
+  return parser
+
+
+def report_regressions(baseline, current, threshold):
+  regressions = compare(baseline, current, threshold)
+  for r in regressions:
+    print(f"REGRESSION {r['case']:<20} {r['metric']:<10} {r['baseline']:.2f} -> {r['current']:.2f} ({r['change']:+.0%})")
+  if not regressions:
+    print(f"No regressions over {threshold:.0%}")
+  return 1 if regressions else 0
+
+
+def main(argv=None):
+  args = build_parser().parse_args(argv)
+  if args.command == 'compare':
+    return report_regressions(load_report(args.baseline), load_report(args.current), args.threshold)
+
+  engine.set_backend(args.backend)
+  if args.command == 'lightness':
+    report = lightness_report(args.resolutions, args.method, args.repeat, args.clip_limit, args.tile_grid)
+    if args.out:
+      save_report(report, args.out)
+    return 0
+  if args.threads is not None and args.backend == engine.BACKEND_OPENCV:
+    engine.get_cv2().setNumThreads(args.threads)
+  report = run(args.resolutions, args.modes, args.repeat, args.clip_limit, args.tile_grid)
+  if args.out:
+    save_report(report, args.out)
+  if args.baseline:
+    return report_regressions(load_report(args.baseline), report, args.threshold)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,152 @@
+"""Reusable RGBA output buffers.
+
+Every Apply used to allocate an intermediate RGB image, a ``np.dstack`` copy
+with alpha, a ``flatten()`` copy and an ``astype`` copy before handing the
+pixels to ``ImageData``. The engine now writes the enhanced channels straight
+into a per-resolution RGBA buffer from this pool, which is reused across
+calls, so the Pyodide heap doesn't fragment with short-lived frame copies.
+
+Transient memory per call on an ``H x W`` uint8 frame, on top of the cached
+source pixels and planes and the pooled ``4*H*W`` output buffer (peak bytes
+traced by ``tracemalloc``, checked by ``tests/test_buffers.py``), is the
+larger of what equalizing the plane and writing the result take, as the
+temporaries of the first are freed by then.
+
+Equalizing allocates ``H*W`` bytes for the equalized plane, plus on NumPy:
+
+* global equalization: 8 bytes per pixel of a ``clahe.STRIP_ROWS`` strip
+  for the intp copies ``np.bincount`` and ``take`` make of it;
+* CLAHE: about 36 bytes per bin of the tile histograms while the LUTs get
+  clipped, then ``24`` bytes per pixel of one tile for the float32
+  interpolation blocks and their intp indices; when the tile histograms
+  aren't cached yet, also ``12`` bytes per pixel of a ``clahe.STRIP_ROWS``
+  strip for binning, and a padded copy of that strip if the plane doesn't
+  divide into whole tiles.
+
+Writing the result takes, with the equalized plane:
+
+* gray mode: nothing more;
+* LAB: on OpenCV ``3*H*W`` for the merged LAB image and ``3*H*W`` for the
+  converted RGB image (7 bytes per pixel); NumPy converts back to RGB strip
+  by strip straight into the output buffer, with 38 bytes per pixel of one
+  ``numpy_backend.STRIP_PIXELS`` strip for its float32, mask, index and
+  channel scratch buffers;
+* YCrCb: the int16 change of the luma and one int16 channel (5 bytes per
+  pixel);
+* HSV value and luma ratio: the uint16 gain table index, its intp copy in
+  ``take`` and the uint32 gains (15 bytes per pixel);
+* restore: nothing, the cached original is handed back as a flat view.
+
+``cv2`` allocates its internal CLAHE buffers outside of the traced heap.
+``transient_bytes`` returns these figures.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+import clahe
+import engine
+import numpy_backend
+
+
+POOL_SIZE = 2
+
+
+class RgbaBufferPool:
+  """Keeps one ``(H, W, 4)`` uint8 buffer per recently used resolution"""
+
+  def __init__(self, max_size=POOL_SIZE):
+    self.max_size = max_size
+    self._buffers = OrderedDict()
+    self.allocations = 0
+
+  def get(self, height, width):
+    key = (int(height), int(width))
+    buf = self._buffers.get(key)
+    if buf is None:
+      buf = np.empty((key[0], key[1], 4), dtype=np.uint8)
+      self.allocations += 1
+      self._buffers[key] = buf
+      if len(self._buffers) > self.max_size:
+        self._buffers.popitem(last=False)
+    else:
+      self._buffers.move_to_end(key)
+    return buf
+
+  @property
+  def nbytes(self):
+    return sum(buf.nbytes for buf in self._buffers.values())
+
+  def clear(self):
+    self._buffers.clear()
+
+
+# Bytes per pixel of writing the result, with the equalized plane, by backend and lightness (None: gray)
+PIXEL_BYTES = {
+  (engine.BACKEND_OPENCV, None): 1,
+  (engine.BACKEND_OPENCV, engine.LIGHTNESS_LAB): 7,
+  (engine.BACKEND_NUMPY, None): 1,
+  (engine.BACKEND_NUMPY, engine.LIGHTNESS_LAB): 1,
+}
+# The other lightness spaces write the result in NumPy on either backend
+for _backend in engine.BACKENDS:
+  PIXEL_BYTES[_backend, engine.LIGHTNESS_YCRCB] = 5
+  PIXEL_BYTES[_backend, engine.LIGHTNESS_HSV] = 15
+  PIXEL_BYTES[_backend, engine.LIGHTNESS_LUMA] = 15
+del _backend
+# Per pixel of a strip of the NumPy LAB -> RGB conversion: seven float32 buffers, a mask, intp indices and the
+# uint8 channel ``take`` buffers before writing it into the interleaved output
+LAB_STRIP_BYTES = 38
+# Per pixel of a strip: the intp copies of global equalization
+BINCOUNT_BYTES = 8
+# Per pixel of a CLAHE tile: float32 result, bottom row and delta blocks plus the intp indices
+INTERPOLATION_BYTES = 24
+# Per pixel of a binning strip: int32 bins and their intp copy in ``np.bincount``
+BINNING_BYTES = 12
+# Per histogram bin of all tiles: the int64 clipping and redistribution temporaries of ``clahe.compute_luts``
+LUT_BYTES = 36
+# Array headers, 256-entry LUTs, the casting buffers of ufuncs and other small allocations
+FIXED_BYTES = 65536
+
+
+def clahe_bytes(height, width, tile_grid=engine.DEFAULT_TILE_GRID, clahe_state=True):
+  """Upper bound of the temporaries of NumPy CLAHE on an 8-bit plane; ``clahe_state`` when the tile histograms are cached"""
+  tiles_x, tiles_y = engine.normalize_tile_grid(tile_grid)
+  ext_shape, (tile_w, tile_h) = clahe.tile_layout((int(height), int(width)), (tiles_x, tiles_y))
+  tables = tiles_x * tiles_y * clahe.HIST_SIZE
+  # The LUTs are derived first, then interpolated: blocks, float32 LUTs and the per-row and per-column weights
+  interpolation = INTERPOLATION_BYTES * tile_w * tile_h + 4 * tables + 16 * (ext_shape[0] + ext_shape[1])
+  total = tables + max(LUT_BYTES * tables, interpolation)
+  if not clahe_state:
+    total += BINNING_BYTES * min(clahe.STRIP_ROWS, ext_shape[0]) * ext_shape[1] + 2 * 8 * tables
+    if ext_shape != (height, width):
+      # The reflected rows and columns are added to one strip at a time
+      total += min(clahe.STRIP_ROWS, ext_shape[0]) * ext_shape[1] + 8 * ext_shape[0]
+  return total
+
+
+def transient_bytes(height, width, lab=False, restore=False, method=engine.METHOD_CLAHE, tile_grid=engine.DEFAULT_TILE_GRID,
+                    backend=None, clahe_state=True):
+  """Upper bound of the short-lived allocations of one call, see the module docstring.
+
+  ``backend`` defaults to the current engine backend; ``clahe_state`` says
+  whether the CLAHE tile histograms come from the pixel cache, as in the app.
+  """
+  if restore:
+    return 0
+  backend = backend or engine.get_backend()
+  pixels = int(height) * int(width)
+  space = engine.lightness_space(lab)
+  equalize = pixels
+  write = pixels * PIXEL_BYTES[backend, space]
+  if backend == engine.BACKEND_NUMPY:
+    if method == engine.METHOD_EQUALIZE:
+      equalize += BINCOUNT_BYTES * min(clahe.STRIP_ROWS, int(height)) * int(width)
+    else:
+      equalize += clahe_bytes(height, width, tile_grid, clahe_state)
+    if space == engine.LIGHTNESS_LAB:
+      write += LAB_STRIP_BYTES * numpy_backend.strip_rows(width) * int(width)
+  return max(equalize, write) + FIXED_BYTES
+
+
+rgba_pool = RgbaBufferPool()
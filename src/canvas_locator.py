@@ -0,0 +1,213 @@
+"""Locating the canvas of a video in the annotation tool store, with a per-video path cache.
+
+Finding the canvas means walking ``store.state.videos``, the player-related
+keys of ``store.state``, the current frame object and finally the video
+object itself, which costs hundreds of JsProxy attribute accesses. The walk
+records the access path of the canvas it finds; ``CanvasPathCache`` keeps
+that path per video ID and later calls just follow it, falling back to the
+full search only when the cached canvas no longer validates. A video whose
+search found nothing goes straight to the frame-URL fallback for a while,
+then gets searched again, since the player may mount its canvas later.
+
+A path is a root name (``'store'`` for ``store.state`` or ``'video'`` for the
+video object) followed by steps: ``('attr', name)``, ``('item', key)`` or
+``('frame', how)``, the latter indexing the current frame the way it was
+found (``'item'``, ``'item_str'`` or ``'frames'``).
+"""
+import time
+
+PLAYER_KEY_TERMS = ('player', 'canvas', 'render', 'display', 'current', 'active', 'ui')
+VIDEO_PROP_TERMS = ('canvas', 'image', 'source', 'data', 'element', 'frame', 'render', 'display')
+MAX_SEARCH_DEPTH = 3
+# A failed search is retried after this many calls or seconds, whichever comes first
+NOT_FOUND_RETRY_CALLS = 25
+NOT_FOUND_RETRY_SECONDS = 5.0
+
+
+def is_canvas(obj):
+  return obj is not None and hasattr(obj, 'getContext')
+
+
+def is_js_object(obj):
+  return str(type(obj)) == "<class 'pyodide.ffi.JsProxy'>"
+
+
+def follow_step(obj, step, frame=None):
+  kind, key = step
+  if kind == 'attr':
+    return getattr(obj, key)
+  if kind == 'item':
+    return obj[key]
+  if kind == 'frame':
+    if key == 'item':
+      return obj[frame]
+    if key == 'item_str':
+      return obj[str(frame)]
+    return getattr(obj.frames, str(frame))
+  raise ValueError(f"Unknown path step: {step!r}")
+
+
+def resolve_path(roots, path, frame=None):
+  """Follow ``path`` from ``roots[path[0]]``, returning None if any step fails"""
+  try:
+    obj = roots[path[0]]
+    for step in path[1:]:
+      obj = follow_step(obj, step, frame)
+    return obj
+  except Exception:
+    return None
+
+
+def search_for_canvas(obj, path, keys, max_depth=MAX_SEARCH_DEPTH, current_depth=0):
+  """Recursively search ``obj`` for a canvas, returning ``(canvas, path)`` or ``(None, None)``"""
+  if current_depth >= max_depth:
+    return None, None
+  try:
+    if is_canvas(obj):
+      return obj, path
+    for prop in ('canvas', 'imageData'):
+      if hasattr(obj, prop):
+        value = getattr(obj, prop)
+        if is_canvas(value):
+          return value, path + [('attr', prop)]
+    if is_js_object(obj):
+      for key in keys(obj):
+        try:
+          value = getattr(obj, key)
+          if is_js_object(value):
+            found, found_path = search_for_canvas(value, path + [('attr', key)], keys, max_depth, current_depth + 1)
+            if found is not None:
+              return found, found_path
+        except Exception:
+          pass  # Skip properties we can't access
+  except Exception:
+    pass
+  return None, None
+
+
+def find_frame_canvas(cur_img, frame):
+  """Look for ``cur_img[frame].sources[0].imageData``, trying the known ways to index a frame"""
+  for how in ('item', 'item_str', 'frames'):
+    try:
+      frame_obj = follow_step(cur_img, ('frame', how), frame)
+    except Exception:
+      continue
+    if not frame_obj:
+      continue
+    try:
+      canvas = frame_obj.sources[0].imageData
+    except Exception:
+      return None, None
+    if is_canvas(canvas):
+      path = ['video', ('frame', how), ('attr', 'sources'), ('item', 0), ('attr', 'imageData')]
+      return canvas, path
+    return None, None
+  return None, None
+
+
+def find_video_canvas(store_state, cur_img, frame, keys):
+  """Full search for the canvas of a video, returning ``(canvas, path)`` or ``(None, None)``"""
+  # Player components in store.state.videos (excluding 'all', which is the dataset)
+  videos_obj = store_state.videos
+  for key in keys(videos_obj):
+    if key == 'all':
+      continue
+    try:
+      found, path = search_for_canvas(getattr(videos_obj, key), ['store', ('attr', 'videos'), ('attr', key)], keys)
+    except Exception:
+      continue
+    if found is not None:
+      return found, path
+
+  # Player-related keys of the broader store.state
+  for key in keys(store_state):
+    if not any(term in key.lower() for term in PLAYER_KEY_TERMS):
+      continue
+    try:
+      found, path = search_for_canvas(getattr(store_state, key), ['store', ('attr', key)], keys)
+    except Exception:
+      continue
+    if found is not None:
+      return found, path
+
+  # Frame-level sources, like images but per frame
+  found, path = find_frame_canvas(cur_img, frame)
+  if found is not None:
+    return found, path
+
+  # Canvas-like properties of the video object itself
+  for prop in dir(cur_img):
+    if not any(term in prop.lower() for term in VIDEO_PROP_TERMS):
+      continue
+    try:
+      value = getattr(cur_img, prop)
+    except Exception:
+      continue
+    if is_canvas(value):
+      return value, ['video', ('attr', prop)]
+    for inner in ('canvas', 'imageData'):
+      inner_value = getattr(value, inner, None)
+      if is_canvas(inner_value):
+        return inner_value, ['video', ('attr', prop), ('attr', inner)]
+
+  return None, None
+
+
+class CanvasPathCache:
+  """Per-video cache of the access path (and size) of the canvas found by the full search"""
+
+  def __init__(self, retry_calls=NOT_FOUND_RETRY_CALLS, retry_seconds=NOT_FOUND_RETRY_SECONDS, clock=time.monotonic):
+    self._paths = {}
+    # video ID -> (calls left, deadline) for videos whose full search found nothing
+    self._not_found = {}
+    self.retry_calls = retry_calls
+    self.retry_seconds = retry_seconds
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+
+  def remember(self, video_id, path, canvas):
+    self._paths[video_id] = (path, canvas.width, canvas.height)
+
+  def forget(self, video_id):
+    self._paths.pop(video_id, None)
+    self._not_found.pop(video_id, None)
+
+  def lookup(self, roots, video_id, frame=None):
+    """Follow the cached path of ``video_id`` and return the canvas if it still validates"""
+    cached = self._paths.get(video_id)
+    if cached is not None:
+      path, width, height = cached
+      canvas = resolve_path(roots, path, frame)
+      if is_canvas(canvas) and canvas.width == width and canvas.height == height:
+        self.hits += 1
+        return canvas
+      self.forget(video_id)
+    self.misses += 1
+    return None
+
+  def _recently_not_found(self, video_id):
+    """Whether the last search for ``video_id`` found nothing and hasn't expired yet; counts one call"""
+    not_found = self._not_found.get(video_id)
+    if not_found is None:
+      return False
+    calls_left, deadline = not_found
+    if calls_left <= 0 or self.clock() >= deadline:
+      del self._not_found[video_id]
+      return False
+    self._not_found[video_id] = (calls_left - 1, deadline)
+    return True
+
+  def locate(self, roots, video_id, cur_img, frame, keys):
+    """Return the video canvas from the cache, running the full search only on a miss"""
+    if self._recently_not_found(video_id):
+      self.hits += 1
+      return None
+    canvas = self.lookup(roots, video_id, frame)
+    if canvas is None:
+      canvas, path = find_video_canvas(roots['store'], cur_img, frame, keys)
+      if canvas is not None:
+        self.remember(video_id, path, canvas)
+      else:
+        self._not_found[video_id] = (self.retry_calls, self.clock() + self.retry_seconds)
+    return canvas
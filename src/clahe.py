@@ -0,0 +1,380 @@
+"""Incremental CLAHE for 8- and 16-bit planes.
+
+``cv2.createCLAHE(...).apply`` recomputes the tile histograms on every call,
+although while the clip-limit slider is dragged only the clip limit changes.
+``IncrementalClahe`` computes the per-tile histograms once per plane and on
+each clip-limit change only redoes clipping, redistribution and the CDF LUTs,
+then applies them with vectorized bilinear interpolation.
+
+The tiling, clipping and interpolation follow OpenCV's implementation, so the
+output matches ``cv2.createCLAHE`` within one gray level.
+The interpolation itself is slower than ``cv2.CLAHE`` on 8-bit planes, so
+the app only keeps the tile histograms where OpenCV isn't used anyway (see
+``engine.reuses_tile_histograms``).
+
+uint16 planes (e.g. 12-bit medical or 14-bit thermal data) keep their bit
+depth: the histograms have one bin per value up to the plane's bit depth,
+and the LUTs map to the full range of that bit depth. Values are first
+divided by the step between the levels actually used (the GCD of the
+values present), so e.g. 8-bit data scaled to 16 bits gets the same 256
+bins as the 8-bit original. CLAHE tile histograms have at most
+``1 << MAX_HIST_BITS`` bins; when there are more levels than that, each
+level is mapped between the LUT values of the previous bin and of its own
+bin by its position in the bin, so the output keeps the levels of a bin
+apart instead of quantizing them to the bins.
+"""
+import numpy as np
+
+
+HIST_SIZE = 256
+# Bits of the per-tile histograms of 16-bit planes, bounds their memory
+MAX_HIST_BITS = 12
+# Rows binned per pass, bounds the size of the int32 temporaries
+STRIP_ROWS = 256
+
+
+def plane_bits(plane, bits=None):
+  """Bit depth of a plane: 8 for uint8, else ``bits`` or that of the largest value (at least 8)"""
+  if plane.dtype == np.uint8:
+    return 8
+  if bits:
+    return int(bits)
+  return max(int(plane.max(initial=0)).bit_length(), 8)
+
+
+def value_histogram(plane):
+  """``np.bincount`` of a uint8 or uint16 plane over its whole value range, ``STRIP_ROWS`` rows at a time"""
+  hist = np.zeros(np.iinfo(plane.dtype).max + 1, dtype=np.int64)
+  plane = plane.reshape(plane.shape[0], -1)
+  # ``np.bincount`` makes an intp copy of what it counts
+  for r0 in range(0, plane.shape[0], STRIP_ROWS):
+    hist += np.bincount(plane[r0:r0 + STRIP_ROWS].ravel(), minlength=hist.size)
+  return hist
+
+
+def level_layout(hist, bits):
+  """Return ``(step, levels, bin_shift)`` of a uint16 plane of ``bits`` bits from its ``value_histogram``.
+
+  ``step`` is the greatest common divisor of the values present, with values
+  beyond the bit depth counted as its largest value; a plane has ``levels``
+  levels of that step, and ``level >> bin_shift`` is its CLAHE histogram bin.
+  """
+  max_value = (1 << bits) - 1
+  present = np.flatnonzero(hist[:max_value])
+  if hist[max_value:].any():
+    present = np.append(present, max_value)
+  step = int(np.gcd.reduce(present)) or 1
+  levels = max_value // step + 1
+  return step, levels, max((levels - 1).bit_length() - MAX_HIST_BITS, 0)
+
+
+def to_levels(plane, bits, step):
+  """Level of every pixel of a uint16 plane: its value, clipped to ``bits`` bits, divided by ``step``"""
+  max_value = (1 << bits) - 1
+  if int(plane.max(initial=0)) > max_value:
+    # Samples beyond the given bit depth would land in the bins of the next tile
+    plane = np.minimum(plane, np.uint16(max_value))
+  return plane // np.uint16(step) if step > 1 else plane
+
+
+def level_index(plane, bits):
+  """Return ``(index, levels, bin_shift)`` of a uint16 plane of ``bits`` bits, see ``level_layout``"""
+  step, levels, bin_shift = level_layout(value_histogram(plane), bits)
+  return to_levels(plane, bits, step), levels, bin_shift
+
+
+def tile_layout(shape, tile_grid):
+  """Return ``(ext_shape, tile_size)`` of OpenCV's CLAHE tiling for a plane of ``shape``.
+
+  Like OpenCV, a plane that doesn't divide evenly into tiles is extended at
+  the bottom/right with ``BORDER_REFLECT_101`` before the histograms are taken.
+  """
+  tiles_x, tiles_y = tile_grid
+  height, width = shape
+  if width % tiles_x != 0 or height % tiles_y != 0:
+    height += tiles_y - height % tiles_y
+    width += tiles_x - width % tiles_x
+  return (height, width), (width // tiles_x, height // tiles_y)
+
+
+def accumulate_tile_histograms(hists, values, tile_size, origin=(0, 0)):
+  """Add the pixels of ``values`` to ``hists`` of shape ``(tiles_y, tiles_x, hist_size)``.
+
+  ``values`` is a block of the extended plane whose top-left pixel sits at
+  ``origin`` (row, col), so a plane can be binned piece by piece.
+  """
+  tiles_y, tiles_x, hist_size = hists.shape
+  tile_w, tile_h = tile_size
+  row0, col0 = origin
+  row_tile = ((np.arange(values.shape[0], dtype=np.int32) + row0) // tile_h) * (tiles_x * hist_size)
+  col_tile = ((np.arange(values.shape[1], dtype=np.int32) + col0) // tile_w) * hist_size
+  flat = hists.reshape(-1)
+  for r0 in range(0, values.shape[0], STRIP_ROWS):
+    r1 = min(r0 + STRIP_ROWS, values.shape[0])
+    bins = values[r0:r1].astype(np.int32)
+    bins += row_tile[r0:r1, None]
+    bins += col_tile[None, :]
+    flat += np.bincount(bins.ravel(), minlength=flat.size)
+  return hists
+
+
+def tile_histogram_bands(plane, tile_grid, hist_size=HIST_SIZE, band_rows=STRIP_ROWS, bin_shift=0):
+  """Generator version of ``tile_histograms`` binning ``band_rows`` rows at a time and yielding after each band.
+
+  The rows and columns past the edges of the plane are reflected band by
+  band, so the extended plane is never copied as a whole. Values are
+  shifted right by ``bin_shift`` into their bin.
+  """
+  tiles_x, tiles_y = tile_grid
+  height, width = plane.shape
+  (ext_h, ext_w), tile_size = tile_layout(plane.shape, tile_grid)
+  row_map = np.pad(np.arange(height), (0, ext_h - height), mode='reflect')
+  hists = np.zeros((tiles_y, tiles_x, hist_size), dtype=np.int64)
+  for r0 in range(0, ext_h, band_rows):
+    r1 = min(r0 + band_rows, ext_h)
+    band = plane[r0:r1] if r1 <= height else plane[row_map[r0:r1]]
+    if ext_w != width:
+      band = np.pad(band, ((0, 0), (0, ext_w - width)), mode='reflect')
+    if bin_shift:
+      band = band >> bin_shift
+    accumulate_tile_histograms(hists, band, tile_size, origin=(r0, 0))
+    yield
+  return hists, tile_size
+
+
+def tile_histograms(plane, tile_grid, hist_size=HIST_SIZE):
+  """Return ``(hists, tile_size)`` where ``hists`` has shape ``(tiles_y, tiles_x, hist_size)``"""
+  return run_bands(tile_histogram_bands(plane, tile_grid, hist_size))
+
+
+def run_bands(steps):
+  """Run a generator of banded work to completion and return its result"""
+  while True:
+    try:
+      next(steps)
+    except StopIteration as done:
+      return done.value
+
+
+def clip_limit_to_count(clip_limit, tile_area, hist_size=HIST_SIZE):
+  """Convert a CLAHE clip limit into an absolute per-bin count, 0 meaning no clipping"""
+  if clip_limit <= 0:
+    return 0
+  return max(int(clip_limit * tile_area / hist_size), 1)
+
+
+def clip_limits_to_counts(clip_limits, tile_area, hist_size=HIST_SIZE):
+  """``clip_limit_to_count`` over an array of clip limits"""
+  clip_limits = np.asarray(clip_limits, dtype=np.float64)
+  counts = np.maximum((clip_limits * tile_area / hist_size).astype(np.int64), 1)
+  return np.where(clip_limits > 0, counts, 0)
+
+
+def compute_luts(hists, clip_count, tile_area, max_value=255, dtype=np.uint8):
+  """Derive CDF LUTs onto ``[0, max_value]`` from tile histograms of any leading shape ``(..., hist_size)``.
+
+  ``clip_count`` is a scalar or an array broadcasting against the leading
+  shape, e.g. ``(K, 1, 1)`` counts with ``(tiles_y, tiles_x, 256)``
+  histograms give the ``(K, tiles_y, tiles_x, 256)`` LUTs of K clip limits.
+  """
+  hist_size = hists.shape[-1]
+  hists = hists.astype(np.int64)
+  clip_count = np.asarray(clip_count, dtype=np.int64)
+  if (clip_count > 0).any():
+    limit = np.where(clip_count > 0, clip_count, np.iinfo(np.int64).max)[..., None]
+    excess = np.maximum(hists - limit, 0).sum(axis=-1)
+    hists = np.minimum(hists, limit)
+    redist_batch = excess // hist_size
+    residual = excess - redist_batch * hist_size
+    hists += redist_batch[..., None]
+
+    # The residual goes one by one into every ``step``-th bin starting from 0
+    bins = np.arange(hist_size)
+    step = np.maximum(hist_size // np.maximum(residual, 1), 1)[..., None]
+    hists += ((bins % step == 0) & (bins // step < residual[..., None])).astype(np.int64)
+
+  lut_scale = np.float32(max_value / tile_area)
+  cdf = np.cumsum(hists, axis=-1).astype(np.float32)
+  return np.clip(np.rint(cdf * lut_scale), 0, max_value).astype(dtype)
+
+
+def equalize_hist_lut(hist, max_value=255, dtype=np.uint8):
+  """LUT of global histogram equalization onto ``[0, max_value]``, same mapping as ``cv2.equalizeHist``"""
+  hist = np.asarray(hist, dtype=np.int64)
+  total = int(hist.sum())
+  nonzero = np.flatnonzero(hist)
+  if total == 0:
+    return np.arange(len(hist)).astype(dtype)
+  first = int(nonzero[0])
+  if hist[first] == total:
+    return np.full(len(hist), first, dtype=dtype)
+  # float64 keeps 16-bit CDFs of large images exact
+  scale = max_value / (total - hist[first])
+  cdf = np.cumsum(hist) - hist[first]
+  lut = np.clip(np.rint(cdf * scale if max_value > 255 else cdf.astype(np.float32) * np.float32(scale)), 0, max_value).astype(dtype)
+  lut[:first] = 0
+  return lut
+
+
+def equalize_hist(plane, bits=None, out=None):
+  """Global equalization of a uint8 or uint16 plane of ``bits`` bits; the histogram has one bin per value"""
+  max_value = (1 << plane_bits(plane, bits)) - 1
+  lut = equalize_hist_lut(value_histogram(plane), max_value, plane.dtype)
+  if out is None:
+    out = np.empty_like(plane)
+  # Strip by strip, like the histogram, as ``take`` converts its indices to intp
+  for r0 in range(0, plane.shape[0], STRIP_ROWS):
+    np.take(lut, plane[r0:r0 + STRIP_ROWS], out=out[r0:r0 + STRIP_ROWS], mode='clip')
+  return out
+
+
+def interpolation_grid(length, tile_len, tiles, start=0, stride=1):
+  """Per-row (or per-column) tile indices and weights of the bilinear interpolation of every ``stride``-th pixel"""
+  pos = np.arange(start, start + length * stride, stride, dtype=np.float32) * np.float32(1.0 / tile_len) - np.float32(0.5)
+  t1 = np.floor(pos).astype(np.int32)
+  weight = (pos - t1).astype(np.float32)
+  t2 = np.minimum(t1 + 1, tiles - 1)
+  t1 = np.maximum(t1, 0)
+  return t1, t2, weight
+
+
+def interpolation_blocks(t1, t2):
+  """Split an axis into ``(start, stop)`` runs over which both tile indices stay constant"""
+  changes = np.flatnonzero((np.diff(t1) != 0) | (np.diff(t2) != 0)) + 1
+  bounds = [0, *changes.tolist(), len(t1)]
+  return list(zip(bounds[:-1], bounds[1:]))
+
+
+def level_rise(levels, bin_shift):
+  """Position of every level in its bin of ``1 << bin_shift`` levels, from the first level (``1 / width``) to the last (1)"""
+  level = np.arange(levels)
+  first = (level >> bin_shift) << bin_shift
+  # The last bin may hold fewer levels
+  return ((level - first + 1) / np.minimum(levels - first, 1 << bin_shift)).astype(np.float32)
+
+
+def apply_luts(plane, luts, tile_size, out=None, origin=(0, 0), bin_shift=0, levels=None, stride=1):
+  """Map ``plane`` through per-tile ``luts`` with bilinear interpolation between tile centers.
+
+  The plane is walked block by block, where a block is the area between four
+  neighbouring tile centers. Inside a block the four LUTs are fixed, so each
+  lookup is a ``take`` into a 256-entry table indexed directly by the pixels,
+  and the interpolation runs in place on float32 blocks.
+  ``plane`` may be a piece of a larger plane whose top-left pixel sits at
+  ``origin`` (row, col); the result is the same as for the whole plane.
+  With ``stride``, ``plane`` holds every ``stride``-th pixel of the plane the
+  tiles were laid out on, e.g. a display-size copy, and the result is that
+  of the whole plane at those pixels.
+
+  With ``bin_shift``, ``plane`` holds ``levels`` levels and the LUTs have one
+  entry per bin of ``1 << bin_shift`` of them: a level goes from the LUT value
+  of the previous bin towards that of its own bin by ``level_rise``. The
+  blend is linear, so it is done once on the interpolated values of both.
+  """
+  tiles_y, tiles_x, _ = luts.shape
+  tile_w, tile_h = tile_size
+  height, width = plane.shape
+  if out is None:
+    out = np.empty_like(plane)
+
+  float_luts = luts.astype(np.float32)
+  if bin_shift:
+    # Where each bin starts: the LUT value of the previous bin, 0 before the first
+    start_luts = np.zeros_like(float_luts)
+    start_luts[..., 1:] = float_luts[..., :-1]
+    rise_table = level_rise(levels, bin_shift)
+  ty1, ty2, ya = interpolation_grid(height, tile_h, tiles_y, origin[0], stride)
+  tx1, tx2, xa = interpolation_grid(width, tile_w, tiles_x, origin[1], stride)
+  col_blocks = interpolation_blocks(tx1, tx2)
+
+  for r0, r1 in interpolation_blocks(ty1, ty2):
+    rows = (ty1[r0], ty2[r0])
+    wy = ya[r0:r1, None]
+    for c0, c1 in col_blocks:
+      cols = (tx1[c0], tx2[c0])
+      # ``take`` converts its indices to intp on every call; convert them once for all lookups
+      values = plane[r0:r1, c0:c1].astype(np.intp)
+      wx = xa[c0:c1]
+      if bin_shift:
+        rise = rise_table.take(values)
+        values >>= bin_shift
+        res = _interpolate(float_luts, rows, cols, values, wx, wy)
+        start = _interpolate(start_luts, rows, cols, values, wx, wy)
+        res -= start
+        res *= rise
+        res += start
+        del start, rise
+      else:
+        res = _interpolate(float_luts, rows, cols, values, wx, wy)
+      np.rint(res, out=res)
+      out[r0:r1, c0:c1] = res
+  return out
+
+
+def _interpolate(luts, rows, cols, values, wx, wy):
+  """Bilinear blend of the lookups of ``values`` in the LUTs of the tiles ``rows`` x ``cols``"""
+  (top, bottom), (left, right) = rows, cols
+  res = luts[top, left].take(values)
+  if left != right:
+    delta = luts[top, right].take(values)
+    delta -= res
+    delta *= wx
+    res += delta
+    del delta
+  if top != bottom:
+    lower = luts[bottom, left].take(values)
+    if left != right:
+      delta = luts[bottom, right].take(values)
+      delta -= lower
+      delta *= wx
+      lower += delta
+      del delta
+    lower -= res
+    lower *= wy
+    res += lower
+  return res
+
+
+class IncrementalClahe:
+  """CLAHE over one uint8 or uint16 plane with the tile histograms computed once"""
+
+  def __init__(self, plane, tile_grid, bits=None):
+    run_bands(self._setup(plane, tile_grid, bits))
+
+  @classmethod
+  def in_bands(cls, plane, tile_grid, bits=None, band_rows=STRIP_ROWS):
+    """Generator building the state ``band_rows`` rows of tile histograms at a time, yielding after each band"""
+    state = cls.__new__(cls)
+    yield from state._setup(plane, tile_grid, bits, band_rows)
+    return state
+
+  def _setup(self, plane, tile_grid, bits, band_rows=STRIP_ROWS):
+    self.plane = plane
+    self.tile_grid = tuple(tile_grid)
+    self.bits = plane_bits(plane, bits)
+    self.max_value = (1 << self.bits) - 1
+    if plane.dtype == np.uint8:
+      self.index, self.levels, self.bin_shift = plane, HIST_SIZE, 0
+    else:
+      self.index, self.levels, self.bin_shift = level_index(plane, self.bits)
+    self.hist_size = ((self.levels - 1) >> self.bin_shift) + 1
+    self.hists, self.tile_size = yield from tile_histogram_bands(self.index, self.tile_grid, self.hist_size, band_rows,
+                                                                 self.bin_shift)
+    self.tile_area = self.tile_size[0] * self.tile_size[1]
+    self._last_clip_count = None
+    self._last_luts = None
+
+  @property
+  def nbytes(self):
+    return self.hists.nbytes + (self.index.nbytes if self.index is not self.plane else 0)
+
+  def luts(self, clip_limit):
+    clip_count = clip_limit_to_count(clip_limit, self.tile_area, self.hist_size)
+    if clip_count != self._last_clip_count:
+      self._last_luts = compute_luts(self.hists, clip_count, self.tile_area, self.max_value, self.plane.dtype)
+      self._last_clip_count = clip_count
+    return self._last_luts
+
+  def apply(self, clip_limit, out=None):
+    return apply_luts(self.index, self.luts(clip_limit), self.tile_size, out=out, bin_shift=self.bin_shift,
+                      levels=self.levels)
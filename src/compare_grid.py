@@ -0,0 +1,109 @@
+"""Side-by-side comparison of CLAHE clip limits and tile grids.
+
+Renders the current image with K clip limits (columns) and optionally
+several tile grids (rows) in one batched pass at preview resolution:
+
+* the gray or lightness planes and the tile histograms of each tile grid are taken
+  once from the full-resolution image (and stay in the pixel cache for the
+  render that follows);
+* the K LUT sets of a tile grid come from one vectorized ``compute_luts``
+  call over a leading parameter axis;
+* only the display-size strided plane is interpolated and composed per cell,
+  at the positions of its pixels in the full-resolution plane, so every cell
+  is the full-resolution result sampled at the grid stride.
+
+uint16 images are equalized at their bit depth and quantized to 8 bits per
+cell, like the full-resolution result is for display.
+"""
+import numpy as np
+
+import clahe
+import engine
+import preview
+
+
+DEFAULT_CLIP_LIMITS = (1.0, 2.0, 3.0, 4.0, 6.0, 8.0)
+MAX_CELLS = 24
+# Gap between cells, in pixels, and its color
+CELL_GAP = 4
+GAP_RGBA = (255, 255, 255, 255)
+
+
+def parse_values(text, cast=float, default=()):
+  """Values of a comma- or space-separated list like ``"1, 2.5, 4"``; ``default`` if none parse"""
+  values = []
+  for part in str(text or '').replace(',', ' ').split():
+    try:
+      value = cast(part)
+    except ValueError:
+      continue
+    if value > 0 and value not in values:
+      values.append(value)
+  return tuple(values) or tuple(default)
+
+
+def batch_luts(state, clip_limits):
+  """LUTs of shape ``(K, tiles_y, tiles_x, hist_size)`` for K clip limits from the tile histograms of ``state``"""
+  counts = clahe.clip_limits_to_counts(clip_limits, state.tile_area, state.hist_size)
+  hists = np.broadcast_to(state.hists, (len(counts),) + state.hists.shape)
+  return clahe.compute_luts(hists, counts[:, None, None], state.tile_area, state.max_value, state.plane.dtype)
+
+
+def grid_layout(cell_shape, rows, cols, gap=CELL_GAP):
+  """``(height, width)`` of the grid and the ``(y, x)`` origin of each cell, row-major"""
+  cell_h, cell_w = cell_shape
+  origins = [(r * (cell_h + gap), c * (cell_w + gap)) for r in range(rows) for c in range(cols)]
+  return (rows * cell_h + (rows - 1) * gap, cols * cell_w + (cols - 1) * gap), origins
+
+
+def compare_grid(planes, alpha, lab, clip_limits=DEFAULT_CLIP_LIMITS, tile_grids=(engine.DEFAULT_TILE_GRID,),
+                 max_side=preview.PREVIEW_MAX_SIDE, clahe_state=None, gap=CELL_GAP, bits=None):
+  """Return ``(grid, cells)``: a uint8 RGBA grid of CLAHE results and ``(y, x, clip_limit, tile_grid)`` per cell.
+
+  ``planes`` is ``engine.to_planes`` of the full-resolution image with ``alpha``.
+  ``clahe_state(tile_grid)`` optionally supplies the tile histograms of the
+  equalized plane, e.g. from the pixel cache; one ``IncrementalClahe`` per
+  tile grid (of ``bits`` bits for uint16 planes) is built otherwise.
+  """
+  plane = engine.luminance_plane(planes, lab)
+  height, width = plane.shape
+  step = preview.preview_step(height, width, max_side)
+  if engine.lightness_space(lab) is None:
+    small_planes = small = np.ascontiguousarray(plane[::step, ::step])
+  else:
+    small_planes = [np.ascontiguousarray(p[::step, ::step]) for p in planes]
+    small = small_planes[0]
+  small_alpha = alpha[::step, ::step]
+
+  tile_grids = [engine.normalize_tile_grid(tile_grid) for tile_grid in tile_grids]
+  clip_limits = list(clip_limits)
+  (grid_h, grid_w), origins = grid_layout(small.shape, len(tile_grids), len(clip_limits), gap)
+  grid = np.empty((grid_h, grid_w, 4), dtype=np.uint8)
+  grid[:] = GAP_RGBA
+  cell = np.empty(small.shape + (4,), dtype=small.dtype)
+  cells = []
+
+  origins = iter(origins)
+  for tile_grid in tile_grids:
+    state = clahe_state(tile_grid) if clahe_state is not None else clahe.IncrementalClahe(plane, tile_grid, bits)
+    luts = batch_luts(state, clip_limits)
+    # The levels of uint16 planes, which the LUTs are indexed with by bin
+    small_index = small if state.index is state.plane else state.index[::step, ::step]
+    for clip_limit, cell_luts in zip(clip_limits, luts):
+      # Pixel (i, j) of the strided plane is pixel (i * step, j * step) of the full one
+      eq = clahe.apply_luts(small_index, cell_luts, state.tile_size, bin_shift=state.bin_shift, levels=state.levels,
+                            stride=step)
+      engine.compose(eq, small_planes, small_alpha, lab, cell, state.bits)
+      y, x = next(origins)
+      grid[y:y + cell.shape[0], x:x + cell.shape[1]] = engine.to_uint8(cell, state.bits)
+      cells.append((y, x, clip_limit, tile_grid))
+  return grid, cells
+
+
+def describe(cells):
+  """Short legend of a grid: the clip limits of the columns and the tile grids of the rows"""
+  clip_limits = list(dict.fromkeys(clip_limit for _, _, clip_limit, _ in cells))
+  tile_grids = list(dict.fromkeys(tile_grid for _, _, _, tile_grid in cells))
+  clips = ' | '.join(f"{clip_limit:g}" for clip_limit in clip_limits)
+  grids = ' | '.join(f"{tx}x{ty}" for tx, ty in tile_grids)
+  return f"Clip limit per column: {clips}; tile grid per row: {grids}"
@@ -0,0 +1,356 @@
+"""Headless histogram equalization / CLAHE engine.
+
+Works on plain ``np.ndarray`` RGBA frames and has no Pyodide or canvas
+dependencies, so it can be imported and profiled on a regular machine.
+
+Color conversion and equalization run on one of two backends, selected with
+``set_backend``: ``'opencv'`` (the default when ``cv2`` is installed) or
+``'numpy'`` (``numpy_backend``, no OpenCV needed). ``cv2`` is only imported
+once the OpenCV backend is actually used, so the app can start on NumPy alone.
+
+The ``lab`` argument selects what gets equalized: ``False`` the gray plane,
+``True`` or ``'lab'`` the LAB lightness, ``'ycrcb'``, ``'hsv'`` or ``'luma'``
+one of the cheaper lightness modes of ``lightness``, which skip the LAB round
+trip and put the equalized luminance back into RGB with integer arithmetic.
+
+Frames and planes may be uint8 or uint16. 16-bit data keeps its bit depth
+through equalization (see ``clahe``) and composition; ``to_uint8`` quantizes
+it for display only. 16-bit planes are equalized by ``clahe`` on both
+backends, and 16-bit LAB goes through OpenCV's float32 conversion. The bit
+depth of uint16 data (e.g. 12 for 12-bit data) is given with ``bits``;
+when it isn't, it is taken from the largest color value of each frame.
+"""
+import importlib.util
+from collections import OrderedDict
+
+import numpy as np
+
+import clahe
+import lightness
+import numpy_backend
+
+
+# Bumped whenever the output of the engine changes, invalidating persisted results
+ENGINE_VERSION = '1'
+
+METHOD_EQUALIZE = 'equalize'
+METHOD_CLAHE = 'clahe'
+METHODS = (METHOD_EQUALIZE, METHOD_CLAHE)
+
+DEFAULT_CLIP_LIMIT = 2.0
+DEFAULT_TILE_GRID = (8, 8)
+CLAHE_POOL_SIZE = 8
+
+BACKEND_OPENCV = 'opencv'
+BACKEND_NUMPY = 'numpy'
+BACKENDS = (BACKEND_OPENCV, BACKEND_NUMPY)
+
+LIGHTNESS_LAB = 'lab'
+LIGHTNESS_YCRCB = 'ycrcb'
+LIGHTNESS_HSV = 'hsv'
+LIGHTNESS_LUMA = 'luma'
+LIGHTNESS_SPACES = (LIGHTNESS_LAB, LIGHTNESS_YCRCB, LIGHTNESS_HSV, LIGHTNESS_LUMA)
+
+_cv2 = None
+
+
+def opencv_available():
+  return _cv2 is not None or importlib.util.find_spec('cv2') is not None
+
+
+def get_cv2():
+  """Import ``cv2`` on first use"""
+  global _cv2
+  if _cv2 is None:
+    import cv2
+    _cv2 = cv2
+  return _cv2
+
+
+_backend = BACKEND_OPENCV if opencv_available() else BACKEND_NUMPY
+
+
+def get_backend():
+  return _backend
+
+
+def set_backend(name):
+  """Select the ``'opencv'`` or ``'numpy'`` backend; raises ``ImportError`` if OpenCV is selected but missing"""
+  global _backend
+  if name not in BACKENDS:
+    raise ValueError(f"Unknown backend: {name!r}, expected one of {BACKENDS}")
+  if name == BACKEND_OPENCV:
+    get_cv2()
+  _backend = name
+
+
+class ClahePool:
+  """Small LRU pool of ``cv2.CLAHE`` objects keyed by (clip_limit, tile_grid)"""
+
+  def __init__(self, max_size=CLAHE_POOL_SIZE):
+    self.max_size = max_size
+    self._items = OrderedDict()
+
+  def get(self, clip_limit, tile_grid):
+    key = (round(float(clip_limit), 3), tuple(int(t) for t in tile_grid))
+    clahe = self._items.get(key)
+    if clahe is None:
+      clahe = get_cv2().createCLAHE(clipLimit=key[0], tileGridSize=key[1])
+      self._items[key] = clahe
+      if len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+    else:
+      self._items.move_to_end(key)
+    return clahe
+
+  def clear(self):
+    self._items.clear()
+
+  def __len__(self):
+    return len(self._items)
+
+
+clahe_pool = ClahePool()
+
+
+def lightness_space(lab):
+  """Lightness space selected by a ``lab`` argument: None in gray mode, ``'lab'`` for True"""
+  if lab is None or lab is False:
+    return None
+  if lab is True:
+    return LIGHTNESS_LAB
+  if lab not in LIGHTNESS_SPACES:
+    raise ValueError(f"Unknown lightness space: {lab!r}, expected one of {LIGHTNESS_SPACES}")
+  return lab
+
+
+def normalize_tile_grid(tile_grid):
+  """Accept an int or a (cols, rows) pair and return a tuple of positive ints"""
+  if isinstance(tile_grid, (int, float)):
+    tile_grid = (tile_grid, tile_grid)
+  cols, rows = (max(1, int(t)) for t in tile_grid)
+  return cols, rows
+
+
+def reuses_tile_histograms(dtype=np.uint8):
+  """Whether CLAHE of a plane of ``dtype`` gets faster with a cached ``clahe.IncrementalClahe``.
+
+  True on the NumPy backend and for 16-bit planes, which ``clahe`` equalizes.
+  On OpenCV, a fresh ``cv2.CLAHE`` of an 8-bit plane beats interpolating the
+  cached LUTs in NumPy, so the tile histograms are not worth keeping.
+  """
+  return _backend == BACKEND_NUMPY or np.dtype(dtype) != np.uint8
+
+
+def equalize_plane(plane, method=METHOD_CLAHE, clip_limit=DEFAULT_CLIP_LIMIT, tile_grid=DEFAULT_TILE_GRID, clahe_state=None,
+                   bits=None):
+  """Equalize a single uint8 or uint16 plane with global equalization or CLAHE.
+
+  Whatever the lightness space, this is the one plane that gets equalized:
+  gray, LAB L, the HSV value or the luma. uint16 planes keep their bit depth
+  and are equalized in NumPy on either backend onto ``bits`` bits.
+  ``clahe_state`` is an optional ``clahe.IncrementalClahe`` built for this
+  plane and tile grid; when given, CLAHE reuses its tile histograms.
+  """
+  if method == METHOD_EQUALIZE:
+    if _backend == BACKEND_NUMPY or plane.dtype != np.uint8:
+      return numpy_backend.equalize_hist(plane, bits)
+    return get_cv2().equalizeHist(plane)
+  if method == METHOD_CLAHE:
+    if clahe_state is not None:
+      return clahe_state.apply(clip_limit)
+    if _backend == BACKEND_NUMPY or plane.dtype != np.uint8:
+      return numpy_backend.apply_clahe(plane, clip_limit, normalize_tile_grid(tile_grid), bits)
+    return clahe_pool.get(clip_limit, normalize_tile_grid(tile_grid)).apply(plane)
+  raise ValueError(f"Unknown equalization method: {method!r}, expected one of {METHODS}")
+
+
+def to_gray(rgba):
+  if _backend == BACKEND_NUMPY:
+    return numpy_backend.rgba_to_gray(rgba)
+  cv2 = get_cv2()
+  return cv2.cvtColor(rgba, cv2.COLOR_RGBA2GRAY)
+
+
+def to_lab_planes(rgba, bits=None):
+  """Split LAB planes; for uint16 frames of ``bits`` bits an L plane of that depth with float32 a and b planes"""
+  if rgba.dtype != np.uint8:
+    return _to_lab_planes16(rgba, bits)
+  if _backend == BACKEND_NUMPY:
+    return numpy_backend.rgb_to_lab_planes(rgba)
+  cv2 = get_cv2()
+  return tuple(cv2.split(cv2.cvtColor(rgba[:, :, :3], cv2.COLOR_RGB2LAB)))
+
+
+def _opencv_for_lab16():
+  if _backend != BACKEND_OPENCV:
+    raise ValueError("16-bit LAB needs the OpenCV backend, or use the 'ycrcb', 'hsv' or 'luma' lightness")
+  return get_cv2()
+
+
+def _to_lab_planes16(rgba, bits=None):
+  cv2 = _opencv_for_lab16()
+  max_value = lightness.max_value(rgba.dtype, color_bits(rgba, bits))
+  rgb = rgba[:, :, :3].astype(np.float32)
+  rgb *= np.float32(1.0 / max_value)
+  np.minimum(rgb, np.float32(1.0), out=rgb)
+  l_plane, a_plane, b_plane = cv2.split(cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB))
+  l_plane *= np.float32(max_value / 100.0)
+  return np.clip(np.rint(l_plane), 0, max_value).astype(np.uint16), a_plane, b_plane
+
+
+def to_planes(rgba, lab=False, bits=None):
+  """Planes to enhance: the gray plane, or ``(lightness, *rest)`` where ``rest`` is what ``compose`` needs back.
+
+  That is the a and b planes for LAB and the RGBA frame itself for the other
+  lightness spaces, with the gray plane (YCrCb, luma) or HSV value as lightness.
+  A uint16 L plane spans the values of ``bits`` bits.
+  """
+  space = lightness_space(lab)
+  if space is None:
+    return to_gray(rgba)
+  if space == LIGHTNESS_LAB:
+    return to_lab_planes(rgba, bits)
+  if space == LIGHTNESS_HSV:
+    return lightness.value_plane(rgba), rgba
+  return to_gray(rgba), rgba
+
+
+def luminance_plane(planes, lab=False):
+  """The plane of ``to_planes`` that gets equalized"""
+  return planes if lightness_space(lab) is None else planes[0]
+
+
+def compose(eq, planes, alpha, lab=False, out=None, bits=None):
+  """Write the equalized plane ``eq`` as RGBA: gray, or the colors of ``planes`` with their lightness replaced.
+
+  16-bit colors are clipped to ``bits`` bits.
+  """
+  space = lightness_space(lab)
+  if space is None:
+    return write_rgba(eq, alpha, out)
+  if space == LIGHTNESS_LAB and not (_backend == BACKEND_NUMPY and eq.dtype == np.uint8):
+    return write_rgba(lab_to_rgb(eq, planes[1], planes[2], bits), alpha, out)
+  if out is None:
+    out = np.empty(eq.shape + (4,), dtype=eq.dtype)
+  if space == LIGHTNESS_LAB:
+    # Converted strip by strip straight into the first three channels
+    numpy_backend.lab_planes_to_rgb(eq, planes[1], planes[2], out=out)
+  elif space == LIGHTNESS_YCRCB:
+    lightness.shift_rgb(planes[1], planes[0], eq, out, bits)
+  else:
+    lightness.scale_rgb(planes[1], planes[0], eq, out, clip=space == LIGHTNESS_LUMA, bits=bits)
+  np.copyto(out[:, :, 3], alpha)
+  return out
+
+
+def lab_to_rgb(l_plane, a_plane, b_plane, bits=None):
+  """Merge split LAB planes back into an ``(H, W, 3)`` RGB image of the L plane's type, of ``bits`` bits if uint16"""
+  if l_plane.dtype != np.uint8:
+    cv2 = _opencv_for_lab16()
+    max_value = lightness.max_value(l_plane.dtype, clahe.plane_bits(l_plane, bits))
+    l_float = l_plane.astype(np.float32)
+    l_float *= np.float32(100.0 / max_value)
+    rgb = cv2.cvtColor(cv2.merge((l_float, a_plane, b_plane)), cv2.COLOR_LAB2RGB)
+    rgb *= np.float32(max_value)
+    return np.clip(np.rint(rgb), 0, max_value).astype(np.uint16)
+  if _backend == BACKEND_NUMPY:
+    return numpy_backend.lab_planes_to_rgb(l_plane, a_plane, b_plane)
+  cv2 = get_cv2()
+  return cv2.cvtColor(cv2.merge((l_plane, a_plane, b_plane)), cv2.COLOR_LAB2RGB)
+
+
+def write_rgba(rgb_or_gray, alpha, out=None):
+  """Expand a gray or RGB image to RGBA in ``out`` (allocated if None) and copy ``alpha`` into it"""
+  if _backend == BACKEND_NUMPY:
+    if out is None:
+      out = np.empty(rgb_or_gray.shape[:2] + (4,), dtype=rgb_or_gray.dtype)
+    out[:, :, :3] = rgb_or_gray[:, :, None] if rgb_or_gray.ndim == 2 else rgb_or_gray
+  else:
+    cv2 = get_cv2()
+    code = cv2.COLOR_GRAY2RGBA if rgb_or_gray.ndim == 2 else cv2.COLOR_RGB2RGBA
+    if out is None:
+      out = cv2.cvtColor(rgb_or_gray, code)
+    else:
+      cv2.cvtColor(rgb_or_gray, code, dst=out)
+  np.copyto(out[:, :, 3], alpha)
+  return out
+
+
+def enhance_planes(planes, alpha, lab=False, method=METHOD_CLAHE, clip_limit=DEFAULT_CLIP_LIMIT, tile_grid=DEFAULT_TILE_GRID, clahe_state=None, out=None, equalizer=None, bits=None):
+  """Enhance planes as prepared by ``to_planes(rgba, lab, bits)``; uint16 planes without ``bits`` take it from the lightness.
+
+  ``equalizer`` optionally replaces ``equalize_plane``, e.g. a
+  ``temporal.TemporalEqualizer`` carrying LUTs across video frames.
+  """
+  plane = luminance_plane(planes, lab)
+  bits = clahe.plane_bits(plane, bits)
+  eq = equalizer(plane) if equalizer is not None else equalize_plane(plane, method, clip_limit, tile_grid, clahe_state, bits)
+  return compose(eq, planes, alpha, lab, out, bits)
+
+
+def rgba_from_buffer(data, height, width):
+  """Copy flat RGBA bytes, e.g. the ``data`` of a canvas ``ImageData``, into an ``(H, W, 4)`` array"""
+  return np.array(data, dtype=np.uint8).reshape(height, width, 4)
+
+
+def check_rgba(rgba):
+  if rgba.ndim != 3 or rgba.shape[2] != 4:
+    raise ValueError(f"Expected an (H, W, 4) RGBA array, got shape {rgba.shape}")
+  return check_dtype(rgba)
+
+
+def check_dtype(pixels):
+  if pixels.dtype not in (np.uint8, np.uint16):
+    raise ValueError(f"Expected uint8 or uint16 pixels, got {pixels.dtype}")
+  return np.ascontiguousarray(pixels)
+
+
+def color_bits(pixels, bits=None):
+  """Bit depth of a frame or plane: 8 for uint8, else ``bits`` or that of the largest color value (at least 8)"""
+  color = pixels[:, :, :3] if pixels.ndim == 3 and pixels.shape[2] == 4 else pixels
+  return clahe.plane_bits(color, bits)
+
+
+def to_uint8(pixels, bits=None):
+  """Quantize uint16 pixels of ``bits``-bit data (default: the bit depth of the color values) to 8 bits for display.
+
+  uint8 pixels pass through; values beyond ``bits`` bits saturate. The alpha
+  channel of an ``(H, W, 4)`` frame is full 16-bit range and scaled on its own.
+  """
+  if pixels.dtype == np.uint8:
+    return pixels
+  color = pixels[:, :, :3] if pixels.ndim == 3 and pixels.shape[2] == 4 else pixels
+  shift = color_bits(pixels, bits) - 8
+  out = np.empty(pixels.shape, dtype=np.uint8)
+  shifted = np.right_shift(color, shift)
+  np.minimum(shifted, 255, out=shifted)
+  if color is pixels:
+    out[:] = shifted
+  else:
+    out[:, :, :3] = shifted
+    np.right_shift(pixels[:, :, 3], 8, out=out[:, :, 3], casting='unsafe')
+  return out
+
+
+def enhance(rgba, lab=False, method=METHOD_CLAHE, clip_limit=DEFAULT_CLIP_LIMIT, tile_grid=DEFAULT_TILE_GRID, out=None, bits=None):
+  """Return an enhanced copy of an ``(H, W, 4)`` RGBA frame or an ``(H, W)`` plane, uint8 or uint16.
+
+  With ``lab=False`` the frame is converted to grayscale and equalized;
+  with ``lab=True`` only the L channel of the LAB representation is
+  equalized and colors are preserved, and a lightness space name picks
+  another lightness (see ``to_planes``). Alpha is passed through unchanged.
+  A single-channel plane is equalized as it is, whatever ``lab``.
+  The result is written into ``out`` when an RGBA buffer of the same shape
+  is given, e.g. one from ``buffers.rgba_pool``. ``bits`` is the bit depth
+  of uint16 data, by default that of its largest color value.
+  """
+  if rgba.ndim == 2:
+    eq = equalize_plane(check_dtype(rgba), method, clip_limit, tile_grid, bits=bits)
+    if out is None:
+      return eq
+    np.copyto(out, eq)
+    return out
+  rgba = check_rgba(rgba)
+  bits = color_bits(rgba, bits)
+  return enhance_planes(to_planes(rgba, lab, bits), rgba[:, :, 3], lab, method, clip_limit, tile_grid, out=out, bits=bits)
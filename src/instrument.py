@@ -0,0 +1,105 @@
+"""Leveled logging and lightweight timing spans.
+
+Every ``print`` in Pyodide is a round trip to the browser console, so the
+app logs through the ``clahe`` logger, which is off unless a level is set
+(``state.logLevel`` in the app). Messages use ``%``-style arguments so
+nothing is formatted while logging is off.
+
+Timings are recorded as named spans:
+
+    with spans.span('readback'):
+      ...
+
+Each span keeps a rolling window of its last durations, and ``stats()``
+summarizes them (count, last, mean, p95) for display in the app state.
+Recording a span is a ``perf_counter`` call on enter and exit and a deque
+append, so spans stay on in production.
+"""
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+LOGGER_NAME = 'clahe'
+LEVELS = {
+  'debug': logging.DEBUG,
+  'info': logging.INFO,
+  'warning': logging.WARNING,
+  'error': logging.ERROR,
+  'off': logging.CRITICAL + 1,
+}
+DEFAULT_LEVEL = 'off'
+DEFAULT_WINDOW = 100
+
+log = logging.getLogger(LOGGER_NAME)
+log.propagate = False
+
+
+def set_level(level):
+  """Set the log level by name (``'off'``, ``'error'``, ..., ``'debug'``); unknown names turn logging off"""
+  level = LEVELS.get(str(level).lower(), LEVELS[DEFAULT_LEVEL])
+  if level != log.level:
+    log.setLevel(level)
+    if level < LEVELS['off'] and not log.handlers:
+      handler = logging.StreamHandler()
+      handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+      log.addHandler(handler)
+  return level
+
+
+set_level(DEFAULT_LEVEL)
+
+
+class SpanStats:
+  """Rolling window of the durations of one span, in milliseconds"""
+
+  def __init__(self, window=DEFAULT_WINDOW):
+    self.durations = deque(maxlen=window)
+    self.count = 0
+
+  def add(self, ms):
+    self.durations.append(ms)
+    self.count += 1
+
+  def summary(self):
+    ordered = sorted(self.durations)
+    return {
+      'count': self.count,
+      'last_ms': round(self.durations[-1], 2),
+      'mean_ms': round(sum(ordered) / len(ordered), 2),
+      'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+    }
+
+
+class SpanRecorder:
+  """Named timing spans with rolling stats"""
+
+  def __init__(self, window=DEFAULT_WINDOW):
+    self.window = window
+    self._spans = {}
+
+  def record(self, name, ms):
+    stats = self._spans.get(name)
+    if stats is None:
+      stats = self._spans[name] = SpanStats(self.window)
+    stats.add(ms)
+    log.debug("%s: %.2f ms", name, ms)
+
+  @contextmanager
+  def span(self, name):
+    """Time the body of a ``with`` block as span ``name``; also works around ``await``s"""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(name, (time.perf_counter() - start) * 1000.0)
+
+  def stats(self):
+    return {name: stats.summary() for name, stats in self._spans.items()}
+
+  def clear(self):
+    self._spans.clear()
+
+
+spans = SpanRecorder()
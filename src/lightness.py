@@ -0,0 +1,101 @@
+"""Integer lightness transfer for the YCrCb, HSV-V and luma-ratio modes.
+
+In these modes the equalized luminance is put back into the RGB channels
+directly instead of round-tripping through a full color space conversion:
+
+* YCrCb: with Cr and Cb kept, the inverse transform is linear in Y, so every
+  channel moves by the change of Y: ``c + (Y' - Y)``;
+* HSV-V: scaling R, G and B by the same factor keeps hue and saturation, so
+  setting V = max(R, G, B) to V' is ``c * V' / V``;
+* luma ratio: the same scaling by ``Y' / Y`` of the gray (Rec. 601) luma.
+
+Everything stays in integers. The ratios come from a 256 x 256 table of
+``GAIN_SHIFT``-bit fixed-point gains indexed by original and equalized luma;
+black pixels (zero luma) have no ratio and become gray ``Y'``. 16-bit frames
+are too deep for the table and divide per pixel in 64-bit integers instead,
+and get clipped to the largest value of their bit depth (``bits``, e.g. 12
+for 12-bit data) rather than of uint16.
+"""
+import numpy as np
+
+
+GAIN_SHIFT = 16
+
+
+def _gain_table():
+  luma = np.arange(256, dtype=np.int64)[:, None]
+  eq = np.arange(256, dtype=np.int64)[None, :]
+  gain = ((eq << GAIN_SHIFT) + luma // 2) // np.maximum(luma, 1)
+  return gain.astype(np.uint32).reshape(-1)
+
+
+# Indexed by ``luma * 256 + equalized luma``
+GAIN = _gain_table()
+
+
+def value_plane(rgba):
+  """HSV value, ``max(R, G, B)``"""
+  return np.maximum(np.maximum(rgba[:, :, 0], rgba[:, :, 1]), rgba[:, :, 2])
+
+
+def max_value(dtype, bits=None):
+  """Largest sample value of ``bits``-bit data, that of ``dtype`` if not given"""
+  return (1 << int(bits)) - 1 if bits and np.dtype(dtype) != np.uint8 else int(np.iinfo(dtype).max)
+
+
+def shift_rgb(rgba, luma, eq, out, bits=None):
+  """Write ``c + (eq - luma)`` of the RGB channels of ``rgba``, clipped to ``bits`` bits, into ``out[:, :, :3]``"""
+  wide = np.int16 if rgba.dtype == np.uint8 else np.int32
+  delta = np.subtract(eq, luma, dtype=wide)
+  channel = np.empty(luma.shape, dtype=wide)
+  top = max_value(rgba.dtype, bits)
+  for c in range(3):
+    np.add(rgba[:, :, c], delta, out=channel)
+    np.clip(channel, 0, top, out=channel)
+    out[:, :, c] = channel
+  return out
+
+
+def scale_rgb(rgba, luma, eq, out, clip=True, bits=None):
+  """Write ``c * eq / luma`` of the RGB channels of ``rgba`` into ``out[:, :, :3]``.
+
+  ``clip=False`` skips clipping at the largest value of ``bits`` bits when
+  no channel exceeds ``luma``, as with the HSV value.
+  """
+  if rgba.dtype != np.uint8:
+    return _scale_rgb_wide(rgba, luma, eq, out, clip, bits)
+  index = luma.astype(np.uint16)
+  index <<= 8
+  index += eq
+  gain = GAIN.take(index)
+  channel = np.empty(luma.shape, dtype=np.uint32)
+  for c in range(3):
+    np.multiply(rgba[:, :, c], gain, out=channel)
+    channel += np.uint32(1 << (GAIN_SHIFT - 1))
+    channel >>= GAIN_SHIFT
+    if clip:
+      np.minimum(channel, 255, out=channel)
+    out[:, :, c] = channel
+  black = luma == 0
+  if black.any():
+    for c in range(3):
+      np.copyto(out[:, :, c], eq, where=black)
+  return out
+
+
+def _scale_rgb_wide(rgba, luma, eq, out, clip=True, bits=None):
+  divisor = np.maximum(luma, 1).astype(np.uint64)
+  half = divisor >> 1
+  channel = np.empty(luma.shape, dtype=np.uint64)
+  for c in range(3):
+    np.multiply(rgba[:, :, c], eq, out=channel, dtype=np.uint64)
+    channel += half
+    channel //= divisor
+    if clip:
+      np.minimum(channel, max_value(rgba.dtype, bits), out=channel)
+    out[:, :, c] = channel
+  black = luma == 0
+  if black.any():
+    for c in range(3):
+      np.copyto(out[:, :, c], eq, where=black)
+  return out
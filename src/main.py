@@ -1,125 +1,507 @@
-from js import ImageData, Object, slyApp, JSON
-from pyodide.ffi import create_proxy
-import numpy as np
-import cv2
+import asyncio
+import logging
+import time
+
+from js import ImageData, Object, JSON
+from pyodide.ffi import create_proxy, to_js
+
+import engine
+from pixel_cache import pixel_cache
+from buffers import rgba_pool
+from scheduler import RenderScheduler
+from video_frames import FrameLoader, FramePrefetcher, StrategyMemo
+from canvas_locator import CanvasPathCache
+from temporal import TemporalEqualizer
+import preview
+import instrument
+from instrument import log, spans
+import roi
+from roi import canvas_writes
+import background
+import result_store
+import compare_grid
 
 
 def dump(obj):
+  if not log.isEnabledFor(logging.DEBUG):
+    return
   for attr in dir(obj):
-    print("obj.%s = %r" % (attr, getattr(obj, attr)))
+    log.debug("obj.%s = %r", attr, getattr(obj, attr))
 
 def debug_js_object(obj, name="object"):
-  """Debug JavaScript objects with comprehensive info"""
-  print(f"\n=== DEBUG {name} ===")
+  """Debug JavaScript objects with comprehensive info, logged at debug level"""
+  if not log.isEnabledFor(logging.DEBUG):
+    return
+  log.debug("=== DEBUG %s ===", name)
   
   # Try to get type and basic info
   try:
-    print(f"Type: {type(obj)}")
-    print(f"Dir: {dir(obj)}")
+    log.debug("Type: %s", type(obj))
+    log.debug("Dir: %s", dir(obj))
   except Exception as e:
-    print(f"Error getting type/dir: {e}")
+    log.debug("Error getting type/dir: %s", e)
   
   # Try Object.keys() for JS objects
   try:
     keys = Object.keys(obj)
-    print(f"Object.keys(): {list(keys)}")
+    log.debug("Object.keys(): %s", list(keys))
     
     # Try to access each key
     for key in keys:
       try:
         value = getattr(obj, key)
-        print(f"  {key}: {type(value)} = {value}")
+        log.debug("  %s: %s = %s", key, type(value), value)
       except Exception as e:
-        print(f"  {key}: Error accessing - {e}")
+        log.debug("  %s: Error accessing - %s", key, e)
   except Exception as e:
-    print(f"Object.keys() failed: {e}")
+    log.debug("Object.keys() failed: %s", e)
   
   # Try JSON.stringify for complex objects
   try:
-    json_str = JSON.stringify(obj)
-    print(f"JSON.stringify(): {json_str}")
+    log.debug("JSON.stringify(): %s", JSON.stringify(obj))
   except Exception as e:
-    print(f"JSON.stringify() failed: {e}")
+    log.debug("JSON.stringify() failed: %s", e)
   
   # Try vars() for Python objects
   try:
-    print(f"vars(): {vars(obj)}")
+    log.debug("vars(): %s", vars(obj))
   except Exception as e:
-    print(f"vars() failed: {e}")
+    log.debug("vars() failed: %s", e)
   
-  print(f"=== END DEBUG {name} ===\n")
+  log.debug("=== END DEBUG %s ===", name)
+
+def get_lightness_space(state):
+  """Lightness space to equalize in, or False in gray mode"""
+  if state.labCheck is not True:
+    return False
+  space = getattr(state, 'lightnessSpace', None) or engine.LIGHTNESS_LAB
+  return space if space in engine.LIGHTNESS_SPACES else engine.LIGHTNESS_LAB
+
+def get_enhance_params(state):
+  """Read enhancement parameters from the app state"""
+  clahe_check = getattr(state, 'claheCheck', True)
+  clip_limit = engine.DEFAULT_CLIP_LIMIT
+  try:
+    clip_limit = float(state.SliderAutoId6MqE3.value)
+  except Exception:
+    pass
+  return {
+    'lab': get_lightness_space(state),
+    'method': engine.METHOD_CLAHE if clahe_check is not False else engine.METHOD_EQUALIZE,
+    'clip_limit': clip_limit,
+    'tile_grid': engine.normalize_tile_grid(getattr(state, 'tileGridSize', 8) or 8),
+  }
+
+canvas_paths = CanvasPathCache()
+# Results pre-enhanced while idle; the job pauses while the scheduler is rendering
+enhanced_results = background.EnhancedCache()
+background_enhancer = background.BackgroundEnhancer(pixel_cache, enhanced_results, is_busy=lambda: scheduler.running)
+frame_memo = StrategyMemo()
+# (video key, FramePrefetcher) of the video currently open
+_video_prefetcher = None
+
+async def load_image_element(url):
+  """Load and decode an image URL, returning the <img> element or None on failure"""
+  from js import document
+
+  img = document.createElement('img')
+  img.crossOrigin = 'anonymous'  # Allow cross-origin for processing
+  img.src = url
+  try:
+    await img.decode()
+  except Exception:
+    return None
+  return img
+
+def prefetcher_key(cur_img, context):
+  return (getattr(cur_img, 'datasetId', None), context.imageId)
+
+def get_frame_prefetcher(cur_img, context, video_width, video_height):
+  """Return the frame prefetcher of the current video, replacing the one of the previous video"""
+  global _video_prefetcher
+  key = prefetcher_key(cur_img, context)
+  if _video_prefetcher is None or _video_prefetcher[0] != key:
+    if _video_prefetcher is not None:
+      _video_prefetcher[1].clear()
+    loader = FrameLoader(frame_memo, key, cur_img.preview, video_width, video_height, load_image_element)
+    _video_prefetcher = (key, FramePrefetcher(loader))
+  return _video_prefetcher[1]
+
+# (video id, lab, method, clip limit, tile grid) and the TemporalEqualizer of the video currently open
+_temporal_equalizer = None
+
+def get_temporal_equalizer(video_id, lab, params):
+  """Return the temporal equalizer of the video, starting over when the video or parameters change"""
+  global _temporal_equalizer
+  key = (video_id, lab, params['method'], params['clip_limit'], params['tile_grid'])
+  if _temporal_equalizer is None or _temporal_equalizer[0] != key:
+    _temporal_equalizer = (key, TemporalEqualizer(params['method'], params['clip_limit'], params['tile_grid']))
+  return _temporal_equalizer[1]
+
+def get_source_version(img_src, context):
+  """Version of the pixels currently on the canvas: source version for images, frame for videos"""
+  if img_src is not None:
+    try:
+      return int(img_src.version)
+    except Exception:
+      return 0
+  return f"frame-{context.frame}"
+
+def put_pixels(ctx, flat_pixels, width, height, x=0, y=0):
+  """Write a flat uint8 RGBA array into a 2D canvas context at (x, y) without copying it in Python"""
+  pixels_proxy = create_proxy(flat_pixels)
+  pixels_buf = pixels_proxy.getBuffer("u8clamped")
+  try:
+    ctx.putImageData(ImageData.new(pixels_buf.data, width, height), x, y)
+  finally:
+    pixels_proxy.destroy()
+    pixels_buf.release()
+
+def show_processed_preview(rgba, status_text, status_color='#28a745'):
+  """Show a display-size RGBA frame in the processed-frame panel of the app"""
+  try:
+    from js import document
+
+    display_img = document.getElementById('processed-frame-display')
+    status_div = document.getElementById('processed-frame-status')
+    if not (display_img and status_div):
+      log.warning("Could not find display elements in app interface")
+      return
 
-def process_histogram_equalization_with_canvas(img_cvs, img_ctx, app, cur_img, mode='process'):
-  """Apply histogram equalization processing to the given canvas"""
+    with spans.span('preview-encode'):
+      height, width = rgba.shape[:2]
+      preview_canvas = document.createElement('canvas')
+      preview_canvas.width = width
+      preview_canvas.height = height
+      put_pixels(preview_canvas.getContext('2d'), rgba.reshape(-1), width, height)
+      display_img.src = preview_canvas.toDataURL('image/png')
+
+    display_img.style.display = 'block'  # Make it visible
+    status_div.textContent = status_text
+    status_div.style.color = status_color
+  except Exception as e:
+    log.error("Error updating app display: %s", e)
+
+def neighbour_items(store, context, count=background.NEIGHBOURS):
+  """``(source_key, (height, width), read_rows)`` of the loaded images next to the current one, nearest first"""
+  items_obj = store.state.videos.all
+  ids = list(Object.keys(items_obj))
   try:
-    print(f"\n🎨 Starting Histogram Equalization processing on {img_cvs.width}x{img_cvs.height} canvas...")
+    index = ids.index(str(context.imageId))
+  except ValueError:
+    return []
+  items = []
+  for offset in (d * sign for d in range(1, count + 1) for sign in (1, -1)):
+    if not 0 <= index + offset < len(ids):
+      continue
+    item_id = ids[index + offset]
+    item = getattr(items_obj, item_id, None)
+    img_src = item.sources[0] if item is not None and hasattr(item, 'sources') and item.sources else None
+    img_cvs = getattr(img_src, 'imageData', None) if img_src is not None else None
+    if img_cvs is None or not getattr(img_cvs, 'width', 0):
+      continue
+    image_id = int(item_id) if item_id.isdigit() else item_id
+    version = get_source_version(img_src, context)
+    key = pixel_cache.source_key(image_id, version)
+    if pixel_cache.is_own_output(image_id, version) and key not in pixel_cache:
+      # The canvas shows our output and the original is gone
+      continue
+
+    def read_rows(r0, r1, img_cvs=img_cvs):
+      # One band of the canvas per call, so the background job can yield in between
+      data = img_cvs.getContext("2d").getImageData(0, r0, img_cvs.width, r1 - r0).data
+      return engine.rgba_from_buffer(data, r1 - r0, img_cvs.width)
+    items.append((key, (img_cvs.height, img_cvs.width), read_rows))
+  return items
+
+# Results persisted across sessions in IndexedDB; None until first used, False if unavailable
+_persistent_results = None
+
+def get_persistent_results():
+  global _persistent_results
+  if _persistent_results is None:
+    try:
+      _persistent_results = result_store.ResultStore(result_store.IndexedDBBackend())
+    except Exception as e:
+      log.warning("Persistent result cache unavailable: %s", e)
+      _persistent_results = False
+  return _persistent_results or None
+
+# image key -> (store, store key, result copy, lab) of the result waiting to be persisted, at most one per image
+_pending_saves = {}
+
+def save_result_when_idle(store, image_key, store_key, rgba, lab):
+  """Persist a copy of a result once no render is running, replacing a save of the same image still waiting"""
+  pending = _pending_saves.get(image_key)
+  if pending is not None and pending[2].shape == rgba.shape and pending[2].dtype == rgba.dtype:
+    # Superseded before it got saved: its copy is overwritten rather than a new one allocated
+    pending[2][...] = rgba
+    copy = pending[2]
+  else:
+    copy = rgba.copy()
+  _pending_saves[image_key] = (store, store_key, copy, lab)
+  if pending is None:
+    asyncio.ensure_future(_save_pending(image_key))
+
+async def _save_pending(image_key):
+  await asyncio.sleep(background.IDLE_DELAY)
+  while scheduler.running:
+    await asyncio.sleep(background.IDLE_DELAY)
+  store, store_key, rgba, lab = _pending_saves.pop(image_key)
+  try:
+    with spans.span('store-save'):
+      await store.save(store_key, rgba, lab)
+  except Exception as e:
+    log.warning("Could not persist result: %s", e)
+
+def publish_stats(state):
+  """Expose rolling timings and cache/scheduler counters in the app state"""
+  try:
+    state.perfStats = to_js({
+      'spans': spans.stats(),
+      'scheduler': scheduler.stats(),
+      'pixelCache': pixel_cache.stats(),
+      'background': background_enhancer.stats(),
+      'persistent': _persistent_results.stats() if _persistent_results else None,
+      'pendingSaves': len(_pending_saves),
+    }, dict_converter=Object.fromEntries)
+  except Exception as e:
+    log.error("Error publishing stats: %s", e)
+
+def apply_engine_backend(state):
+  """Switch the engine to the backend selected in the app state (index.html loads OpenCV on demand)"""
+  backend = getattr(state, 'engineBackend', None) or engine.BACKEND_NUMPY
+  if backend == engine.get_backend():
+    return
+  try:
+    engine.set_backend(backend)
+  except (ImportError, ValueError) as e:
+    log.warning("Engine backend %s unavailable, staying on %s: %s", backend, engine.get_backend(), e)
+    return
+  # Planes converted by the other backend may differ by a level or two
+  pixel_cache.drop_planes()
+
+# Where the selected label may live in the labeling tool store, tried in order
+FIGURE_STORE_PATHS = (('figures', 'all'), ('videos', 'figures'), ('figures',))
+
+def selected_label_geometry(store, context):
+  """Geometry JSON of the label selected in the labeling tool, or None"""
+  figure_id = getattr(context, 'figureId', None)
+  if figure_id is None:
+    return None
+  for path in FIGURE_STORE_PATHS:
+    container = store.state
+    for attr in path:
+      container = getattr(container, attr, None)
+      if container is None:
+        break
+    figure = getattr(container, str(figure_id), None) if container is not None else None
+    geometry = getattr(figure, 'geometry', None) if figure is not None else None
+    if geometry is not None:
+      return geometry.to_py() if hasattr(geometry, 'to_py') else geometry
+  return None
+
+def get_roi_bbox(state, store, context, width, height):
+  """ROI of the current render, clipped to the canvas: the selected label's bbox or the box in the state"""
+  margin = int(getattr(state, 'roiMargin', roi.DEFAULT_MARGIN) or 0)
+  bbox = None
+  if getattr(state, 'roiSource', 'label') == 'label':
+    bbox = roi.bbox_from_geometry(selected_label_geometry(store, context))
+    if bbox is None:
+      log.warning("No selected label with a bounding box, using the ROI box")
+  if bbox is None:
+    box = getattr(state, 'roiBox', None)
+    if box is None:
+      return None
+    bbox = (box.left, box.top, box.right, box.bottom)
+    margin = 0
+  return roi.clip_bbox(bbox, width, height, margin)
+
+def undo_roi(img_ctx, cache_key):
+  """Put back the original pixels under the last ROI written to this canvas; returns the last write"""
+  last_write = canvas_writes.pop(cache_key)
+
+  def put_region(original, x, y):
+    with spans.span('roi-undo'):
+      put_pixels(img_ctx, original.reshape(-1), original.shape[1], original.shape[0], x, y)
+  roi.restore(last_write, put_region)
+  return last_write
+
+def get_compare_params(state):
+  """Clip limits (columns) and tile grids (rows) of the comparison grid from the app state"""
+  clip_limits = compare_grid.parse_values(getattr(state, 'compareClipLimits', ''), float, compare_grid.DEFAULT_CLIP_LIMITS)
+  tile_grids = compare_grid.parse_values(getattr(state, 'compareTileGrids', ''), int,
+                                         (get_enhance_params(state)['tile_grid'][0],))
+  return clip_limits[:max(compare_grid.MAX_CELLS // len(tile_grids), 1)], tile_grids[:compare_grid.MAX_CELLS]
+
+def show_comparison(entry, state):
+  """Render the clip-limit / tile-grid comparison grid of a pixel cache entry into the processed-frame panel"""
+  lab = get_lightness_space(state)
+  clip_limits, tile_grids = get_compare_params(state)
+  with spans.span('convert'):
+    planes = pixel_cache.planes(entry, lab)
+  with spans.span('compare'):
+    grid, cells = compare_grid.compare_grid(
+      planes, entry.rgba[:, :, 3], lab, clip_limits, tile_grids,
+      clahe_state=lambda tile_grid: pixel_cache.clahe_state(entry, lab, tile_grid))
+  show_processed_preview(grid, f"🔍 {compare_grid.describe(cells)}", '#333')
+
+async def checkpoint(token, stage):
+  """Give up the render here if the scheduler has a newer request"""
+  if token is not None:
+    await token.checkpoint(stage)
+
+def bump_source_version(img_src, context, cache_key):
+  """For images, increment the source version to trigger a refresh and remember it as our own output"""
+  try:
+    if img_src:
+      img_src.version += 1
+      pixel_cache.mark_written(context.imageId, cache_key[1], img_src.version)
+  except:
+    log.debug("No image version to increment (video processing)")
+
+async def process_roi(img_cvs, img_ctx, state, cache_key, bbox, last_write, token=None):
+  """Enhance and write back only the ``bbox`` region of the canvas; returns the enhanced region"""
+  x0, y0, x1, y1 = bbox
+  width, height = x1 - x0, y1 - y0
+
+  await checkpoint(token, 'readback')
+  with spans.span('readback'):
+    entry = pixel_cache.get(cache_key)
+    if entry is not None and last_write is not None and last_write[0] is None:
+      # The whole canvas still shows the previous full result; go back to the original once
+      put_pixels(img_ctx, entry.rgba.reshape(-1), img_cvs.width, img_cvs.height)
+    if entry is not None:
+      original = roi.region(entry.rgba, bbox).copy()
+    else:
+      # Only the dirty rectangle is read from the canvas
+      original = engine.rgba_from_buffer(img_ctx.getImageData(x0, y0, width, height).data, height, width)
+
+  await checkpoint(token, 'equalize')
+  with spans.span('equalize'):
+    params = get_enhance_params(state)
+    enhanced = roi.enhance_region(original, params.pop('lab'), **params)
+
+  await checkpoint(token, 'write-back')
+  with spans.span('write-back'):
+    put_pixels(img_ctx, enhanced.reshape(-1), width, height, x0, y0)
+  canvas_writes.record_roi(cache_key, bbox, original)
+  log.info("ROI %s enhanced (%dx%d of %dx%d)", bbox, width, height, img_cvs.width, img_cvs.height)
+  return enhanced
+
+async def process_histogram_equalization_with_canvas(img_cvs, img_ctx, app, cur_img, mode='process', token=None, roi_bbox=None):
+  """Apply histogram equalization processing to the given canvas, or only to ``roi_bbox`` of it.
+
+  Returns the RGBA array written to the canvas, or None if processing failed.
+  In ``'compare'`` mode the canvas is left alone and the comparison grid is
+  shown in the processed-frame panel instead; None is returned.
+  """
+  try:
+    log.info("Histogram Equalization (%s) on %dx%d canvas", mode, img_cvs.width, img_cvs.height)
     
     context = app.context
     state = app.state
     
-    if state.imagePixelsDataImageId != context.imageId:
+    img_src = cur_img.sources[0] if hasattr(cur_img, 'sources') and cur_img.sources else None
+    source_version = get_source_version(img_src, context)
+    cache_key = pixel_cache.source_key(context.imageId, source_version)
+
+    # Original pixels go back under a previous ROI first, so neither the readback nor this render sees them
+    last_write = undo_roi(img_ctx, cache_key)
+    if mode != 'restore' and roi_bbox is not None:
+      result = await process_roi(img_cvs, img_ctx, state, cache_key, roi_bbox, last_write, token)
+      bump_source_version(img_src, context, cache_key)
+      return result
+
+    def read_canvas_pixels():
       img_data = img_ctx.getImageData(0, 0, img_cvs.width, img_cvs.height).data
+      return engine.rgba_from_buffer(img_data, img_cvs.height, img_cvs.width)
 
-      # reshape flat array of rgba to numpy
-      state.imagePixelsData = np.array(img_data, dtype=np.uint8).reshape(img_cvs.height, img_cvs.width, 4)
-      state.imagePixelsDataImageId = context.imageId
+    await checkpoint(token, 'readback')
+    with spans.span('readback'):
+      entry = pixel_cache.get_or_load(cache_key, read_canvas_pixels)
+
+    if mode == 'compare':
+      if last_write is not None and last_write[0] is None:
+        # The canvas keeps showing the full result
+        canvas_writes.record_full(cache_key)
+      await checkpoint(token, 'compare')
+      show_comparison(entry, state)
+      return None
 
     new_img_data = None
-    img_arr = state.imagePixelsData
+    img_arr = entry.rgba
 
     if mode == 'restore':
-      new_img_data = img_arr.flatten()
+      # flat view of the cached original, no copy
+      new_img_data = img_arr.reshape(-1)
     else:
-      if state.labCheck is False:
-        # Apply histogram equalization to grayscale
-        img_gray = cv2.cvtColor(img_arr, cv2.COLOR_RGBA2GRAY)
-        eq_img_gray = cv2.equalizeHist(img_gray)
-        eq_img_rgb = cv2.cvtColor(eq_img_gray, cv2.COLOR_GRAY2RGB)
-      else:
-        # Apply histogram equalization to L channel in LAB color space
-        img_lab = cv2.cvtColor(img_arr, cv2.COLOR_RGB2LAB)
-
-        lab_planes = list(cv2.split(img_lab))
-        lab_planes[0] = cv2.equalizeHist(lab_planes[0])  # Equalize L channel only
-        img_lab = cv2.merge(lab_planes)
-
-        eq_img_rgb = cv2.cvtColor(img_lab, cv2.COLOR_LAB2RGB)
-        
-      alpha_channel = img_arr[:, :, 3]
-      eq_img = np.dstack((eq_img_rgb, alpha_channel))
+      params = get_enhance_params(state)
+      params['out'] = rgba_pool.get(img_arr.shape[0], img_arr.shape[1])
+      alpha = img_arr[:, :, 3]
+      lab = params.pop('lab')
 
-      new_img_data = eq_img.flatten().astype(np.uint8)
+      # Pre-enhanced in the background while the app was idle: only the write-back is left
+      pkey = background_enhancer.invalidate(lab, params)
+      ready = enhanced_results.get(cache_key, pkey) if img_src is not None else None
+      store = get_persistent_results() if img_src is not None and getattr(state, 'persistentCache', True) is not False else None
+      store_key = None
+      if ready is None and store is not None:
+        store_key = result_store.result_key(context.imageId, cache_key[1], lab, params['method'], params['clip_limit'], params['tile_grid'])
+        try:
+          with spans.span('store-load'):
+            ready = await store.load(store_key, out=params['out'])
+        except Exception as e:
+          log.warning("Could not load persisted result: %s", e)
+      if ready is not None:
+        log.debug("Using the pre-enhanced result of %s", cache_key)
+        img_arr = ready
+        new_img_data = ready.reshape(-1)
+      elif getattr(state, 'progressivePreview', True) is not False and preview.preview_step(*img_arr.shape[:2]) > 1:
+        # Instant display-size result first; the full-resolution pass below only runs if still the latest request
+        with spans.span('quick-preview'):
+          quick = preview.quick_preview(img_arr, lab, params['method'], params['clip_limit'], params['tile_grid'])
+        show_processed_preview(quick, f"⏳ Preview, refining {img_arr.shape[1]}x{img_arr.shape[0]}...", '#666')
 
-    pixels_proxy = create_proxy(new_img_data)
-    pixels_buf = pixels_proxy.getBuffer("u8clamped")
-    new_img_data = ImageData.new(pixels_buf.data, img_cvs.width, img_cvs.height)
+      if ready is None:
+        await checkpoint(token, 'convert')
+        with spans.span('convert'):
+          planes = pixel_cache.planes(entry, lab)
+          if (img_src is None and getattr(state, 'temporalVideo', True) is not False
+              and engine.reuses_tile_histograms(entry.rgba.dtype)):
+            # Video frames carry their LUTs over from the previous frames. On OpenCV a fresh
+            # cv2.CLAHE / equalizeHist per frame is faster than the NumPy LUT interpolation
+            params['equalizer'] = get_temporal_equalizer(context.imageId, lab, params)
+          elif params['method'] == engine.METHOD_CLAHE and engine.reuses_tile_histograms(entry.rgba.dtype):
+            params['clahe_state'] = pixel_cache.clahe_state(entry, lab, params['tile_grid'])
 
-    img_ctx.putImageData(new_img_data, 0, 0)
-    
-    # For images, increment version to trigger refresh
-    try:
-      img_src = cur_img.sources[0] if hasattr(cur_img, 'sources') and cur_img.sources else None
-      if img_src:
-        img_src.version += 1
-        print("  ✅ Image version incremented for refresh")
-    except:
-      print("  ℹ️ No image version to increment (video processing)")
+        await checkpoint(token, 'equalize')
+        with spans.span('equalize'):
+          eq_img = engine.enhance_planes(planes, alpha, lab, **params)
+        if store_key is not None:
+          # The pooled output buffer gets reused by the next render, persist a copy
+          save_result_when_idle(store, context.imageId, store_key, eq_img, lab)
+        img_arr = eq_img
+        # flat view of the pooled output buffer, no copy
+        new_img_data = eq_img.reshape(-1)
 
-    pixels_proxy.destroy()
-    pixels_buf.release()
+    log.debug("Pixel cache: %s", pixel_cache.stats())
+
+    await checkpoint(token, 'write-back')
+    with spans.span('write-back'):
+      put_pixels(img_ctx, new_img_data, img_cvs.width, img_cvs.height)
+    if mode != 'restore':
+      canvas_writes.record_full(cache_key)
     
-    print("  ✅ Histogram Equalization processing completed successfully!")
+    bump_source_version(img_src, context, cache_key)
+    return img_arr
     
   except Exception as e:
-    print(f"  ❌ Error in Histogram Equalization processing: {e}")
-
-def main(mode='process'):
-  app = slyApp.app
-  store = slyApp.store
-  app = getattr(app, '$children')[0]
+    log.error("Error in Histogram Equalization processing: %s", e)
+    return None
 
+async def render_media(app, store, mode='process', token=None):
   context = app.context
-  state = app.state
 
   # store action example
   # appEventEmitter = app.appEventEmitter
@@ -130,426 +512,129 @@ def main(mode='process'):
 
   cur_img = getattr(store.state.videos.all, str(context.imageId))
   
-  print(f"Processing media ID: {context.imageId}")
-  print(f"Current frame: {context.frame}")
-  
   # Check if this is a video or image and handle accordingly
   has_sources = hasattr(cur_img, 'sources') and cur_img.sources and len(cur_img.sources) > 0
   is_video = hasattr(cur_img, 'frames') and hasattr(cur_img, 'fileMeta') and getattr(cur_img.fileMeta, 'framesCount', None) is not None
-  
-  print(f"\nMedia type detection:")
-  print(f"  has_sources: {has_sources}")
-  print(f"  is_video: {is_video}")
-  print(f"  current frame: {context.frame}")
+  log.info("Media %s, frame %s: has_sources=%s, is_video=%s", context.imageId, context.frame, bool(has_sources), is_video)
+
+  def roi_for(canvas):
+    if mode != 'process' or getattr(app.state, 'roiEnabled', False) is not True:
+      return None
+    bbox = get_roi_bbox(app.state, store, context, canvas.width, canvas.height)
+    if bbox is None:
+      log.warning("ROI mode is on but there is no ROI, enhancing the whole image")
+    return bbox
   
   if has_sources:
     # Handle images - use existing logic
-    print("Processing as IMAGE")
     img_src = cur_img.sources[0]
     img_cvs = img_src.imageData
     img_ctx = img_cvs.getContext("2d")
-    print(f"Image canvas: {img_cvs.width}x{img_cvs.height}")
     
     # Process histogram equalization immediately for images
-    process_histogram_equalization_with_canvas(img_cvs, img_ctx, app, cur_img, mode)
+    result = await process_histogram_equalization_with_canvas(img_cvs, img_ctx, app, cur_img, mode, token, roi_for(img_cvs))
     
-    # Also display processed image in our app interface
-    try:
-      print("  🖼️ Displaying processed image in app interface...")
-      from js import document
-      
-      # Convert canvas to data URL
-      processed_data_url = img_cvs.toDataURL('image/png')
-      
-      # Update our display elements
-      display_img = document.getElementById('processed-frame-display')
-      status_div = document.getElementById('processed-frame-status')
-      
-      if display_img and status_div:
-        # Show the processed image
-        display_img.src = processed_data_url
-        display_img.style.display = 'block'  # Make it visible
-        
-        # Update status
-        status_div.textContent = f"✅ Processed image ({img_cvs.width}x{img_cvs.height})"
-        status_div.style.color = '#28a745'  # Green color for success
-        
-        print(f"    ✅ Updated app display with processed image!")
-      else:
-        print(f"    ❌ Could not find display elements in app interface")
-        
-    except Exception as e:
-      print(f"  ❌ Error updating app display: {e}")
+    # Also display processed image in our app interface, at display size
+    if result is not None:
+      show_processed_preview(preview.display_copy(result), f"✅ Processed image ({img_cvs.width}x{img_cvs.height})")
     
+    # Next and previous images get enhanced with the same parameters while the app is idle
+    if mode == 'process' and roi_for(img_cvs) is None and getattr(app.state, 'backgroundEnhance', True) is not False:
+      params = get_enhance_params(app.state)
+      background_enhancer.schedule(neighbour_items(store, context), params.pop('lab'), params)
+    else:
+      background_enhancer.cancel()
     return
   
   elif is_video:
-    # Handle videos - look for direct canvas access like images
-    print("Processing as VIDEO")
-    print("Looking for video canvas equivalent to img.sources...")
-    
-    # Search store.state.videos for video player components (not individual videos)
-    print("\nSearching store.state.videos for player components:")
-    
-    def search_for_canvas_in_object(obj, obj_name, max_depth=3, current_depth=0):
-      """Recursively search for canvas objects"""
-      if current_depth >= max_depth:
-        return None
-        
-      try:
-        # Check if this object is itself a canvas
-        if hasattr(obj, 'getContext'):
-          print(f"  🎯 FOUND CANVAS in {obj_name}!")
-          return obj
-          
-        # Check if this object has canvas properties
-        if hasattr(obj, 'canvas'):
-          canvas = getattr(obj, 'canvas')
-          if hasattr(canvas, 'getContext'):
-            print(f"  🎯 FOUND CANVAS in {obj_name}.canvas!")
-            return canvas
-            
-        if hasattr(obj, 'imageData'):
-          img_data = getattr(obj, 'imageData')
-          if hasattr(img_data, 'getContext'):
-            print(f"  🎯 FOUND CANVAS in {obj_name}.imageData!")
-            return img_data
-        
-        # If this is a JS object, search its properties
-        if str(type(obj)) == "<class 'pyodide.ffi.JsProxy'>":
-          try:
-            keys = Object.keys(obj)
-            for key in keys:
-              try:
-                value = getattr(obj, key)
-                # Recursively search if it's another object
-                if str(type(value)) == "<class 'pyodide.ffi.JsProxy'>":
-                  result = search_for_canvas_in_object(value, f"{obj_name}.{key}", max_depth, current_depth + 1)
-                  if result:
-                    return result
-              except Exception as e:
-                pass  # Skip properties we can't access
-          except Exception as e:
-            pass
-            
-      except Exception as e:
-        pass
-        
-      return None
-    
-    # Search through store.state.videos (excluding 'all' since that's the dataset)
-    video_canvas = None
-    videos_obj = store.state.videos
-    videos_keys = [key for key in Object.keys(videos_obj) if key != 'all']  # Skip the dataset
-    print(f"  Searching videos keys (excluding 'all'): {videos_keys}")
-    
-    for key in videos_keys:
-      try:
-        obj = getattr(videos_obj, key)
-        print(f"  Searching videos.{key}: {type(obj)}")
-        
-        result = search_for_canvas_in_object(obj, f"videos.{key}")
-        if result:
-          video_canvas = result
-          break
-          
-      except Exception as e:
-        print(f"  Error searching videos.{key}: {e}")
-    
-    # If not found in videos, search broader store.state
-    if not video_canvas:
-      print(f"\n  Searching broader store.state for player components:")
-      store_keys = Object.keys(store.state)
-      player_keys = [key for key in store_keys if any(term in key.lower() for term in 
-                     ['player', 'canvas', 'render', 'display', 'current', 'active', 'ui'])]
-      print(f"  Potential player-related store keys: {player_keys}")
-      
-      for key in player_keys:
-        try:
-          obj = getattr(store.state, key)
-          print(f"  Searching store.{key}: {type(obj)}")
-          
-          result = search_for_canvas_in_object(obj, f"store.{key}")
-          if result:
-            video_canvas = result
-            break
-            
-        except Exception as e:
-          print(f"  Error searching store.{key}: {e}")
-    
-    # Test frame-level sources approach (like images but per frame)
-    if not video_canvas:
-      print(f"\n  Testing frame-level sources approach:")
-      try:
-        current_frame = context.frame
-        print(f"  Trying cur_img[{current_frame}].sources...")
-        
-        # Try accessing the specific frame
-        frame_obj = None
-        try:
-          # Try numeric indexing
-          frame_obj = cur_img[current_frame]
-          print(f"    cur_img[{current_frame}]: {type(frame_obj)}")
-        except:
-          try:
-            # Try string indexing
-            frame_obj = cur_img[str(current_frame)]
-            print(f"    cur_img['{current_frame}']: {type(frame_obj)}")
-          except:
-            try:
-              # Try accessing from frames property
-              frame_obj = getattr(cur_img.frames, str(current_frame))
-              print(f"    cur_img.frames['{current_frame}']: {type(frame_obj)}")
-            except:
-              print(f"    ❌ Could not access frame {current_frame}")
-        
-        if frame_obj:
-          print(f"    ✅ Found frame object: {type(frame_obj)}")
-          
-          # Check if frame has sources like images do
-          if hasattr(frame_obj, 'sources'):
-            sources = getattr(frame_obj, 'sources')
-            print(f"    ✅ Frame has sources: {type(sources)}, length: {len(sources) if hasattr(sources, '__len__') else 'unknown'}")
-            
-            if sources and len(sources) > 0:
-              frame_src = sources[0]
-              print(f"    ✅ Frame source[0]: {type(frame_src)}")
-              
-              if hasattr(frame_src, 'imageData'):
-                video_canvas = frame_src.imageData
-                print(f"    🎯 FOUND FRAME CANVAS! {type(video_canvas)}")
-              else:
-                print(f"    ❌ Frame source has no imageData")
-            else:
-              print(f"    ❌ Frame sources is empty")
-          else:
-            print(f"    ❌ Frame has no sources property")
-            # Debug what the frame object does have
-            try:
-              frame_keys = Object.keys(frame_obj) if str(type(frame_obj)) == "<class 'pyodide.ffi.JsProxy'>" else dir(frame_obj)
-              print(f"    Frame properties: {frame_keys}")
-            except:
-              print(f"    Could not get frame properties")
-        
-      except Exception as e:
-        print(f"  Error testing frame-level approach: {e}")
-    
-    # Search for canvas-like properties in the individual video object (final fallback)
-    if not video_canvas:
-      print(f"\n  Final fallback: Searching cur_img for canvas properties:")
-      all_props = dir(cur_img)
-      canvas_props = [prop for prop in all_props if any(term in prop.lower() for term in 
-                     ['canvas', 'image', 'source', 'data', 'element', 'frame', 'render', 'display'])]
-      print(f"  Potential canvas properties: {canvas_props}")
-      
-      # Try individual video object properties
-      for prop in canvas_props:
-        try:
-          value = getattr(cur_img, prop)
-          print(f"  cur_img.{prop}: {type(value)}")
-          
-          # Check if this could be a canvas
-          if hasattr(value, 'getContext'):
-            print(f"    ^ This has getContext() - it's a canvas!")
-            video_canvas = value
-            break
-          elif hasattr(value, 'canvas'):
-            print(f"    ^ This has a canvas property!")
-            video_canvas = getattr(value, 'canvas')
-            break
-          elif hasattr(value, 'imageData'):
-            print(f"    ^ This has imageData property!")
-            video_canvas = getattr(value, 'imageData')
-            break
-            
-        except Exception as e:
-          print(f"  Error accessing {prop}: {e}")
-    
-    # Final canvas setup
-    
+    # Cached access path first, full store walk only when it no longer validates
+    roots = {'store': store.state, 'video': cur_img}
+    video_canvas = canvas_paths.locate(roots, context.imageId, cur_img, context.frame, Object.keys)
+
     if video_canvas:
-      print(f"\n🎯 FOUND VIDEO CANVAS OBJECT!")
-      print(f"  Type: {type(video_canvas)}")
+      log.debug("Video canvas: %dx%d (path cache hits: %d, misses: %d)",
+                video_canvas.width, video_canvas.height, canvas_paths.hits, canvas_paths.misses)
       try:
-        print(f"  Dimensions: {video_canvas.width}x{video_canvas.height}")
-        img_cvs = video_canvas
-        img_ctx = video_canvas.getContext("2d")
-        print("  Successfully set up for CLAHE processing!")
+        video_canvas.getContext("2d")
       except Exception as e:
-        print(f"  Error setting up canvas: {e}")
-        return
+        log.error("Error setting up canvas: %s", e)
+        canvas_paths.forget(context.imageId)
+      # As before, the player's own canvas is only located, never written to
+      return
     else:
-      print("❌ No direct video canvas access found")
-      print("🔄 Trying alternative approach: create canvas from video frame...")
-      
-      # Alternative approach: Create our own canvas using video dimensions
+      # No direct video canvas access: create our own canvas from the video frame
+      log.debug("No direct video canvas access found, drawing the frame to a canvas")
       try:
         from js import document
         
         # Get video dimensions from fileMeta
         video_width = cur_img.fileMeta.width
         video_height = cur_img.fileMeta.height
-        print(f"  Video dimensions: {video_width}x{video_height}")
         
-        # Try to get current frame URL from preview system
-        # Videos have preview URLs like: "https://app.supervisely.com/previews/.../videoframe/33p/1/174515916?..."
-        frame_url = None
-        if hasattr(cur_img, 'preview'):
-          preview_url = cur_img.preview
-          print(f"  Base preview URL: {preview_url}")
-          
-          # Strategy: Try multiple URL approaches, prioritizing high resolution
-          current_frame = context.frame
-          frame_urls_to_try = []
-          
-          import re
-          frame_pattern = r'videoframe/([^/]+)/(\d+)/'
-          match = re.search(frame_pattern, preview_url)
-          
-          print(f"  🔍 Analyzing preview URL for frame pattern:")
-          print(f"    URL: {preview_url}")
-          if match:
-            original_frame_str = match.group(2)
-            quality = match.group(1)
-            print(f"    Found frame pattern: quality={quality}, original_frame={original_frame_str}")
-          else:
-            print(f"    ❌ No frame pattern found in URL!")
-          
-          # Strategy 1: High resolution with correct frame (PRIORITIZE FRAME-AWARE STRATEGIES)
-          url_high_res = preview_url.replace('resize:fill:150:0:0', f'resize:fill:{video_width}:{video_height}:0')
-          if match:
-            # Try both frame indexing strategies at high resolution
-            quality = match.group(1)
-            original_frame_num = int(match.group(2))
-            
-            # 1-indexed frame at high res (try this first)
-            new_frame_1indexed = current_frame + 1
-            url_high_1indexed = re.sub(frame_pattern, f'videoframe/{quality}/{new_frame_1indexed}/', url_high_res)
-            frame_urls_to_try.append(("high_res_1indexed", url_high_1indexed))
-            print(f"    Generated 1-indexed URL: {original_frame_num} -> {new_frame_1indexed}")
-            
-            # 0-indexed frame at high res
-            new_frame_0indexed = current_frame
-            url_high_0indexed = re.sub(frame_pattern, f'videoframe/{quality}/{new_frame_0indexed}/', url_high_res)
-            frame_urls_to_try.append(("high_res_0indexed", url_high_0indexed))
-            print(f"    Generated 0-indexed URL: {original_frame_num} -> {new_frame_0indexed}")
-            
-            # Strategy 2: Full resolution with correct frame (remove resize but keep frame changes)
-            url_full_res_1indexed = re.sub(r'/resize:fill:\d+:\d+:\d+', '', url_high_1indexed)
-            url_full_res_0indexed = re.sub(r'/resize:fill:\d+:\d+:\d+', '', url_high_0indexed)
-            frame_urls_to_try.append(("full_res_1indexed", url_full_res_1indexed))
-            frame_urls_to_try.append(("full_res_0indexed", url_full_res_0indexed))
-          else:
-            # Just high resolution with original frame
-            frame_urls_to_try.append(("high_resolution", url_high_res))
-          
-          # Strategy 3: Fallback to original low-res (last resort - same frame always)
-          frame_urls_to_try.append(("original_low_res_fallback", preview_url))
-          
-          # Try each URL until one works
-          print(f"  Will try {len(frame_urls_to_try)} URL strategies:")
-          for i, (strategy, url) in enumerate(frame_urls_to_try):
-            print(f"    {i+1}. {strategy}: {url}")
-          
-          frame_url = frame_urls_to_try[0][1]  # Start with the first one
-          current_strategy_index = 0
+        if not hasattr(cur_img, 'preview'):
+          log.error("No frame URL available")
+          return
         
-        if frame_urls_to_try:
-          print(f"  Prepared {len(frame_urls_to_try)} URL strategies to try")
-          
-          # Create canvas with video dimensions
-          temp_canvas = document.createElement('canvas')
-          temp_canvas.width = video_width
-          temp_canvas.height = video_height
-          temp_ctx = temp_canvas.getContext('2d')
-          
-          # Create image element to load the frame
-          frame_img = document.createElement('img')
-          frame_img.crossOrigin = 'anonymous'  # Allow cross-origin for processing
-          
-          def on_frame_loaded(event=None):
-            strategy_name = frame_urls_to_try[current_strategy_index][0]
-            successful_url = frame_urls_to_try[current_strategy_index][1]
-            print(f"  ✅ Frame image loaded successfully using strategy: {strategy_name}")
-            print(f"  ✅ Successful URL: {successful_url}")
-            try:
-              # Draw the frame to our canvas
-              temp_ctx.drawImage(frame_img, 0, 0, video_width, video_height)
-              print("  Frame drawn to canvas!")
-              
-              # Set up for CLAHE processing
-              img_cvs = temp_canvas
-              img_ctx = temp_ctx
-              print("  Canvas ready for Histogram Equalization processing!")
-              
-              # Continue with histogram equalization processing now that frame is loaded
-              process_histogram_equalization_with_canvas(img_cvs, img_ctx, app, cur_img, mode)
-              
-              # After histogram equalization processing, display processed frame in our app interface
-              try:
-                print("  🖼️ Displaying processed frame in app interface...")
-                
-                # Convert processed canvas to data URL
-                processed_data_url = temp_canvas.toDataURL('image/png')
-                
-                # Update our display elements
-                display_img = document.getElementById('processed-frame-display')
-                status_div = document.getElementById('processed-frame-status')
-                
-                if display_img and status_div:
-                  # Show the processed image
-                  display_img.src = processed_data_url
-                  display_img.style.display = 'block'  # Make it visible
-                  
-                  # Update status
-                  status_div.textContent = f"✅ Processed frame {context.frame} ({video_width}x{video_height})"
-                  status_div.style.color = '#28a745'  # Green color for success
-                  
-                  print(f"    ✅ Updated app display with processed frame!")
-                else:
-                  print(f"    ❌ Could not find display elements in app interface")
-                  
-              except Exception as e:
-                print(f"  ❌ Error updating app display: {e}")
-              
-            except Exception as e:
-              print(f"  Error drawing frame to canvas: {e}")
-          
-          def on_frame_error(event=None):
-            nonlocal current_strategy_index
-            current_strategy_index += 1
-            
-            if current_strategy_index < len(frame_urls_to_try):
-              strategy, next_url = frame_urls_to_try[current_strategy_index]
-              print(f"  ❌ Failed to load with strategy {current_strategy_index}. Trying strategy {current_strategy_index + 1}: {strategy}")
-              print(f"  🎯 FRAME {context.frame} FALLBACK URL: {next_url}")
-              frame_img.src = next_url  # Try the next URL
-            else:
-              print("  ❌ All URL strategies failed - cannot process video")
-          
-          # Set up image loading with fallback mechanism
-          frame_img.onload = on_frame_loaded
-          frame_img.onerror = on_frame_error
+        # Frames come from the per-video prefetch ring, which also loads the next frames ahead
+        current_frame = context.frame
+        prefetcher = get_frame_prefetcher(cur_img, context, video_width, video_height)
+        with spans.span('frame-fetch'):
+          frame_img = await prefetcher.get(current_frame, getattr(cur_img.fileMeta, 'framesCount', None))
+        if frame_img is None:
+          log.error("All URL strategies failed - cannot process video")
+          return
+        log.debug("Frame %s loaded (strategy: %s)", current_frame, frame_memo.get(prefetcher_key(cur_img, context)))
+        
+        # Create canvas with video dimensions
+        temp_canvas = document.createElement('canvas')
+        temp_canvas.width = video_width
+        temp_canvas.height = video_height
+        temp_ctx = temp_canvas.getContext('2d')
+        
+        try:
+          # Draw the frame to our canvas
+          with spans.span('frame-draw'):
+            temp_ctx.drawImage(frame_img, 0, 0, video_width, video_height)
           
-          # Start with the first strategy
-          strategy_name, first_url = frame_urls_to_try[0]
-          print(f"  Starting with strategy 1: {strategy_name}")
-          print(f"  🎯 FRAME {current_frame} URL: {first_url}")
-          frame_img.src = first_url
+          # Continue with histogram equalization processing now that frame is loaded
+          result = await process_histogram_equalization_with_canvas(temp_canvas, temp_ctx, app, cur_img, mode, token, roi_for(temp_canvas))
           
-          print("  Canvas created, waiting for frame to load...")
-          return  # Exit here - processing continues in onload callback
+          # After histogram equalization processing, display processed frame in our app interface
+          if result is not None:
+            show_processed_preview(preview.display_copy(result), f"✅ Processed frame {context.frame} ({video_width}x{video_height})")
           
-        else:
-          print("❌ No frame URL available")
-          return
+        except Exception as e:
+          log.error("Error drawing frame to canvas: %s", e)
+        
+        return
           
       except Exception as e:
-        print(f"❌ Error creating video canvas: {e}")
+        log.error("Error creating video canvas: %s", e)
         return
     
   else:
-    print("ERROR: Unknown media type - neither image nor video format recognized")
+    log.error("Unknown media type - neither image nor video format recognized")
     return
 
-main
\ No newline at end of file
+async def main(mode='process', token=None):
+  """Render the current item; returns True once done (the scheduler resolves superseded requests with None)"""
+  from js import slyApp
+
+  app = getattr(slyApp.app, '$children')[0]
+  instrument.set_level(getattr(app.state, 'logLevel', instrument.DEFAULT_LEVEL))
+  apply_engine_backend(app.state)
+
+  start = time.perf_counter()
+  try:
+    await render_media(app, slyApp.store, mode, token)
+    spans.record('render', (time.perf_counter() - start) * 1000.0)
+  finally:
+    publish_stats(app.state)
+  return True
+
+# Latest-wins: a burst of requests renders only the newest one, one render at a time
+scheduler = RenderScheduler(main)
+
+def handler(mode='process'):
+  """Entry point called by index.html, returns an awaitable resolved when the render finishes"""
+  return scheduler.submit(mode)
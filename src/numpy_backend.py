@@ -0,0 +1,242 @@
+"""Pure-NumPy versions of the OpenCV calls used by the engine.
+
+Lets the app run on NumPy alone, without downloading and initializing
+Pyodide's ``opencv-python`` package. Conversions follow OpenCV's 8-bit
+formulas:
+
+* gray: the fixed-point ``0.299 R + 0.587 G + 0.114 B`` of ``RGBA2GRAY``,
+  bit-exact;
+* RGB to LAB: OpenCV's fixed-point sRGB gamma and cube-root tables, bit-exact
+  for L and within one level for a and b;
+* LAB to RGB: the same sRGB / D65 formulas in float32 with lookup tables for
+  the gamma step, within two levels of ``LAB2RGB``;
+* equalization: ``clahe.equalize_hist_lut`` (bit-exact with
+  ``equalizeHist``) and ``clahe.IncrementalClahe``.
+
+The conversions work on strips of ``STRIP_PIXELS`` pixels with scratch
+buffers allocated once per call, so their temporaries don't grow with the
+frame.
+"""
+import numpy as np
+
+import clahe
+
+
+# Fixed-point RGB -> gray weights of OpenCV (sum 1 << GRAY_SHIFT)
+GRAY_SHIFT = 15
+GRAY_WEIGHTS = (9798, 19235, 3735)
+
+RGB_TO_XYZ = np.array([
+  [0.412453, 0.357580, 0.180423],
+  [0.212671, 0.715160, 0.072169],
+  [0.019334, 0.119193, 0.950227],
+], dtype=np.float32)
+XYZ_TO_RGB = np.array([
+  [3.240479, -1.537150, -0.498535],
+  [-0.969256, 1.875991, 0.041556],
+  [0.055648, -0.204043, 1.057311],
+], dtype=np.float32)
+WHITE_X = 0.950456
+WHITE_Z = 1.088754
+
+LAB_EPSILON = 0.008856
+LAB_KAPPA = 903.3
+# Resolution of the float tables indexed by values in [0, 1]
+TABLE_SIZE = 16384
+
+# Fixed-point layout of OpenCV's 8-bit RGB -> LAB
+GAMMA_SHIFT = 3
+LAB_SHIFT = 12
+LAB_SHIFT2 = LAB_SHIFT + GAMMA_SHIFT
+CBRT_TABLE_SIZE = 256 * 3 // 2 * (1 << GAMMA_SHIFT)
+L_SCALE = (116 * 255 + 50) // 100
+L_SHIFT = -((16 * 255 * (1 << LAB_SHIFT2) + 50) // 100)
+
+
+def _srgb_to_linear(v):
+  return np.where(v <= 0.04045, v / 12.92, ((v + 0.055) / 1.055) ** 2.4)
+
+
+def _fixed_gamma_table():
+  return np.rint(255.0 * (1 << GAMMA_SHIFT) * _srgb_to_linear(np.arange(256) / 255.0)).astype(np.int32)
+
+
+def _fixed_cbrt_table():
+  t = np.arange(CBRT_TABLE_SIZE) / (255.0 * (1 << GAMMA_SHIFT))
+  return np.rint((1 << LAB_SHIFT2) * np.where(t < LAB_EPSILON, 7.787 * t + 16.0 / 116.0, np.cbrt(t))).astype(np.int32)
+
+
+def _fixed_xyz_coeffs():
+  white = np.array([WHITE_X, 1.0, WHITE_Z])
+  return np.rint((1 << LAB_SHIFT) * RGB_TO_XYZ.astype(np.float64) / white[:, None]).astype(np.int32)
+
+
+def _linear_to_srgb_table():
+  v = np.linspace(0.0, 1.0, TABLE_SIZE)
+  srgb = np.where(v <= 0.0031308, 12.92 * v, 1.055 * v ** (1.0 / 2.4) - 0.055)
+  return np.rint(srgb * 255.0).astype(np.uint8)
+
+
+GAMMA_FIXED = _fixed_gamma_table()
+CBRT_FIXED = _fixed_cbrt_table()
+XYZ_COEFFS_FIXED = _fixed_xyz_coeffs()
+LINEAR_TO_SRGB = _linear_to_srgb_table()
+
+# Pixels per strip of the conversions, bounds their float32 and int32 scratch buffers
+STRIP_PIXELS = 1 << 16
+
+
+def _table_index(values, out):
+  """Index into a ``TABLE_SIZE`` table for float values in [0, 1], clipped; ``values`` is overwritten"""
+  values *= np.float32(TABLE_SIZE - 1)
+  np.clip(values, 0, TABLE_SIZE - 1, out=values)
+  np.rint(values, out=values)
+  np.copyto(out, values, casting='unsafe')
+  return out
+
+
+def strip_rows(width, pixels=None):
+  """Rows per strip of about ``pixels`` (default ``STRIP_PIXELS``) pixels for a plane of ``width`` columns"""
+  return max(1, (pixels or STRIP_PIXELS) // max(int(width), 1))
+
+
+def rgba_to_gray(rgba):
+  """``cv2.cvtColor(rgba, cv2.COLOR_RGBA2GRAY)``, for uint8 or uint16 frames"""
+  height, width = rgba.shape[:2]
+  wr, wg, wb = (np.uint32(w) for w in GRAY_WEIGHTS)
+  gray = np.empty((height, width), dtype=rgba.dtype)
+  rows = strip_rows(width)
+  acc_buf = np.empty((rows, width), dtype=np.uint32)
+  term_buf = np.empty((rows, width), dtype=np.uint32)
+  for r0 in range(0, height, rows):
+    r1 = min(r0 + rows, height)
+    acc, term = acc_buf[:r1 - r0], term_buf[:r1 - r0]
+    np.multiply(rgba[r0:r1, :, 0], wr, out=acc)
+    np.multiply(rgba[r0:r1, :, 1], wg, out=term)
+    acc += term
+    np.multiply(rgba[r0:r1, :, 2], wb, out=term)
+    acc += term
+    acc += np.uint32(1 << (GRAY_SHIFT - 1))
+    acc >>= GRAY_SHIFT
+    gray[r0:r1] = acc
+  return gray
+
+
+def _descale(values, shift):
+  values += 1 << (shift - 1)
+  values >>= shift
+  return values
+
+
+def rgb_to_lab_planes(rgb):
+  """Split 8-bit LAB planes of an RGB(A) image, like ``cv2.split(cv2.cvtColor(rgb, COLOR_RGB2LAB))``"""
+  height, width = rgb.shape[:2]
+  planes = tuple(np.empty((height, width), dtype=np.uint8) for _ in range(3))
+  rows = strip_rows(width)
+  # Linear RGB, then fx, fy, fz, then one output plane at a time in ``acc``
+  linear_buf = np.empty((3, rows, width), dtype=np.int32)
+  f_buf = np.empty((3, rows, width), dtype=np.int32)
+  acc_buf = np.empty((rows, width), dtype=np.int32)
+  for r0 in range(0, height, rows):
+    r1 = min(r0 + rows, height)
+    linear, f, acc = linear_buf[:, :r1 - r0], f_buf[:, :r1 - r0], acc_buf[:r1 - r0]
+    for c in range(3):
+      np.take(GAMMA_FIXED, rgb[r0:r1, :, c], out=linear[c])
+    for i, (c_r, c_g, c_b) in enumerate(XYZ_COEFFS_FIXED.tolist()):
+      np.multiply(linear[0], c_r, out=acc)
+      np.multiply(linear[1], c_g, out=f[i])
+      acc += f[i]
+      np.multiply(linear[2], c_b, out=f[i])
+      acc += f[i]
+      np.take(CBRT_FIXED, _descale(acc, LAB_SHIFT), out=f[i])
+    fx, fy, fz = f
+    np.multiply(fy, L_SCALE, out=acc)
+    acc += L_SHIFT
+    _store_uint8(_descale(acc, LAB_SHIFT2), planes[0][r0:r1])
+    np.subtract(fx, fy, out=acc)
+    acc *= 500
+    acc += 128 << LAB_SHIFT2
+    _store_uint8(_descale(acc, LAB_SHIFT2), planes[1][r0:r1])
+    np.subtract(fy, fz, out=acc)
+    acc *= 200
+    acc += 128 << LAB_SHIFT2
+    _store_uint8(_descale(acc, LAB_SHIFT2), planes[2][r0:r1])
+  return planes
+
+
+def lab_planes_to_rgb(l_plane, a_plane, b_plane, out=None):
+  """8-bit LAB planes to an ``(H, W, 3)`` RGB image, like ``cv2.cvtColor(merged, COLOR_LAB2RGB)``.
+
+  ``out`` may be any ``(H, W, >=3)`` uint8 array, e.g. an RGBA buffer whose
+  first three channels get written.
+  """
+  height, width = l_plane.shape
+  if out is None:
+    out = np.empty((height, width, 3), dtype=np.uint8)
+  rows = strip_rows(width)
+  light_buf, fy_buf, f_buf, tmp_buf, x_buf, y_buf, z_buf = np.empty((7, rows, width), dtype=np.float32)
+  mask_buf = np.empty((rows, width), dtype=bool)
+  index_buf = np.empty((rows, width), dtype=np.intp)
+  for r0 in range(0, height, rows):
+    n = min(rows, height - r0)
+    light, fy, f, tmp, x, y, z = (buf[:n] for buf in (light_buf, fy_buf, f_buf, tmp_buf, x_buf, y_buf, z_buf))
+    mask, index = mask_buf[:n], index_buf[:n]
+
+    np.multiply(l_plane[r0:r0 + n], np.float32(100.0 / 255.0), out=light)
+    np.add(light, np.float32(16.0), out=fy)
+    fy /= np.float32(116.0)
+    # Y from the cube of fy, or from the linear segment for dark pixels, whose fy then follows from Y
+    np.less_equal(light, np.float32(LAB_KAPPA * LAB_EPSILON), out=mask)
+    np.multiply(fy, fy, out=y)
+    y *= fy
+    np.divide(light, np.float32(LAB_KAPPA), out=tmp)
+    np.copyto(y, tmp, where=mask)
+    np.multiply(y, np.float32(7.787), out=tmp)
+    tmp += np.float32(16.0 / 116.0)
+    np.copyto(fy, tmp, where=mask)
+
+    np.subtract(a_plane[r0:r0 + n], np.float32(128.0), out=tmp)
+    tmp /= np.float32(500.0)
+    np.add(fy, tmp, out=f)
+    _lab_f_inverse(f, x, tmp, mask)
+    x *= np.float32(WHITE_X)
+    np.subtract(b_plane[r0:r0 + n], np.float32(128.0), out=tmp)
+    tmp /= np.float32(200.0)
+    np.subtract(fy, tmp, out=f)
+    _lab_f_inverse(f, z, tmp, mask)
+    z *= np.float32(WHITE_Z)
+
+    for c, (r_x, r_y, r_z) in enumerate(XYZ_TO_RGB):
+      np.multiply(x, r_x, out=tmp)
+      np.multiply(y, r_y, out=light)
+      tmp += light
+      np.multiply(z, r_z, out=light)
+      tmp += light
+      np.take(LINEAR_TO_SRGB, _table_index(tmp, index), out=out[r0:r0 + n, :, c], mode='clip')
+  return out[:, :, :3]
+
+
+def _lab_f_inverse(f, out, tmp, mask):
+  """Inverse of the LAB companding function of ``f`` into ``out``; ``tmp`` and ``mask`` are scratch"""
+  np.greater(f, np.float32(0.206893), out=mask)
+  np.subtract(f, np.float32(16.0 / 116.0), out=out)
+  out /= np.float32(7.787)
+  np.multiply(f, f, out=tmp)
+  tmp *= f
+  np.copyto(out, tmp, where=mask)
+  return out
+
+
+def _store_uint8(values, out):
+  np.clip(values, 0, 255, out=values)
+  out[...] = values
+
+
+def equalize_hist(plane, bits=None):
+  """``cv2.equalizeHist``, which ``clahe.equalize_hist`` extends to uint16 planes of ``bits`` bits"""
+  return clahe.equalize_hist(plane, bits)
+
+
+def apply_clahe(plane, clip_limit, tile_grid, bits=None):
+  """``cv2.createCLAHE(clip_limit, tile_grid).apply(plane)``, within one level"""
+  return clahe.IncrementalClahe(plane, tile_grid, bits).apply(clip_limit)
@@ -0,0 +1,241 @@
+"""Byte-budgeted LRU cache of decoded RGBA pixels and derived color planes.
+
+Entries are keyed by ``(image_id, source_version)``. The gray plane, the
+split LAB planes, the HSV value plane and the CLAHE tile histograms of each
+lightness plane are derived lazily from the
+cached RGBA frame, so toggling between modes or returning to a recently
+viewed image skips both the canvas readback and the color conversion.
+"""
+from collections import OrderedDict
+
+import engine
+import lightness
+from clahe import IncrementalClahe
+
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class CachedImage:
+  """RGBA pixels of one image plus lazily derived color planes"""
+
+  def __init__(self, rgba):
+    self.rgba = rgba
+    self.gray = None
+    self.lab_planes = None
+    self.value = None
+    # (plane name, tile grid) -> IncrementalClahe
+    self.clahe_states = {}
+    # False once evicted or discarded: planes derived later no longer count toward the cache's bytes
+    self.cached = False
+
+  @property
+  def nbytes(self):
+    total = self.rgba.nbytes
+    if self.gray is not None:
+      total += self.gray.nbytes
+    if self.lab_planes is not None:
+      total += sum(plane.nbytes for plane in self.lab_planes)
+    if self.value is not None:
+      total += self.value.nbytes
+    total += sum(state.nbytes for state in self.clahe_states.values())
+    return total
+
+
+def _derived_attr(lab):
+  """The ``CachedImage`` attribute holding the plane(s) derived for ``lab``"""
+  space = engine.lightness_space(lab)
+  if space == engine.LIGHTNESS_LAB:
+    return 'lab_planes'
+  return 'value' if space == engine.LIGHTNESS_HSV else 'gray'
+
+
+def _clahe_key(lab, tile_grid):
+  space = engine.lightness_space(lab)
+  # YCrCb and luma ratio equalize the gray plane
+  plane_name = space if space in (engine.LIGHTNESS_LAB, engine.LIGHTNESS_HSV) else 'gray'
+  return (plane_name, tuple(tile_grid))
+
+
+class PixelCache:
+  """LRU of ``CachedImage`` entries bounded by the total number of bytes held"""
+
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self._entries = OrderedDict()
+    # image_id -> (version after our own write-back, version of the source pixels)
+    self._written_versions = {}
+    self.hits = 0
+    self.misses = 0
+    self.plane_hits = 0
+    self.plane_misses = 0
+    self.evictions = 0
+
+  def source_key(self, image_id, version):
+    """Map a version produced by our own write-back to the version of the original pixels"""
+    written = self._written_versions.get(image_id)
+    if written is not None and written[0] == version:
+      version = written[1]
+    return (image_id, version)
+
+  def mark_written(self, image_id, source_version, new_version):
+    """Record that ``new_version`` of an image is our enhanced output of ``source_version``"""
+    self._written_versions[image_id] = (new_version, source_version)
+
+  def is_own_output(self, image_id, version):
+    """Whether ``version`` of an image is our enhanced output rather than its original pixels"""
+    written = self._written_versions.get(image_id)
+    return written is not None and written[0] == version
+
+  def get(self, key):
+    entry = self._entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._entries.move_to_end(key)
+    return entry
+
+  def put(self, key, rgba):
+    self.discard(key)
+    entry = CachedImage(rgba)
+    entry.cached = True
+    self._entries[key] = entry
+    self._grow(entry, entry.nbytes)
+    return entry
+
+  def get_or_load(self, key, load_rgba):
+    """Return the cached entry for ``key``, calling ``load_rgba()`` on a miss"""
+    entry = self.get(key)
+    if entry is None:
+      entry = self.put(key, load_rgba())
+    return entry
+
+  def gray(self, entry):
+    if entry.gray is None:
+      self.plane_misses += 1
+      entry.gray = engine.to_gray(entry.rgba)
+      self._grow(entry, entry.gray.nbytes)
+    else:
+      self.plane_hits += 1
+    return entry.gray
+
+  def lab_planes(self, entry):
+    if entry.lab_planes is None:
+      self.plane_misses += 1
+      entry.lab_planes = engine.to_lab_planes(entry.rgba)
+      self._grow(entry, sum(plane.nbytes for plane in entry.lab_planes))
+    else:
+      self.plane_hits += 1
+    return entry.lab_planes
+
+  def value(self, entry):
+    if entry.value is None:
+      self.plane_misses += 1
+      entry.value = lightness.value_plane(entry.rgba)
+      self._grow(entry, entry.value.nbytes)
+    else:
+      self.plane_hits += 1
+    return entry.value
+
+  def planes(self, entry, lab=False):
+    """``engine.to_planes(entry.rgba, lab)``, from the planes cached in the entry"""
+    space = engine.lightness_space(lab)
+    if space is None:
+      return self.gray(entry)
+    if space == engine.LIGHTNESS_LAB:
+      return self.lab_planes(entry)
+    if space == engine.LIGHTNESS_HSV:
+      return self.value(entry), entry.rgba
+    return self.gray(entry), entry.rgba
+
+  def has_planes(self, entry, lab=False):
+    """Whether the planes ``planes`` returns for ``lab`` are already derived"""
+    return getattr(entry, _derived_attr(lab)) is not None
+
+  def put_planes(self, entry, lab, derived):
+    """Store the plane (the tuple of LAB planes) of ``lab`` derived elsewhere, e.g. band by band"""
+    attr = _derived_attr(lab)
+    if getattr(entry, attr) is None:
+      setattr(entry, attr, derived)
+      self._grow(entry, sum(plane.nbytes for plane in derived) if isinstance(derived, tuple) else derived.nbytes)
+
+  def has_clahe_state(self, entry, lab, tile_grid):
+    return _clahe_key(lab, tile_grid) in entry.clahe_states
+
+  def clahe_state(self, entry, lab, tile_grid, state=None):
+    """Return the tile histograms of the plane that gets equalized with ``lab``.
+
+    ``state`` is stored if there are none yet, e.g. histograms computed band by band.
+    """
+    key = _clahe_key(lab, tile_grid)
+    if key not in entry.clahe_states:
+      self.plane_misses += 1
+      if state is None:
+        plane = engine.luminance_plane(self.planes(entry, lab), lab)
+        state = IncrementalClahe(plane, tile_grid)
+      entry.clahe_states[key] = state
+      self._grow(entry, state.nbytes)
+    else:
+      self.plane_hits += 1
+      state = entry.clahe_states[key]
+    return state
+
+  def drop_planes(self):
+    """Forget the derived planes of all entries but keep their pixels, e.g. after switching engine backends"""
+    for entry in self._entries.values():
+      self.nbytes -= entry.nbytes
+      entry.gray = None
+      entry.lab_planes = None
+      entry.value = None
+      entry.clahe_states = {}
+      self.nbytes += entry.nbytes
+
+  def discard(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      entry.cached = False
+      self.nbytes -= entry.nbytes
+
+  def clear(self):
+    for entry in self._entries.values():
+      entry.cached = False
+    self._entries.clear()
+    self._written_versions.clear()
+    self.nbytes = 0
+
+  def _grow(self, entry, nbytes):
+    """Count ``nbytes`` newly held by ``entry``, unless it was evicted while they were being derived"""
+    if entry.cached:
+      self.nbytes += nbytes
+      self._evict()
+
+  def _evict(self):
+    # The most recently used entry is always kept, even if it alone exceeds the budget
+    while self.nbytes > self.max_bytes and len(self._entries) > 1:
+      _, entry = self._entries.popitem(last=False)
+      entry.cached = False
+      self.nbytes -= entry.nbytes
+      self.evictions += 1
+
+  def stats(self):
+    return {
+      'entries': len(self._entries),
+      'bytes': self.nbytes,
+      'max_bytes': self.max_bytes,
+      'hits': self.hits,
+      'misses': self.misses,
+      'plane_hits': self.plane_hits,
+      'plane_misses': self.plane_misses,
+      'evictions': self.evictions,
+    }
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
+
+
+pixel_cache = PixelCache()
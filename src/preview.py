@@ -0,0 +1,46 @@
+"""Display-size previews for progressive rendering.
+
+The processed-frame panel shows at most ``PREVIEW_MAX_SIDE`` pixels, so it
+never needs the full-resolution image. Before the full-resolution pass runs,
+``quick_preview`` equalizes a strided, display-size copy of the frame (LUTs
+come from that subsampled copy), which is fast enough to show right away.
+``display_copy`` shrinks a finished full-resolution result for the panel
+the same way, instead of PNG-encoding the whole canvas.
+"""
+import math
+
+import numpy as np
+
+import clahe
+import engine
+
+
+PREVIEW_MAX_SIDE = 512
+
+
+def preview_step(height, width, max_side=PREVIEW_MAX_SIDE):
+  """Integer stride that brings the longer side down to about ``max_side``"""
+  return max(1, math.ceil(max(height, width) / max_side))
+
+
+def display_copy(rgba, max_side=PREVIEW_MAX_SIDE):
+  """Contiguous, strided display-size copy of an RGBA frame, quantized to 8 bits"""
+  step = preview_step(rgba.shape[0], rgba.shape[1], max_side)
+  return np.ascontiguousarray(engine.to_uint8(rgba[::step, ::step]))
+
+
+def quick_preview(rgba, lab=False, method=engine.METHOD_CLAHE, clip_limit=engine.DEFAULT_CLIP_LIMIT,
+                  tile_grid=engine.DEFAULT_TILE_GRID, max_side=PREVIEW_MAX_SIDE):
+  """Enhance a display-size copy of ``rgba``; the LUTs come from the subsampled pixels only.
+
+  The CLAHE clip limit is relative to the tile area, so the same tile grid
+  on the small copy gives a close approximation of the full-resolution result.
+  """
+  small = display_copy(rgba, max_side)
+  if method == engine.METHOD_EQUALIZE:
+    def equalizer(plane):
+      return clahe.equalize_hist_lut(np.bincount(plane.ravel(), minlength=clahe.HIST_SIZE)).take(plane)
+  else:
+    def equalizer(plane):
+      return clahe.IncrementalClahe(plane, engine.normalize_tile_grid(tile_grid)).apply(clip_limit)
+  return engine.enhance_planes(engine.to_planes(small, lab), small[:, :, 3], lab, equalizer=equalizer)
@@ -0,0 +1,251 @@
+"""Persistent, size-bounded store of enhanced results shared across sessions.
+
+Results are addressed by a hash of everything they depend on: the image ID,
+the version of its source pixels (``sources[0].version`` in the app, file
+size and mtime in the batch CLI), the mode, clip limit, tile grid and the
+engine version and backend. A new source version therefore simply misses
+and the old entry ages out.
+
+Payloads are zlib-compressed. Gray results have identical RGB channels, so
+only gray and alpha are stored for them; single-channel results are stored
+as they are. 16-bit results keep their depth, as little-endian samples. ``ResultStore`` keeps the total
+size under ``max_bytes`` and evicts the least recently used entries. The
+bytes themselves live in a pluggable backend with an async interface:
+
+* ``FileSystemBackend``: one file per entry in a directory, for the batch
+  CLI and tests;
+* ``IndexedDBBackend``: the browser, through the small promise-based
+  ``resultStoreDB`` helper defined in ``index.html``.
+"""
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+import engine
+
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+COMPRESS_LEVEL = 1
+
+MAGIC = b'CLR1'
+HEADER = struct.Struct('>4sBII')
+KIND_RGBA = 0
+KIND_GRAY_ALPHA = 1
+KIND_PLANE = 2
+# Or-ed into the kind of uint16 results
+KIND_16BIT = 0x10
+
+
+def result_key(image_id, version, lab, method, clip_limit, tile_grid, bits=None):
+  """Content address of an enhanced result"""
+  parts = {
+    'image': str(image_id),
+    'version': str(version),
+    'lab': engine.lightness_space(lab),
+    'method': method,
+    'clip_limit': round(float(clip_limit), 3),
+    'tile_grid': list(engine.normalize_tile_grid(tile_grid)),
+    'engine': engine.ENGINE_VERSION,
+    'backend': engine.get_backend(),
+  }
+  if bits is not None:
+    # Only when given, so the keys of results of guessed bit depths stay the same
+    parts['bits'] = int(bits)
+  return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def encode(rgba, lab=True):
+  """Compress an ``(H, W, 4)`` or single-channel ``(H, W)`` result; gray results (``lab=False``) keep only gray and alpha"""
+  height, width = rgba.shape[:2]
+  if rgba.ndim == 2:
+    kind, pixels = KIND_PLANE, rgba
+  elif engine.lightness_space(lab) is not None:
+    kind, pixels = KIND_RGBA, rgba
+  else:
+    kind, pixels = KIND_GRAY_ALPHA, rgba[:, :, ::3]
+  if rgba.dtype == np.uint16:
+    kind |= KIND_16BIT
+    pixels = pixels.astype('<u2', copy=False)
+  return HEADER.pack(MAGIC, kind, height, width) + zlib.compress(np.ascontiguousarray(pixels).tobytes(), COMPRESS_LEVEL)
+
+
+def decode(payload, out=None):
+  """Decompress a payload from ``encode`` into an ``(H, W, 4)`` or ``(H, W)`` array (``out`` if given)"""
+  magic, kind, height, width = HEADER.unpack_from(payload)
+  if magic != MAGIC:
+    raise ValueError("Not an enhanced result payload")
+  dtype = np.uint16 if kind & KIND_16BIT else np.uint8
+  kind &= ~KIND_16BIT
+  pixels = np.frombuffer(zlib.decompress(memoryview(payload)[HEADER.size:]), dtype='<u2' if dtype == np.uint16 else dtype)
+  if kind == KIND_PLANE:
+    if out is None:
+      out = np.empty((height, width), dtype=dtype)
+    out[:] = pixels.reshape(height, width)
+    return out
+  if out is None:
+    out = np.empty((height, width, 4), dtype=dtype)
+  if kind == KIND_RGBA:
+    out[:] = pixels.reshape(height, width, 4)
+  else:
+    pixels = pixels.reshape(height, width, 2)
+    out[:, :, :3] = pixels[:, :, :1]
+    out[:, :, 3] = pixels[:, :, 1]
+  return out
+
+
+class FileSystemBackend:
+  """Entries as files in a directory; last use is the file's mtime"""
+
+  def __init__(self, directory):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + '.bin')
+
+  async def get(self, key):
+    try:
+      with open(self._path(key), 'rb') as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  async def put(self, key, payload):
+    # Several batch workers may write at once: write under a temporary name, then rename
+    tmp_path = f"{self._path(key)}.{os.getpid()}.partial"
+    with open(tmp_path, 'wb') as f:
+      f.write(payload)
+    os.replace(tmp_path, self._path(key))
+
+  async def touch(self, key, last_used):
+    try:
+      os.utime(self._path(key), (last_used, last_used))
+    except FileNotFoundError:
+      pass
+
+  async def delete(self, key):
+    try:
+      os.remove(self._path(key))
+    except FileNotFoundError:
+      pass
+
+  async def entries(self):
+    """``(key, size, last_used)`` of every stored entry"""
+    result = []
+    for entry in os.scandir(self.directory):
+      if entry.name.endswith('.bin'):
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          # Evicted by another worker since the listing
+          continue
+        result.append((entry.name[:-4], stat.st_size, stat.st_mtime))
+    return result
+
+
+class IndexedDBBackend:
+  """Entries in the browser's IndexedDB through the ``resultStoreDB`` JS helper of ``index.html``"""
+
+  def __init__(self, db=None):
+    if db is None:
+      from js import resultStoreDB as db
+    self.db = db
+
+  async def get(self, key):
+    data = await self.db.get(key)
+    return None if data is None else data.to_bytes()
+
+  async def put(self, key, payload):
+    from pyodide.ffi import to_js
+    await self.db.put(key, to_js(payload), len(payload), time.time())
+
+  async def touch(self, key, last_used):
+    await self.db.touch(key, last_used)
+
+  async def delete(self, key):
+    await self.db.delete(key)
+
+  async def entries(self):
+    return [tuple(entry) for entry in (await self.db.entries()).to_py()]
+
+
+class ResultStore:
+  """Size-bounded LRU over a backend; the index of entry sizes, oldest first, is loaded on first use.
+
+  ``shared`` when other processes write to the same backend, like the batch
+  workers: the index is then re-scanned after every write, so the bound
+  covers the entries of all of them.
+  """
+
+  def __init__(self, backend, max_bytes=DEFAULT_MAX_BYTES, shared=False):
+    self.backend = backend
+    self.max_bytes = max_bytes
+    self.shared = shared
+    self.nbytes = 0
+    self._index = None
+    self.hits = 0
+    self.misses = 0
+    self.writes = 0
+    self.evictions = 0
+
+  async def _load_index(self):
+    if self._index is None:
+      entries = sorted(await self.backend.entries(), key=lambda entry: entry[2])
+      self._index = {key: size for key, size, _ in entries}
+      self.nbytes = sum(self._index.values())
+
+  async def get(self, key):
+    """Payload stored under ``key``, or None"""
+    await self._load_index()
+    # Asked even for keys missing from the index: another process may have stored them since
+    payload = await self.backend.get(key)
+    if payload is None:
+      self.nbytes -= self._index.pop(key, 0)
+      self.misses += 1
+      return None
+    self.hits += 1
+    # dicts keep insertion order: re-inserting moves the key to the most recently used end
+    self.nbytes += len(payload) - self._index.pop(key, 0)
+    self._index[key] = len(payload)
+    await self.backend.touch(key, time.time())
+    return payload
+
+  async def put(self, key, payload):
+    await self._load_index()
+    await self.backend.put(key, payload)
+    if self.shared:
+      # Evict by what all processes stored, the new entry being the most recent
+      self._index = None
+      await self._load_index()
+    self.nbytes += len(payload) - self._index.pop(key, 0)
+    self._index[key] = len(payload)
+    self.writes += 1
+    while self.nbytes > self.max_bytes and len(self._index) > 1:
+      old_key = next(iter(self._index))
+      self.nbytes -= self._index.pop(old_key)
+      await self.backend.delete(old_key)
+      self.evictions += 1
+
+  async def load(self, key, out=None):
+    """Decoded result stored under ``key``, or None"""
+    payload = await self.get(key)
+    return None if payload is None else decode(payload, out)
+
+  async def save(self, key, rgba, lab=True):
+    await self.put(key, encode(rgba, lab))
+
+  def stats(self):
+    return {
+      'entries': len(self._index or ()),
+      'bytes': self.nbytes,
+      'max_bytes': self.max_bytes,
+      'hits': self.hits,
+      'misses': self.misses,
+      'writes': self.writes,
+      'evictions': self.evictions,
+    }
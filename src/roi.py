@@ -0,0 +1,102 @@
+"""Region-of-interest enhancement.
+
+In ROI mode only a rectangle around the object of interest is equalized:
+the histogram (or CLAHE tiles) come from the region alone and only the
+region is written back to the canvas, so the cost scales with the ROI area
+instead of the image area.
+
+Bounding boxes are ``(x0, y0, x1, y1)`` in canvas pixels, end exclusive.
+``CanvasWrites`` remembers what was last written to each canvas, so the
+original pixels under a previous ROI can be put back before the next render
+reads from or writes to the canvas.
+"""
+import numpy as np
+
+import engine
+
+
+DEFAULT_MARGIN = 16
+
+
+def clip_bbox(bbox, width, height, margin=0):
+  """Grow ``bbox`` by ``margin`` and clip it to the canvas; None if nothing is left"""
+  x0, y0, x1, y1 = (int(round(float(v))) for v in bbox)
+  if x0 > x1:
+    x0, x1 = x1, x0
+  if y0 > y1:
+    y0, y1 = y1, y0
+  x0, y0 = max(x0 - margin, 0), max(y0 - margin, 0)
+  x1, y1 = min(x1 + margin, width), min(y1 + margin, height)
+  if x1 <= x0 or y1 <= y0:
+    return None
+  return x0, y0, x1, y1
+
+
+def bbox_from_points(points):
+  """Bounding box of ``[[x, y], ...]`` points, end exclusive"""
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+  if not len(points):
+    return None
+  x0, y0 = np.floor(points.min(axis=0))
+  x1, y1 = np.ceil(points.max(axis=0)) + 1
+  return x0, y0, x1, y1
+
+
+def bbox_from_geometry(geometry):
+  """Bounding box of a label geometry in Supervisely JSON (rectangle, polygon, polyline or point).
+
+  Bitmap labels only carry the origin of an encoded mask and give None.
+  """
+  if not geometry:
+    return None
+  points = geometry.get('points')
+  if points and points.get('exterior'):
+    return bbox_from_points(points['exterior'])
+  return None
+
+
+def region(rgba, bbox):
+  x0, y0, x1, y1 = bbox
+  return rgba[y0:y1, x0:x1]
+
+
+def enhance_region(rgba_region, lab=False, **params):
+  """Enhance an RGBA region on its own: histogram or CLAHE tiles come from the region only"""
+  return engine.enhance(np.ascontiguousarray(rgba_region), lab, **params)
+
+
+class CanvasWrites:
+  """Last enhancement written to each canvas: the whole image, or an ROI with its original pixels"""
+
+  def __init__(self):
+    # cache key -> (bbox or None for the whole image, original RGBA under the bbox)
+    self._writes = {}
+
+  def record_full(self, key):
+    self._writes[key] = (None, None)
+
+  def record_roi(self, key, bbox, original):
+    self._writes[key] = (bbox, original)
+
+  def pop(self, key):
+    """Return and forget the last write to the canvas of ``key`` as ``(bbox, original)``, or None"""
+    return self._writes.pop(key, None)
+
+  def clear(self):
+    self._writes.clear()
+
+
+def restore(last_write, put_region):
+  """Put back the original pixels under the ROI of ``last_write``, as ``CanvasWrites.pop`` returns it.
+
+  ``put_region(rgba, x, y)`` writes an RGBA region to the canvas at ``(x, y)``.
+  Returns whether there were pixels to put back.
+  """
+  if last_write is None or last_write[0] is None:
+    return False
+  bbox, original = last_write
+  put_region(original, bbox[0], bbox[1])
+  return True
+
+
+canvas_writes = CanvasWrites()
@@ -0,0 +1,101 @@
+"""Latest-wins render scheduler.
+
+Slider drags and checkbox bursts produce requests faster than a full render
+finishes. ``RenderScheduler`` keeps at most one pending request (the newest),
+never runs two renders at the same time, and lets the running render stop
+early: the render awaits ``token.checkpoint(stage)`` between pipeline stages
+and is aborted there as soon as a newer request has been submitted.
+"""
+import asyncio
+
+
+STAGES = ('readback', 'convert', 'equalize', 'write-back')
+
+
+class RenderCancelled(BaseException):
+  """Raised at a checkpoint of a render that a newer request has superseded.
+
+  Derives from ``BaseException`` so that the broad ``except Exception``
+  blocks of the render pipeline don't swallow it.
+  """
+
+
+class RenderToken:
+  """Handed to each render to check whether it is still the latest request"""
+
+  def __init__(self, scheduler, generation):
+    self._scheduler = scheduler
+    self.generation = generation
+
+  @property
+  def stale(self):
+    return self.generation != self._scheduler.generation
+
+  async def checkpoint(self, stage=None):
+    # Yield to the event loop so newer UI events get a chance to be submitted
+    await asyncio.sleep(0)
+    if self.stale:
+      self._scheduler.cancelled_at[stage] = self._scheduler.cancelled_at.get(stage, 0) + 1
+      raise RenderCancelled(stage)
+
+
+class RenderScheduler:
+  """Runs ``await render(*args, token=token, **kwargs)`` for the newest submitted request only"""
+
+  def __init__(self, render):
+    self._render = render
+    self.generation = 0
+    self._pending = None
+    self._worker = None
+    self.running = False
+    self.submitted = 0
+    self.dropped = 0
+    self.cancelled = 0
+    self.completed = 0
+    self.cancelled_at = {}
+
+  def submit(self, *args, **kwargs):
+    """Queue a render and return a future with its result, or ``None`` if it was superseded"""
+    future = asyncio.get_event_loop().create_future()
+    self.generation += 1
+    self.submitted += 1
+    if self._pending is not None:
+      self._resolve(self._pending[3], None)
+      self.dropped += 1
+    self._pending = (self.generation, args, kwargs, future)
+    if self._worker is None or self._worker.done():
+      self._worker = asyncio.ensure_future(self._run())
+    return future
+
+  async def _run(self):
+    while self._pending is not None:
+      generation, args, kwargs, future = self._pending
+      self._pending = None
+      self.running = True
+      try:
+        result = await self._render(*args, token=RenderToken(self, generation), **kwargs)
+      except RenderCancelled:
+        self.cancelled += 1
+        self._resolve(future, None)
+      except Exception as e:
+        if not future.done():
+          future.set_exception(e)
+      else:
+        self.completed += 1
+        self._resolve(future, result)
+      finally:
+        self.running = False
+
+  @staticmethod
+  def _resolve(future, result):
+    if not future.done():
+      future.set_result(result)
+
+  def stats(self):
+    return {
+      'submitted': self.submitted,
+      'dropped': self.dropped,
+      'cancelled': self.cancelled,
+      'completed': self.completed,
+      'cancelled_at': dict(self.cancelled_at),
+    }
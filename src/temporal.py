@@ -0,0 +1,114 @@
+"""Temporally coherent equalization for video frames.
+
+Consecutive frames of a video have nearly identical histograms, so fully
+re-equalizing every frame wastes work and makes the output flicker.
+``TemporalEqualizer`` keeps the LUTs (per tile for CLAHE, a single one for
+global equalization) between frames of the same video and compares a cheap
+subsampled histogram of each new frame with the one the LUTs were built
+from:
+
+* distance below ``threshold``: the LUTs are reused as they are;
+* distance above ``threshold``: the LUTs are recomputed and blended into the
+  previous ones with weight ``blend``, so lighting changes fade in;
+* distance above ``cut_threshold`` (a scene cut): the recomputed LUTs replace
+  the previous ones outright.
+
+The distance is the total variation between normalized histograms, in [0, 1].
+
+The reused LUTs are applied with ``clahe.apply_luts``, so like the cached
+tile histograms this only pays off where ``engine.reuses_tile_histograms``:
+on OpenCV, ``cv2.CLAHE`` and ``cv2.equalizeHist`` on every frame are faster.
+"""
+import numpy as np
+
+import clahe
+import engine
+
+
+DEFAULT_THRESHOLD = 0.04
+DEFAULT_CUT_THRESHOLD = 0.35
+DEFAULT_BLEND = 0.5
+DEFAULT_SAMPLE_STEP = 4
+
+
+def sampled_histogram(plane, step=DEFAULT_SAMPLE_STEP):
+  """Normalized 256-bin histogram of every ``step``-th pixel in both directions"""
+  hist = np.bincount(plane[::step, ::step].ravel(), minlength=clahe.HIST_SIZE).astype(np.float32)
+  return hist / max(hist.sum(), 1.0)
+
+
+def histogram_distance(hist_a, hist_b):
+  return float(np.abs(hist_a - hist_b).sum()) * 0.5
+
+
+class TemporalEqualizer:
+  """Equalizes the frames of one video, reusing LUTs while the content stays similar"""
+
+  def __init__(self, method=engine.METHOD_CLAHE, clip_limit=engine.DEFAULT_CLIP_LIMIT, tile_grid=engine.DEFAULT_TILE_GRID,
+               threshold=DEFAULT_THRESHOLD, cut_threshold=DEFAULT_CUT_THRESHOLD, blend=DEFAULT_BLEND, sample_step=DEFAULT_SAMPLE_STEP):
+    if method not in engine.METHODS:
+      raise ValueError(f"Unknown equalization method: {method!r}, expected one of {engine.METHODS}")
+    self.method = method
+    self.clip_limit = clip_limit
+    self.tile_grid = engine.normalize_tile_grid(tile_grid)
+    self.threshold = threshold
+    self.cut_threshold = cut_threshold
+    self.blend = blend
+    self.sample_step = sample_step
+    self.reset()
+
+  def reset(self):
+    self._luts = None
+    self._tile_size = None
+    self._shape = None
+    self._reference_hist = None
+    self.frames = 0
+    self.recomputed = 0
+    self.reused = 0
+    self.cuts = 0
+
+  def _compute_luts(self, plane):
+    """Float32 LUTs of the plane: ``(tiles_y, tiles_x, 256)`` for CLAHE, ``(256,)`` otherwise"""
+    if self.method == engine.METHOD_EQUALIZE:
+      hist = np.bincount(plane.ravel(), minlength=clahe.HIST_SIZE)
+      return clahe.equalize_hist_lut(hist).astype(np.float32), None
+    hists, tile_size = clahe.tile_histograms(plane, self.tile_grid)
+    tile_area = tile_size[0] * tile_size[1]
+    luts = clahe.compute_luts(hists, clahe.clip_limit_to_count(self.clip_limit, tile_area), tile_area)
+    return luts.astype(np.float32), tile_size
+
+  def _update(self, plane, hist):
+    distance = None if self._reference_hist is None else histogram_distance(hist, self._reference_hist)
+    if distance is not None and plane.shape == self._shape and distance <= self.threshold:
+      self.reused += 1
+      return
+
+    luts, tile_size = self._compute_luts(plane)
+    self.recomputed += 1
+    if distance is None or plane.shape != self._shape or distance > self.cut_threshold:
+      if distance is not None:
+        self.cuts += 1
+      self._luts = luts
+    else:
+      self._luts += (luts - self._luts) * np.float32(self.blend)
+    self._tile_size = tile_size
+    self._shape = plane.shape
+    self._reference_hist = hist
+
+  def apply(self, plane):
+    """Equalize one uint8 frame plane"""
+    self.frames += 1
+    self._update(plane, sampled_histogram(plane, self.sample_step))
+    if self.method == engine.METHOD_EQUALIZE:
+      return np.rint(self._luts).astype(np.uint8).take(plane)
+    return clahe.apply_luts(plane, self._luts, self._tile_size)
+
+  __call__ = apply
+
+  def stats(self):
+    return {
+      'frames': self.frames,
+      'recomputed': self.recomputed,
+      'reused': self.reused,
+      'cuts': self.cuts,
+    }
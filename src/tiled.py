@@ -0,0 +1,225 @@
+"""Out-of-core equalization of gigapixel images stored as ``np.memmap``.
+
+The whole-frame path makes several full-size copies of the image, which
+doesn't work for slide and aerial images far larger than memory. Here the
+input and output are memory-mapped and processed block by block, so peak
+memory is bounded by the block size instead of the image size:
+
+* global equalization runs in two passes: the luminance histogram is
+  accumulated over all blocks, then the LUT is applied block by block;
+* CLAHE accumulates the per-tile histograms of the whole image over all
+  blocks first (with OpenCV's REFLECT_101 extension at the bottom/right
+  edge), derives the LUT grid once, then interpolates every block against
+  that global grid. Blocks therefore need no overlap and there are no seams:
+  the output is identical to ``clahe.IncrementalClahe`` on the whole plane.
+
+Blocks go through the engine's color conversions, so in gray mode the output
+is a single-channel plane and in lightness mode (any of
+``engine.LIGHTNESS_SPACES``) it has the same channels as the input, with
+alpha copied through, as ``engine.enhance_planes`` would give it.
+
+uint16 images keep their bit depth: ``bits`` or, by default, that of the
+largest color value, found in an extra pass. For CLAHE the luminance
+histogram of the whole image gives the step between its levels and their
+histogram bins (see ``clahe.level_layout``), as the whole-plane path takes
+them from the whole plane.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import clahe
+import engine
+
+
+DEFAULT_BLOCK_SIZE = (1024, 1024)
+
+
+def iter_blocks(shape, block_size=DEFAULT_BLOCK_SIZE):
+  """Yield ``(r0, r1, c0, c1)`` blocks covering a ``(height, width)`` area row by row"""
+  height, width = shape[:2]
+  block_h, block_w = block_size
+  for r0 in range(0, height, block_h):
+    for c0 in range(0, width, block_w):
+      yield r0, min(r0 + block_h, height), c0, min(c0 + block_w, width)
+
+
+def reflect_101(indices, length):
+  """Map indices past the end of an axis back inside it like ``BORDER_REFLECT_101``"""
+  return np.where(indices < length, indices, 2 * (length - 1) - indices)
+
+
+def read_block(src, r0, r1, c0, c1):
+  """Read a block of ``src`` given in extended coordinates, reflecting what lies past the edges"""
+  height, width = src.shape[:2]
+  if r1 <= height and c1 <= width:
+    return np.asarray(src[r0:r1, c0:c1])
+  rows = reflect_101(np.arange(r0, r1), height)
+  cols = reflect_101(np.arange(c0, c1), width)
+  return np.asarray(src[np.ix_(rows, cols)])
+
+
+def as_rgba(block):
+  """An RGB or RGBA block as the RGBA frame the engine converts, opaque if it has no alpha"""
+  if block.shape[2] == 4:
+    return np.ascontiguousarray(block)
+  rgba = np.empty(block.shape[:2] + (4,), dtype=block.dtype)
+  rgba[:, :, :3] = block
+  rgba[:, :, 3] = np.iinfo(block.dtype).max
+  return rgba
+
+
+def luminance(block, lab=False, bits=None):
+  """The plane that gets equalized: the block itself if single-channel, else gray or the lightness of ``lab``"""
+  if block.ndim == 2:
+    return block
+  return engine.luminance_plane(engine.to_planes(as_rgba(block), lab, bits), lab)
+
+
+def output_shape(src_shape, lab=False):
+  if lab and len(src_shape) == 3:
+    return tuple(src_shape)
+  return tuple(src_shape[:2])
+
+
+def source_bits(src, bits=None, block_size=DEFAULT_BLOCK_SIZE):
+  """Bit depth of ``src``: 8 for uint8, else ``bits`` or that of the largest color value of all blocks"""
+  if src.dtype == np.uint8:
+    return 8
+  if bits:
+    return int(bits)
+  return max(engine.color_bits(np.asarray(src[r0:r1, c0:c1])) for r0, r1, c0, c1 in iter_blocks(src.shape, block_size))
+
+
+def luminance_histogram(src, lab=False, bits=None, block_size=DEFAULT_BLOCK_SIZE):
+  """Histogram of the luminance of the whole image, one bin per value"""
+  hist = np.zeros(np.iinfo(src.dtype).max + 1, dtype=np.int64)
+  for r0, r1, c0, c1 in iter_blocks(src.shape, block_size):
+    hist += clahe.value_histogram(luminance(np.asarray(src[r0:r1, c0:c1]), lab, bits))
+  return hist
+
+
+def global_lut(src, lab=False, bits=8, block_size=DEFAULT_BLOCK_SIZE):
+  """First pass of global equalization: the LUT of the whole image's luminance histogram"""
+  return clahe.equalize_hist_lut(luminance_histogram(src, lab, bits, block_size), (1 << bits) - 1, src.dtype)
+
+
+def level_layout(src, lab=False, bits=8, block_size=DEFAULT_BLOCK_SIZE):
+  """``(step, levels, bin_shift)`` of the luminance levels of the whole image, as ``clahe.IncrementalClahe`` has them"""
+  if src.dtype == np.uint8:
+    return 1, clahe.HIST_SIZE, 0
+  return clahe.level_layout(luminance_histogram(src, lab, bits, block_size), bits)
+
+
+def clahe_luts(src, clip_limit, tile_grid, lab=False, bits=8, layout=(1, clahe.HIST_SIZE, 0),
+               block_size=DEFAULT_BLOCK_SIZE):
+  """First pass of CLAHE: the LUT grid from the tile histograms of the whole image.
+
+  ``layout`` is the ``level_layout`` of the image. Returns ``(luts, tile_size)``
+  as used by ``clahe.apply_luts``.
+  """
+  step, levels, bin_shift = layout
+  hist_size = ((levels - 1) >> bin_shift) + 1
+  tiles_x, tiles_y = tile_grid
+  ext_shape, tile_size = clahe.tile_layout(src.shape[:2], tile_grid)
+  hists = np.zeros((tiles_y, tiles_x, hist_size), dtype=np.int64)
+  for r0, r1, c0, c1 in iter_blocks(ext_shape, block_size):
+    block = clahe.to_levels(luminance(read_block(src, r0, r1, c0, c1), lab, bits), bits, step)
+    if bin_shift:
+      block = block >> bin_shift
+    clahe.accumulate_tile_histograms(hists, block, tile_size, origin=(r0, c0))
+  tile_area = tile_size[0] * tile_size[1]
+  luts = clahe.compute_luts(hists, clahe.clip_limit_to_count(clip_limit, tile_area, hist_size), tile_area,
+                            (1 << bits) - 1, src.dtype)
+  return luts, tile_size
+
+
+def equalize_tiled(src, dst, lab=False, method=engine.METHOD_CLAHE, clip_limit=engine.DEFAULT_CLIP_LIMIT,
+                   tile_grid=engine.DEFAULT_TILE_GRID, block_size=DEFAULT_BLOCK_SIZE, bits=None):
+  """Equalize ``src`` (``(H, W)``, ``(H, W, 3)`` RGB or ``(H, W, 4)`` RGBA, uint8 or uint16) into ``dst`` block by block.
+
+  Both are typically ``np.memmap`` arrays; ``dst`` must have ``output_shape(src.shape, lab)``
+  and the sample type of ``src``. ``bits`` is the bit depth of uint16 data.
+  """
+  if src.dtype not in (np.uint8, np.uint16):
+    raise ValueError(f"Unsupported sample type {src.dtype}, expected uint8 or uint16")
+  lab = lab if src.ndim == 3 else False
+  if dst.shape != output_shape(src.shape, lab) or dst.dtype != src.dtype:
+    raise ValueError(f"Expected {src.dtype} output of shape {output_shape(src.shape, lab)}, "
+                     f"got {dst.dtype} of shape {dst.shape}")
+  bits = source_bits(src, bits, block_size)
+  if method == engine.METHOD_EQUALIZE:
+    lut = global_lut(src, lab, bits, block_size)
+
+    def equalize(plane, origin):
+      return lut.take(plane)
+  elif method == engine.METHOD_CLAHE:
+    layout = level_layout(src, lab, bits, block_size)
+    luts, tile_size = clahe_luts(src, clip_limit, engine.normalize_tile_grid(tile_grid), lab, bits, layout, block_size)
+    step, levels, bin_shift = layout
+
+    def equalize(plane, origin):
+      return clahe.apply_luts(clahe.to_levels(plane, bits, step), luts, tile_size, origin=origin, bin_shift=bin_shift,
+                              levels=levels)
+  else:
+    raise ValueError(f"Unknown equalization method: {method!r}, expected one of {engine.METHODS}")
+
+  last_row = 0
+  for r0, r1, c0, c1 in iter_blocks(src.shape, block_size):
+    block = np.asarray(src[r0:r1, c0:c1])
+    if not lab:
+      dst[r0:r1, c0:c1] = equalize(luminance(block, bits=bits), (r0, c0))
+    else:
+      rgba = as_rgba(block)
+      planes = engine.to_planes(rgba, lab, bits)
+      out = engine.compose(equalize(engine.luminance_plane(planes, lab), (r0, c0)), planes, rgba[:, :, 3], lab,
+                           bits=bits)
+      dst[r0:r1, c0:c1] = out[:, :, :block.shape[2]]
+    if r0 != last_row and hasattr(dst, 'flush'):
+      # Write finished block rows back so dirty pages don't pile up
+      dst.flush()
+      last_row = r0
+  if hasattr(dst, 'flush'):
+    dst.flush()
+  return dst
+
+
+def equalize_npy(src_path, dst_path, block_size=DEFAULT_BLOCK_SIZE, **params):
+  """Equalize a ``.npy`` image into a new ``.npy`` file of the same sample type, both memory-mapped"""
+  src = np.load(src_path, mmap_mode='r')
+  lab = params.get('lab', False) and src.ndim == 3
+  dst = np.lib.format.open_memmap(dst_path, mode='w+', dtype=src.dtype, shape=output_shape(src.shape, lab))
+  return equalize_tiled(src, dst, block_size=block_size, **params)
+
+
+def build_parser():
+  parser = argparse.ArgumentParser(description="Apply histogram equalization / CLAHE to a .npy image larger than "
+                                               "memory, block by block")
+  parser.add_argument('input', help="source image: (H, W), (H, W, 3) RGB or (H, W, 4) RGBA uint8 or uint16 .npy file")
+  parser.add_argument('output', help="enhanced .npy file, written block by block")
+  parser.add_argument('--lab', nargs='?', const=engine.LIGHTNESS_LAB, default=False, choices=engine.LIGHTNESS_SPACES,
+                      help="equalize lightness only and keep colors, in LAB or the given space (default: grayscale)")
+  parser.add_argument('--method', choices=engine.METHODS, default=engine.METHOD_CLAHE, help="equalization method")
+  parser.add_argument('--clip-limit', type=float, default=engine.DEFAULT_CLIP_LIMIT, help="CLAHE clip limit")
+  parser.add_argument('--tile-grid', type=int, default=engine.DEFAULT_TILE_GRID[0], help="CLAHE tiles per side")
+  parser.add_argument('--bits', type=int, default=None, choices=range(8, 17), metavar='{8..16}',
+                      help="bit depth of the data in uint16 images, e.g. 12 (default: from the largest value)")
+  parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE[0],
+                      help="side of the blocks processed at once, bounds memory use")
+  return parser
+
+
+def main(argv=None):
+  args = build_parser().parse_args(argv)
+  start = time.perf_counter()
+  dst = equalize_npy(args.input, args.output, block_size=(args.block_size, args.block_size), lab=args.lab,
+                     method=args.method, clip_limit=args.clip_limit,
+                     tile_grid=engine.normalize_tile_grid(args.tile_grid), bits=args.bits)
+  print(f"Wrote {'x'.join(map(str, dst.shape))} {dst.dtype} to {args.output} in {time.perf_counter() - start:.1f}s")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,174 @@
+"""Video frame URLs, per-video strategy memo and a ring-buffer frame prefetcher.
+
+Video frames are loaded from preview URLs such as
+``.../videoframe/33p/1/174515916?...``. Which variant of the URL actually
+serves the requested frame (1- or 0-indexed frame number, resized or full
+resolution) depends on the server, so candidates are tried in order. The
+strategy that worked is remembered per video, so later frames go straight to
+it, and frames around the current one are fetched and decoded ahead of time.
+
+Nothing here touches the DOM: loading a URL is done by an injected async
+callable, which makes the module usable against a local HTTP stand-in.
+"""
+import asyncio
+import re
+from collections import OrderedDict
+
+
+FRAME_PATTERN = r'videoframe/([^/]+)/(\d+)/'
+RESIZE_PATTERN = r'/resize:fill:\d+:\d+:\d+'
+
+DEFAULT_PREFETCH_AHEAD = 4
+DEFAULT_PREFETCH_BEHIND = 1
+DEFAULT_RING_CAPACITY = 8
+
+
+def build_frame_urls(preview_url, frame, width, height):
+  """Return the ``(strategy, url)`` candidates for ``frame``, best first"""
+  candidates = []
+  url_high_res = preview_url.replace('resize:fill:150:0:0', f'resize:fill:{width}:{height}:0')
+  match = re.search(FRAME_PATTERN, preview_url)
+  if match:
+    quality = match.group(1)
+    url_high_1indexed = re.sub(FRAME_PATTERN, f'videoframe/{quality}/{frame + 1}/', url_high_res)
+    url_high_0indexed = re.sub(FRAME_PATTERN, f'videoframe/{quality}/{frame}/', url_high_res)
+    candidates.append(("high_res_1indexed", url_high_1indexed))
+    candidates.append(("high_res_0indexed", url_high_0indexed))
+    # Full resolution with the same frame numbers (resize removed)
+    candidates.append(("full_res_1indexed", re.sub(RESIZE_PATTERN, '', url_high_1indexed)))
+    candidates.append(("full_res_0indexed", re.sub(RESIZE_PATTERN, '', url_high_0indexed)))
+  else:
+    candidates.append(("high_resolution", url_high_res))
+  # Last resort, always the same low-res frame
+  candidates.append(("original_low_res_fallback", preview_url))
+  return candidates
+
+
+class StrategyMemo:
+  """Remembers which URL strategy served frames of each video"""
+
+  def __init__(self):
+    self._winners = {}
+
+  def get(self, key):
+    return self._winners.get(key)
+
+  def remember(self, key, strategy):
+    self._winners[key] = strategy
+
+  def forget(self, key):
+    self._winners.pop(key, None)
+
+  def order(self, key, candidates):
+    """Move the remembered strategy of ``key`` to the front of ``candidates``"""
+    winner = self._winners.get(key)
+    if winner is None:
+      return list(candidates)
+    return sorted(candidates, key=lambda candidate: candidate[0] != winner)
+
+
+async def load_first(candidates, load_url):
+  """Try ``await load_url(url)`` for each candidate until one returns something other than None.
+
+  Returns ``(strategy, result)``, or ``(None, None)`` if every candidate failed.
+  """
+  for strategy, url in candidates:
+    try:
+      result = await load_url(url)
+    except Exception:
+      result = None
+    if result is not None:
+      return strategy, result
+  return None, None
+
+
+class FrameLoader:
+  """Loads frames of one video, trying the memoized strategy first"""
+
+  def __init__(self, memo, memo_key, preview_url, width, height, load_url):
+    self.memo = memo
+    self.memo_key = memo_key
+    self.preview_url = preview_url
+    self.width = width
+    self.height = height
+    self._load_url = load_url
+    self.attempts = 0
+
+  async def __call__(self, frame):
+    candidates = self.memo.order(self.memo_key, build_frame_urls(self.preview_url, frame, self.width, self.height))
+
+    async def load_url(url):
+      self.attempts += 1
+      return await self._load_url(url)
+
+    strategy, result = await load_first(candidates, load_url)
+    if strategy is None:
+      self.memo.forget(self.memo_key)
+    elif strategy != 'original_low_res_fallback':
+      # The fallback ignores the frame number, never make it the default
+      self.memo.remember(self.memo_key, strategy)
+    return result
+
+
+class FramePrefetcher:
+  """Bounded ring buffer of frame load tasks around the current frame"""
+
+  def __init__(self, load_frame, capacity=DEFAULT_RING_CAPACITY, ahead=DEFAULT_PREFETCH_AHEAD, behind=DEFAULT_PREFETCH_BEHIND):
+    self._load_frame = load_frame
+    self.capacity = max(capacity, ahead + behind + 1)
+    self.ahead = ahead
+    self.behind = behind
+    self._tasks = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def _task(self, frame):
+    task = self._tasks.get(frame)
+    if task is None:
+      task = asyncio.ensure_future(self._load_frame(frame))
+      self._tasks[frame] = task
+      while len(self._tasks) > self.capacity:
+        _, old = self._tasks.popitem(last=False)
+        if not old.done():
+          old.cancel()
+    else:
+      self._tasks.move_to_end(frame)
+    return task
+
+  def prefetch_around(self, frame, frames_count=None):
+    """Start loading the frames in ``[frame - behind, frame + ahead]`` that aren't buffered yet"""
+    last = frame + self.ahead
+    if frames_count is not None:
+      last = min(last, frames_count - 1)
+    for neighbour in range(max(frame - self.behind, 0), last + 1):
+      if neighbour != frame:
+        self._task(neighbour)
+
+  async def get(self, frame, frames_count=None):
+    """Return the loaded ``frame`` (None if it failed), then prefetch its neighbours"""
+    if frame in self._tasks:
+      self.hits += 1
+    else:
+      self.misses += 1
+    task = self._task(frame)
+    try:
+      result = await asyncio.shield(task)
+    except asyncio.CancelledError:
+      # Evicted while we were waiting, load it again
+      self._tasks.pop(frame, None)
+      result = await self._task(frame)
+    # Neighbours start after the current frame, so they already use the memoized strategy
+    self.prefetch_around(frame, frames_count)
+    return result
+
+  def clear(self):
+    for task in self._tasks.values():
+      if not task.done():
+        task.cancel()
+    self._tasks.clear()
+
+  def __contains__(self, frame):
+    return frame in self._tasks
+
+  def __len__(self):
+    return len(self._tasks)
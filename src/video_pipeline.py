@@ -0,0 +1,225 @@
+"""Streaming enhancement of video files.
+
+Frames are read with ``cv2.VideoCapture``, enhanced by the engine with the
+same modes as the app and the batch CLI (gray or any lightness space, on
+either backend) and written with ``cv2.VideoWriter``. Decode, process and encode run
+in their own threads connected by bounded queues, so the stages overlap
+(OpenCV releases the GIL) and memory stays constant regardless of video
+length. Each stage records how long it was busy, which tells whether decode,
+the filter or encode is the bottleneck.
+"""
+import argparse
+import queue
+import sys
+import threading
+import time
+
+import cv2
+
+import engine
+from temporal import TemporalEqualizer
+
+
+DEFAULT_QUEUE_SIZE = 8
+DEFAULT_FOURCC = 'mp4v'
+# How often blocked queue operations wake up to check for a failed stage
+POLL_SECONDS = 0.1
+
+_END = object()
+
+
+class StageStats:
+  """Frames handled and busy time of one pipeline stage"""
+
+  def __init__(self, name):
+    self.name = name
+    self.frames = 0
+    self.busy = 0.0
+
+  @property
+  def fps(self):
+    return self.frames / self.busy if self.busy > 0 else 0.0
+
+  def as_dict(self):
+    return {'frames': self.frames, 'busy_seconds': self.busy, 'fps': self.fps}
+
+
+def enhance_bgr(frame, lab=False, method=engine.METHOD_CLAHE, clip_limit=engine.DEFAULT_CLIP_LIMIT,
+                tile_grid=engine.DEFAULT_TILE_GRID, equalizer=None):
+  """Enhance one BGR frame as read by ``cv2.VideoCapture`` like ``engine.enhance`` and return a BGR frame"""
+  rgba = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
+  enhanced = engine.enhance_planes(engine.to_planes(rgba, lab), rgba[:, :, 3], lab, method, clip_limit, tile_grid,
+                                   equalizer=equalizer)
+  return cv2.cvtColor(enhanced, cv2.COLOR_RGBA2BGR)
+
+
+class VideoPipeline:
+  """Decode -> process -> encode over bounded queues, one thread per stage"""
+
+  def __init__(self, src_path, dst_path, params, start=0, end=None, temporal=False,
+               queue_size=DEFAULT_QUEUE_SIZE, fourcc=DEFAULT_FOURCC):
+    self.src_path = src_path
+    self.dst_path = dst_path
+    self.params = params
+    self.start = max(int(start), 0)
+    self.end = end
+    self.equalizer = None
+    if temporal:
+      self.equalizer = TemporalEqualizer(params.get('method', engine.METHOD_CLAHE),
+                                         params.get('clip_limit', engine.DEFAULT_CLIP_LIMIT),
+                                         params.get('tile_grid', engine.DEFAULT_TILE_GRID))
+    self.queue_size = queue_size
+    self.fourcc = fourcc
+    self.stats = {name: StageStats(name) for name in ('decode', 'process', 'encode')}
+    self._stop = threading.Event()
+    self._errors = []
+
+  def _put(self, q, item):
+    while not self._stop.is_set():
+      try:
+        q.put(item, timeout=POLL_SECONDS)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def _get(self, q):
+    while not self._stop.is_set():
+      try:
+        return q.get(timeout=POLL_SECONDS)
+      except queue.Empty:
+        pass
+    return _END
+
+  def _run_stage(self, target, *args):
+    try:
+      target(*args)
+    except BaseException as e:
+      self._errors.append(e)
+      self._stop.set()
+
+  def _decode(self, cap, out_q):
+    stats = self.stats['decode']
+    index = self.start
+    while self.end is None or index < self.end:
+      t = time.perf_counter()
+      ok, frame = cap.read()
+      stats.busy += time.perf_counter() - t
+      if not ok:
+        break
+      stats.frames += 1
+      index += 1
+      if not self._put(out_q, frame):
+        return
+    self._put(out_q, _END)
+
+  def _process(self, in_q, out_q):
+    stats = self.stats['process']
+    while True:
+      frame = self._get(in_q)
+      if frame is _END:
+        break
+      t = time.perf_counter()
+      frame = enhance_bgr(frame, equalizer=self.equalizer, **self.params)
+      stats.busy += time.perf_counter() - t
+      stats.frames += 1
+      if not self._put(out_q, frame):
+        return
+    self._put(out_q, _END)
+
+  def _encode(self, writer, in_q):
+    stats = self.stats['encode']
+    while True:
+      frame = self._get(in_q)
+      if frame is _END:
+        break
+      t = time.perf_counter()
+      writer.write(frame)
+      stats.busy += time.perf_counter() - t
+      stats.frames += 1
+
+  def run(self):
+    """Run the pipeline to completion and return a summary dict with per-stage throughput"""
+    cap = cv2.VideoCapture(self.src_path)
+    if not cap.isOpened():
+      raise ValueError(f"Could not open video: {self.src_path}")
+    writer = None
+    try:
+      fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+      size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+      if self.start:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+      writer = cv2.VideoWriter(self.dst_path, cv2.VideoWriter_fourcc(*self.fourcc), fps, size)
+      if not writer.isOpened():
+        raise ValueError(f"Could not open video writer: {self.dst_path}")
+
+      decoded_q = queue.Queue(maxsize=self.queue_size)
+      processed_q = queue.Queue(maxsize=self.queue_size)
+      threads = [
+        threading.Thread(target=self._run_stage, args=(self._decode, cap, decoded_q), name='decode'),
+        threading.Thread(target=self._run_stage, args=(self._process, decoded_q, processed_q), name='process'),
+        threading.Thread(target=self._run_stage, args=(self._encode, writer, processed_q), name='encode'),
+      ]
+      start = time.perf_counter()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      seconds = time.perf_counter() - start
+    finally:
+      cap.release()
+      if writer is not None:
+        writer.release()
+
+    if self._errors:
+      raise self._errors[0]
+    frames = self.stats['encode'].frames
+    summary = {
+      'frames': frames,
+      'seconds': seconds,
+      'fps': frames / seconds if seconds > 0 else 0.0,
+      'stages': {name: stats.as_dict() for name, stats in self.stats.items()},
+      'bottleneck': max(self.stats.values(), key=lambda stats: stats.busy).name,
+    }
+    if self.equalizer is not None:
+      summary['temporal'] = self.equalizer.stats()
+    return summary
+
+
+def build_parser():
+  parser = argparse.ArgumentParser(description="Apply histogram equalization / CLAHE to a video file")
+  parser.add_argument('input', help="source video file")
+  parser.add_argument('output', help="enhanced video file")
+  parser.add_argument('--space', choices=engine.LIGHTNESS_SPACES, default=None,
+                      help="equalize lightness only and keep colors, in the given space (default: grayscale)")
+  parser.add_argument('--method', choices=engine.METHODS, default=engine.METHOD_CLAHE, help="equalization method")
+  parser.add_argument('--clip-limit', type=float, default=engine.DEFAULT_CLIP_LIMIT, help="CLAHE clip limit")
+  parser.add_argument('--tile-grid', type=int, default=engine.DEFAULT_TILE_GRID[0], help="CLAHE tiles per side")
+  parser.add_argument('--start', type=int, default=0, help="first frame to process")
+  parser.add_argument('--end', type=int, default=None, help="frame to stop before (default: end of video)")
+  parser.add_argument('--temporal', action='store_true', help="reuse LUTs across similar frames (less flicker)")
+  parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help="frames buffered between stages")
+  parser.add_argument('--fourcc', default=DEFAULT_FOURCC, help="output codec")
+  return parser
+
+
+def main(argv=None):
+  args = build_parser().parse_args(argv)
+  params = {
+    'lab': args.space or False,
+    'method': args.method,
+    'clip_limit': args.clip_limit,
+    'tile_grid': engine.normalize_tile_grid(args.tile_grid),
+  }
+  pipeline = VideoPipeline(args.input, args.output, params, start=args.start, end=args.end, temporal=args.temporal,
+                           queue_size=args.queue_size, fourcc=args.fourcc)
+  summary = pipeline.run()
+  print(f"Processed {summary['frames']} frames in {summary['seconds']:.1f}s: {summary['fps']:.1f} fps")
+  for name, stage in summary['stages'].items():
+    print(f"  {name:<8} {stage['frames']:>7} frames  {stage['busy_seconds']:8.2f}s busy  {stage['fps']:8.1f} fps")
+  print(f"  bottleneck: {summary['bottleneck']}")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
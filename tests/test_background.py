@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import background
+import bench
+import clahe
+import engine
+from pixel_cache import PixelCache
+
+
+@pytest.fixture
+def frame():
+  return bench.synthetic_frame(241, 317)
+
+
+def read_rows_of(frame, calls):
+  def read_rows(r0, r1):
+    calls.append((r0, r1))
+    return frame[r0:r1].copy()
+  return read_rows
+
+
+@pytest.mark.parametrize('lab', [False] + list(engine.LIGHTNESS_SPACES))
+@pytest.mark.parametrize('method', engine.METHODS)
+def test_banded_result_matches_render_path(frame, lab, method):
+  cache = PixelCache()
+  calls = []
+  steps = background.load_and_enhance(cache, 'key', frame.shape[:2], read_rows_of(frame, calls), lab, method, 2.0,
+                                      (8, 8), band_rows=64)
+  yields = 0
+  while True:
+    try:
+      next(steps)
+      yields += 1
+    except StopIteration as done:
+      result = done.value
+      break
+
+  # Readback, conversion, histograms and equalization each take one step per band
+  assert calls == [(0, 64), (64, 128), (128, 192), (192, 241)]
+  assert yields >= 4 * len(calls)
+  # The render path with the tile histograms of the pixel cache
+  planes = engine.to_planes(frame, lab)
+  state = clahe.IncrementalClahe(engine.luminance_plane(planes, lab), (8, 8))
+  expected = engine.enhance_planes(planes, frame[:, :, 3], lab, method, 2.0, (8, 8), clahe_state=state)
+  assert np.array_equal(result, expected)
+
+  # The planes and tile histograms are left in the pixel cache for the render path
+  entry = cache.get('key')
+  assert cache.has_planes(entry, lab)
+  assert cache.has_clahe_state(entry, lab, (8, 8)) == (method == engine.METHOD_CLAHE)
+
+
+def test_cached_entry_skips_readback(frame):
+  cache = PixelCache()
+  cache.put('key', frame)
+  calls = []
+  steps = background.load_and_enhance(cache, 'key', frame.shape[:2], read_rows_of(frame, calls), True,
+                                      engine.METHOD_CLAHE, 2.0, (8, 8))
+  clahe.run_bands(steps)
+  assert calls == []
+
+
+def test_entry_evicted_mid_job_is_not_accounted(frame):
+  cache = PixelCache(max_bytes=2 * frame.nbytes)
+  steps = background.load_and_enhance(cache, 'key', frame.shape[:2], read_rows_of(frame, []), True,
+                                      engine.METHOD_CLAHE, 2.0, (8, 8), band_rows=64)
+  # Read back the frame, then let a foreground render push it out of the cache
+  for _ in range(5):
+    next(steps)
+  cache.put('other', frame.copy())
+  cache.put('third', frame.copy())
+  assert 'key' not in cache
+  result = clahe.run_bands(steps)
+
+  # The planes and histograms of the evicted entry don't count toward the budget
+  assert cache.nbytes == sum(cache.get(key).nbytes for key in ('other', 'third'))
+  assert cache.nbytes == 2 * frame.nbytes
+  assert cache.evictions == 1
+  assert result.shape == frame.shape
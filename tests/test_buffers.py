@@ -0,0 +1,73 @@
+import tracemalloc
+
+import pytest
+
+import bench
+import buffers
+import clahe
+import engine
+
+
+def peak_bytes(fn):
+  tracemalloc.start()
+  try:
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    fn()
+    return tracemalloc.get_traced_memory()[1] - before
+  finally:
+    tracemalloc.stop()
+
+
+@pytest.fixture(params=engine.BACKENDS)
+def backend(request):
+  if request.param == engine.BACKEND_OPENCV:
+    pytest.importorskip('cv2')
+  previous = engine.get_backend()
+  engine.set_backend(request.param)
+  yield request.param
+  engine.set_backend(previous)
+
+
+# Cached tile histograms only exist for CLAHE on the NumPy backend, the one ``engine.reuses_tile_histograms`` for uint8
+PEAK_CASES = [(backend, method, clahe_state) for backend in engine.BACKENDS for method in engine.METHODS
+              for clahe_state in (False, True)
+              if not clahe_state or (method == engine.METHOD_CLAHE and backend == engine.BACKEND_NUMPY)]
+
+
+@pytest.mark.parametrize('shape, tile_grid', [((480, 640), (8, 8)), ((241, 317), (3, 5))])
+@pytest.mark.parametrize('lab', [False] + list(engine.LIGHTNESS_SPACES))
+@pytest.mark.parametrize('backend, method, clahe_state', PEAK_CASES, indirect=['backend'])
+def test_peak_matches_transient_bytes(backend, shape, tile_grid, lab, method, clahe_state):
+  assert not clahe_state or engine.reuses_tile_histograms()
+  height, width = shape
+  frame = bench.synthetic_frame(height, width)
+  # What the pixel cache and the buffer pool already hold before the call
+  planes = engine.to_planes(frame, lab)
+  state = clahe.IncrementalClahe(engine.luminance_plane(planes, lab), tile_grid) if clahe_state else None
+  out = buffers.RgbaBufferPool().get(height, width)
+
+  peak = peak_bytes(lambda: engine.enhance_planes(planes, frame[:, :, 3], lab, method, tile_grid=tile_grid,
+                                                  clahe_state=state, out=out))
+  bound = buffers.transient_bytes(height, width, lab, method=method, tile_grid=tile_grid, clahe_state=clahe_state)
+  assert peak <= bound
+  # The documented figures are close to what actually gets allocated
+  assert peak >= 0.5 * bound
+
+
+def test_restore_allocates_nothing():
+  frame = bench.synthetic_frame(64, 96)
+  assert buffers.transient_bytes(64, 96, restore=True) == 0
+  # Only the header of the flat view
+  assert peak_bytes(lambda: frame.reshape(-1)) < 1024
+
+
+def test_pool_reuses_buffers_per_resolution():
+  pool = buffers.RgbaBufferPool(max_size=2)
+  first = pool.get(10, 20)
+  assert pool.get(10, 20) is first
+  pool.get(30, 40)
+  pool.get(50, 60)
+  assert pool.get(10, 20) is not first
+  assert pool.allocations == 4
+  assert pool.nbytes == (50 * 60 + 10 * 20) * 4
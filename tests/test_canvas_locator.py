@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+from canvas_locator import CanvasPathCache
+
+
+class Canvas:
+  def __init__(self, width=640, height=360):
+    self.width = width
+    self.height = height
+
+  def getContext(self, kind):
+    return kind
+
+
+class Clock:
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+def keys(obj):
+  return list(vars(obj))
+
+
+def make_store(player=None):
+  videos = SimpleNamespace(all=SimpleNamespace())
+  if player is not None:
+    videos.player = player
+  return SimpleNamespace(videos=videos)
+
+
+def locate(cache, store, video=None):
+  video = video or SimpleNamespace(frames=SimpleNamespace())
+  return cache.locate({'store': store, 'video': video}, 7, video, 0, keys)
+
+
+def test_found_path_is_followed_without_searching_again():
+  canvas = Canvas()
+  store = make_store(SimpleNamespace(canvas=canvas))
+  cache = CanvasPathCache()
+  assert locate(cache, store) is canvas
+  assert (cache.hits, cache.misses) == (0, 1)
+  assert locate(cache, store) is canvas
+  assert (cache.hits, cache.misses) == (1, 1)
+  # A resized canvas no longer validates and triggers a new search
+  store.videos.player.canvas = Canvas(1280, 720)
+  assert locate(cache, store) is store.videos.player.canvas
+  assert cache.misses == 2
+
+
+def test_not_found_expires_after_retry_calls():
+  store = make_store()
+  cache = CanvasPathCache(retry_calls=3, retry_seconds=60.0, clock=Clock())
+  assert locate(cache, store) is None
+  store.videos.player = SimpleNamespace(canvas=Canvas())
+  # The player mounted its canvas, but the negative entry holds for three calls
+  assert [locate(cache, store) for _ in range(3)] == [None, None, None]
+  assert locate(cache, store) is store.videos.player.canvas
+
+
+def test_not_found_expires_after_retry_seconds():
+  store = make_store()
+  clock = Clock()
+  cache = CanvasPathCache(retry_calls=100, retry_seconds=5.0, clock=clock)
+  assert locate(cache, store) is None
+  store.videos.player = SimpleNamespace(canvas=Canvas())
+  clock.now = 4.9
+  assert locate(cache, store) is None
+  clock.now = 5.0
+  assert locate(cache, store) is store.videos.player.canvas
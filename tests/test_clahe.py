@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import batch
+import clahe
+import engine
+
+
+def deep_plane(height=600, width=700, bits=16, seed=0):
+  """Smooth uint16 plane using far more than ``1 << clahe.MAX_HIST_BITS`` levels"""
+  rng = np.random.default_rng(seed)
+  y, x = np.mgrid[0:height, 0:width]
+  top = (1 << bits) - 1
+  values = (np.sin(x / 90.0) * np.cos(y / 70.0) * 0.45 + 0.5) * top + rng.normal(0, top / 2000, x.shape)
+  return np.clip(np.rint(values), 0, top).astype(np.uint16)
+
+
+def test_16bit_clahe_keeps_levels_within_bins():
+  plane = deep_plane()
+  state = clahe.IncrementalClahe(plane, (1, 1))
+  assert state.bin_shift > 0
+  out = state.apply(2.0)
+  # One tile, no interpolation: a monotonic mapping that keeps (nearly) every level apart
+  order = np.argsort(plane, axis=None, kind='stable')
+  assert (np.diff(out.ravel()[order].astype(np.int64)) >= 0).all()
+  assert len(np.unique(out)) > 0.8 * len(np.unique(plane))
+  assert len(np.unique(out)) > 4 << clahe.MAX_HIST_BITS
+
+
+def test_16bit_clahe_matches_the_binned_luts_at_bin_ends():
+  plane = deep_plane()
+  state = clahe.IncrementalClahe(plane, (1, 1))
+  lut = state.luts(2.0)[0, 0]
+  out = state.apply(2.0)
+  # The last level of every bin maps to the LUT value of the bin
+  last = ((plane.astype(np.int64) + 1) & ((1 << state.bin_shift) - 1)) == 0
+  assert np.array_equal(out[last], lut[plane[last] >> state.bin_shift])
+
+
+def test_histograms_taken_in_strips():
+  plane = deep_plane(height=3 * clahe.STRIP_ROWS + 5, width=40)
+  assert np.array_equal(clahe.value_histogram(plane), np.bincount(plane.ravel(), minlength=1 << 16))
+  lut = clahe.equalize_hist_lut(np.bincount(plane.ravel(), minlength=1 << 16), (1 << 16) - 1, np.uint16)
+  assert np.array_equal(clahe.equalize_hist(plane, 16), lut.take(plane))
+
+
+@pytest.mark.parametrize('lab', [False, engine.LIGHTNESS_YCRCB, engine.LIGHTNESS_HSV, engine.LIGHTNESS_LUMA])
+@pytest.mark.parametrize('method', engine.METHODS)
+def test_output_stays_within_the_given_bit_depth(lab, method):
+  rgba = np.empty((120, 160, 4), dtype=np.uint16)
+  for c in range(3):
+    rgba[:, :, c] = deep_plane(120, 160, bits=12, seed=c)
+  rgba[:, :, 3] = 65535
+  # A dark 12-bit image whose largest value would suggest 11 bits
+  rgba[:, :, :3] //= 2
+  result = engine.enhance(rgba, lab, method, bits=12)
+  assert result[:, :, :3].max() <= 4095
+  # Equalization spreads the values over all 12 bits, not just 11
+  assert result[:, :, :3].max() > 2047
+  assert engine.to_uint8(result, bits=12)[:, :, :3].max() > 127
+
+
+def test_lab16_stays_within_the_given_bit_depth():
+  pytest.importorskip('cv2')
+  previous = engine.get_backend()
+  engine.set_backend(engine.BACKEND_OPENCV)
+  try:
+    rgba = np.empty((64, 80, 4), dtype=np.uint16)
+    for c in range(3):
+      rgba[:, :, c] = deep_plane(64, 80, bits=12, seed=c)
+    rgba[:, :, 3] = 65535
+    result = engine.enhance(rgba, engine.LIGHTNESS_LAB, bits=12)
+  finally:
+    engine.set_backend(previous)
+  assert 2047 < result[:, :, :3].max() <= 4095
+
+
+def test_to_uint8_saturates_beyond_the_bit_depth():
+  pixels = np.array([[0, 4095, 8000]], dtype=np.uint16)
+  assert engine.to_uint8(pixels, bits=12).tolist() == [[0, 255, 255]]
+
+
+def test_bits_option():
+  args = batch.build_parser().parse_args(['in', 'out', '--bits', '12'])
+  assert args.bits == 12
+  with pytest.raises(SystemExit):
+    batch.build_parser().parse_args(['in', 'out', '--bits', '17'])
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+import bench
+import clahe
+import compare_grid
+import engine
+import preview
+
+
+def cell_at(grid, cells, index, shape):
+  y, x, _, _ = cells[index]
+  return grid[y:y + shape[0], x:x + shape[1]]
+
+
+def deep_frame(height, width, scale, offset):
+  """uint16 frame of the synthetic test image; ``scale`` sets the step between its values"""
+  frame = bench.synthetic_frame(height, width).astype(np.uint16) * np.uint16(scale) + np.uint16(offset)
+  frame[:, :, 3] = 65535
+  return frame
+
+
+@pytest.mark.parametrize('lab', [False] + list(engine.LIGHTNESS_SPACES))
+def test_cells_sample_the_full_resolution_render(lab):
+  frame = bench.synthetic_frame(1100, 900)
+  planes = engine.to_planes(frame, lab)
+  clip_limits, tile_grids = (1.0, 2.5, 6.0), ((8, 8), (3, 5))
+  grid, cells = compare_grid.compare_grid(planes, frame[:, :, 3], lab, clip_limits, tile_grids)
+  step = preview.preview_step(1100, 900)
+  assert step == 3
+  assert [(clip_limit, tile_grid) for _, _, clip_limit, tile_grid in cells] == \
+    [(clip_limit, tile_grid) for tile_grid in tile_grids for clip_limit in clip_limits]
+  for index, (_, _, clip_limit, tile_grid) in enumerate(cells):
+    state = clahe.IncrementalClahe(engine.luminance_plane(planes, lab), tile_grid)
+    full = engine.enhance_planes(planes, frame[:, :, 3], lab, clip_limit=clip_limit, tile_grid=tile_grid,
+                                 clahe_state=state)
+    expected = full[::step, ::step]
+    assert np.array_equal(cell_at(grid, cells, index, expected.shape), expected)
+  # The gaps between cells keep their color
+  y, x, _, _ = cells[1]
+  assert (grid[:, x - compare_grid.CELL_GAP:x] == compare_grid.GAP_RGBA).all()
+
+
+def test_batched_luts_match_separate_calls():
+  state = clahe.IncrementalClahe(engine.to_gray(bench.synthetic_frame(241, 317)), (3, 5))
+  clip_limits = (0.5, 2.0, 40.0, 0.0)
+  luts = compare_grid.batch_luts(state, clip_limits)
+  assert luts.shape == (4, 5, 3, clahe.HIST_SIZE)
+  for clip_limit, batched in zip(clip_limits, luts):
+    count = clahe.clip_limit_to_count(clip_limit, state.tile_area)
+    assert np.array_equal(batched, clahe.compute_luts(state.hists, count, state.tile_area))
+
+
+def test_parse_values():
+  assert compare_grid.parse_values("1, 2.5 4") == (1.0, 2.5, 4.0)
+  # Duplicates, non-positive and unparsable entries are dropped
+  assert compare_grid.parse_values("2,2, -1, 0, x, 3") == (2.0, 3.0)
+  assert compare_grid.parse_values("8 4.5 16", int) == (8, 16)
+  assert compare_grid.parse_values("", default=(1.0,)) == (1.0,)
+  assert compare_grid.parse_values(None, int, (8,)) == (8,)
+  assert compare_grid.parse_values("abc, -2", default=compare_grid.DEFAULT_CLIP_LIMITS) == compare_grid.DEFAULT_CLIP_LIMITS
+
+
+# 12-bit values one level apart, and 16-bit values 257 apart (8-bit data scaled up)
+@pytest.mark.parametrize('scale, offset', [(16, 3), (257, 0)])
+@pytest.mark.parametrize('lab', [False, engine.LIGHTNESS_YCRCB, engine.LIGHTNESS_HSV, engine.LIGHTNESS_LUMA])
+def test_uint16_cells_match_the_quantized_render(scale, offset, lab):
+  frame = deep_frame(700, 900, scale, offset)
+  grid, cells = compare_grid.compare_grid(engine.to_planes(frame, lab), frame[:, :, 3], lab, (1.0, 4.0),
+                                          ((8, 8), (4, 4)))
+  assert grid.dtype == np.uint8
+  step = preview.preview_step(700, 900)
+  expected = engine.to_uint8(engine.enhance(frame, lab, clip_limit=4.0, tile_grid=(4, 4)))[::step, ::step]
+  assert np.array_equal(cell_at(grid, cells, 3, expected.shape), expected)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+import bench
+import clahe
+import engine
+
+cv2 = pytest.importorskip('cv2')
+
+
+@pytest.fixture(params=engine.BACKENDS)
+def backend(request):
+  previous = engine.get_backend()
+  engine.set_backend(request.param)
+  yield request.param
+  engine.set_backend(previous)
+
+
+@pytest.fixture
+def frame():
+  return bench.synthetic_frame(241, 317)
+
+
+def max_diff(a, b):
+  return int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max())
+
+
+def test_equalize_matches_cv2(backend, frame):
+  gray = cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY)
+  assert np.array_equal(engine.equalize_plane(gray, engine.METHOD_EQUALIZE), cv2.equalizeHist(gray))
+
+
+@pytest.mark.parametrize('clip_limit', [0.5, 2.0, 40.0])
+@pytest.mark.parametrize('tile_grid', [(8, 8), (3, 5)])
+def test_clahe_matches_cv2(backend, frame, clip_limit, tile_grid):
+  gray = cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY)
+  expected = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid).apply(gray)
+  assert max_diff(engine.equalize_plane(gray, engine.METHOD_CLAHE, clip_limit, tile_grid), expected) <= 1
+
+
+def test_incremental_clahe_matches_cv2_across_clip_limits(frame):
+  gray = cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY)
+  state = clahe.IncrementalClahe(gray, (8, 8))
+  for clip_limit in (1.0, 4.0, 1.0, 12.0):
+    expected = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8)).apply(gray)
+    assert max_diff(state.apply(clip_limit), expected) <= 1
+
+
+def test_enhance_keeps_alpha_and_writes_into_out(backend, frame):
+  frame[:, :, 3] = np.arange(frame.shape[1], dtype=np.uint8)[None, :]
+  out = np.empty_like(frame)
+  result = engine.enhance(frame, lab=True, out=out)
+  assert result is out
+  assert np.array_equal(out[:, :, 3], frame[:, :, 3])
+
+
+def test_gray_enhance_has_equal_channels(backend, frame):
+  result = engine.enhance(frame, lab=False, method=engine.METHOD_EQUALIZE)
+  assert np.array_equal(result[:, :, 0], result[:, :, 1])
+  assert np.array_equal(result[:, :, 0], result[:, :, 2])
+
+
+def test_clahe_pool_reuses_and_bounds_objects():
+  pool = engine.ClahePool(max_size=2)
+  first = pool.get(2.0, (8, 8))
+  assert pool.get(2.0004, [8, 8]) is first
+  pool.get(3.0, (8, 8))
+  pool.get(4.0, (8, 8))
+  assert len(pool) == 2
+  assert pool.get(2.0, (8, 8)) is not first
+
+
+def test_invalid_arguments():
+  with pytest.raises(ValueError):
+    engine.equalize_plane(np.zeros((4, 4), dtype=np.uint8), 'median')
+  with pytest.raises(ValueError):
+    engine.lightness_space('xyz')
+  with pytest.raises(ValueError):
+    engine.enhance(np.zeros((4, 4, 3), dtype=np.uint8))
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import bench
+import numpy_backend
+
+cv2 = pytest.importorskip('cv2')
+
+
+def max_diff(a, b):
+  return int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max())
+
+
+# One strip, several strips with a short last one, and strips of a single row
+@pytest.mark.parametrize('shape, strip_pixels', [((37, 53), numpy_backend.STRIP_PIXELS), ((241, 317), 5000),
+                                                 ((9, 700), 300)])
+def test_conversions_match_cv2(monkeypatch, shape, strip_pixels):
+  monkeypatch.setattr(numpy_backend, 'STRIP_PIXELS', strip_pixels)
+  frame = bench.synthetic_frame(*shape)
+
+  assert np.array_equal(numpy_backend.rgba_to_gray(frame), cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY))
+
+  planes = numpy_backend.rgb_to_lab_planes(frame)
+  expected = cv2.split(cv2.cvtColor(frame[:, :, :3], cv2.COLOR_RGB2LAB))
+  assert np.array_equal(planes[0], expected[0])
+  assert max_diff(planes[1], expected[1]) <= 1
+  assert max_diff(planes[2], expected[2]) <= 1
+
+  rgb = numpy_backend.lab_planes_to_rgb(*expected)
+  assert max_diff(rgb, cv2.cvtColor(cv2.merge(expected), cv2.COLOR_LAB2RGB)) <= 2
+
+
+def test_lab_to_rgb_writes_into_rgba():
+  frame = bench.synthetic_frame(120, 90)
+  planes = numpy_backend.rgb_to_lab_planes(frame)
+  out = np.full_like(frame, 7)
+  rgb = numpy_backend.lab_planes_to_rgb(*planes, out=out)
+  assert np.shares_memory(rgb, out)
+  assert np.array_equal(out[:, :, :3], numpy_backend.lab_planes_to_rgb(*planes))
+  assert (out[:, :, 3] == 7).all()
+
+
+def test_gray_of_uint16_frames():
+  frame = bench.synthetic_frame(64, 80).astype(np.uint16) * 257
+  assert np.array_equal(numpy_backend.rgba_to_gray(frame), cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY))
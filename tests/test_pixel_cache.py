@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+import bench
+import clahe
+import engine
+from pixel_cache import PixelCache
+
+
+def frame(seed=0):
+  return bench.synthetic_frame(40, 50, seed)
+
+
+def tracked_bytes(cache, keys):
+  """What the entries of ``keys`` actually hold"""
+  return sum(cache.get(key).nbytes for key in keys)
+
+
+def test_evicts_least_recently_used_within_the_byte_budget():
+  size = frame().nbytes
+  cache = PixelCache(max_bytes=3 * size)
+  for key in 'abc':
+    cache.put(key, frame())
+  assert cache.nbytes == 3 * size
+  # Reading 'a' makes 'b' the least recently used
+  cache.get('a')
+  cache.put('d', frame())
+  assert 'b' not in cache
+  assert [key in cache for key in 'acd'] == [True, True, True]
+  assert cache.evictions == 1
+  assert cache.nbytes == 3 * size
+
+
+def test_derived_planes_count_toward_the_budget():
+  rgba = frame()
+  cache = PixelCache(max_bytes=rgba.nbytes * 2)
+  entry = cache.put('a', rgba)
+  cache.put('b', frame(1))
+  cache.get('a')
+  # The gray plane of 'a' pushes the total over the budget, so 'b' goes
+  gray = cache.gray(entry)
+  assert np.array_equal(gray, engine.to_gray(rgba))
+  assert 'b' not in cache
+  assert cache.nbytes == rgba.nbytes + gray.nbytes == entry.nbytes
+  # The most recently used entry is kept even when it alone is over the budget
+  cache.lab_planes(entry)
+  cache.clahe_state(entry, False, (8, 8))
+  assert len(cache) == 1
+  assert cache.nbytes == entry.nbytes > cache.max_bytes
+
+
+def test_planes_are_derived_once():
+  rgba = frame()
+  cache = PixelCache()
+  entry = cache.put('a', rgba)
+  for lab in [False] + list(engine.LIGHTNESS_SPACES):
+    first = cache.planes(entry, lab)
+    second = cache.planes(entry, lab)
+    expected = engine.to_planes(rgba, lab)
+    if engine.lightness_space(lab) is None:
+      assert first is second
+      assert np.array_equal(first, expected)
+    else:
+      assert all(a is b for a, b in zip(first, second))
+      assert all(np.array_equal(a, b) for a, b in zip(first, expected))
+  state = cache.clahe_state(entry, engine.LIGHTNESS_HSV, (8, 8))
+  assert cache.clahe_state(entry, engine.LIGHTNESS_HSV, [8, 8]) is state
+  assert isinstance(state, clahe.IncrementalClahe)
+  # Gray (shared by no lightness, YCrCb and luma), LAB, HSV value and the tile histograms are derived;
+  # the other lookups hit, including the value plane read to build the tile histograms
+  stats = cache.stats()
+  assert (stats['plane_misses'], stats['plane_hits']) == (4, 9)
+  assert cache.nbytes == entry.nbytes
+
+
+def test_hit_and_miss_counters():
+  cache = PixelCache()
+  loads = []
+
+  def load():
+    loads.append(1)
+    return frame()
+
+  cache.get_or_load('a', load)
+  cache.get_or_load('a', load)
+  assert cache.get('missing') is None
+  assert len(loads) == 1
+  stats = cache.stats()
+  assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 1)
+
+
+def test_drop_planes_and_discard_keep_the_accounting():
+  cache = PixelCache()
+  entry = cache.put('a', frame())
+  cache.planes(entry, True)
+  cache.clahe_state(entry, True, (8, 8))
+  cache.drop_planes()
+  assert entry.lab_planes is None and entry.clahe_states == {}
+  assert cache.nbytes == entry.rgba.nbytes
+  cache.discard('a')
+  assert cache.nbytes == 0 and len(cache) == 0
+  # Planes derived from a discarded entry aren't counted
+  cache.gray(entry)
+  assert cache.nbytes == 0
+
+
+def test_own_write_back_maps_to_the_source_version():
+  cache = PixelCache()
+  assert cache.source_key(7, 3) == (7, 3)
+  # Version 4 of image 7 is our enhanced output of version 3
+  cache.mark_written(7, 3, 4)
+  assert cache.is_own_output(7, 4)
+  assert not cache.is_own_output(7, 3)
+  assert cache.source_key(7, 4) == (7, 3)
+  # A newer version not written by us is the image's own again, as are other images
+  assert cache.source_key(7, 5) == (7, 5)
+  assert cache.source_key(8, 4) == (8, 4)
+  cache.mark_written(7, 5, 6)
+  assert cache.source_key(7, 4) == (7, 4)
+  assert cache.source_key(7, 6) == (7, 5)
+  cache.clear()
+  assert cache.source_key(7, 6) == (7, 6)
+
+
+@pytest.mark.parametrize('max_bytes', [1, 10 ** 9])
+def test_accounting_matches_the_entries(max_bytes):
+  cache = PixelCache(max_bytes=max_bytes)
+  rng = np.random.default_rng(0)
+  keys = [f"k{i}" for i in range(6)]
+  for _ in range(60):
+    key = keys[rng.integers(len(keys))]
+    entry = cache.get(key) or cache.put(key, frame(int(rng.integers(3))))
+    cache.planes(entry, list(engine.LIGHTNESS_SPACES)[rng.integers(len(engine.LIGHTNESS_SPACES))])
+    assert cache.nbytes == tracked_bytes(cache, [key for key in keys if key in cache])
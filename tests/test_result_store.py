@@ -0,0 +1,59 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+
+import bench
+import engine
+import result_store
+from result_store import FileSystemBackend, ResultStore
+
+
+def stored_bytes(directory):
+  return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.bin'))
+
+
+@pytest.mark.parametrize('lab', [False, True])
+def test_encode_round_trip(lab):
+  rgba = engine.enhance(bench.synthetic_frame(37, 53), lab=lab)
+  assert np.array_equal(result_store.decode(result_store.encode(rgba, lab)), rgba)
+  deep = rgba.astype(np.uint16) * 257
+  assert np.array_equal(result_store.decode(result_store.encode(deep, lab)), deep)
+
+
+def test_shared_stores_keep_the_bound_together(tmp_path):
+  payload = bytes(1000)
+
+  async def scenario():
+    # Two processes' views of the same directory, writing in turns
+    stores = [ResultStore(FileSystemBackend(str(tmp_path)), max_bytes=3500, shared=True) for _ in range(2)]
+    for i in range(10):
+      await stores[i % 2].put(f"key{i}", payload)
+      assert stored_bytes(tmp_path) <= 3500
+    return stores
+
+  stores = asyncio.run(scenario())
+  # The most recent entries survive, whichever store wrote them
+  assert sorted(entry.name for entry in os.scandir(tmp_path)) == ['key7.bin', 'key8.bin', 'key9.bin']
+  assert sum(store.evictions for store in stores) == 7
+
+
+def test_batch_workers_keep_the_cache_bound(tmp_path):
+  cv2 = pytest.importorskip('cv2')
+  import batch
+
+  input_dir, output_dir, cache_dir = tmp_path / 'in', tmp_path / 'out', tmp_path / 'cache'
+  input_dir.mkdir()
+  for i in range(8):
+    frame = bench.synthetic_frame(64 + i, 96)
+    cv2.imwrite(str(input_dir / f"{i}.png"), frame[:, :, :3])
+  params = {'lab': engine.LIGHTNESS_LAB, 'method': engine.METHOD_CLAHE, 'clip_limit': 2.0, 'tile_grid': (8, 8)}
+  payload_bytes = len(result_store.encode(engine.enhance(bench.synthetic_frame(71, 96), lab=True)))
+  max_bytes = int(2.5 * payload_bytes)
+
+  messages = []
+  summary = batch.run(str(input_dir), str(output_dir), params, workers=2, cache_dir=str(cache_dir),
+                      cache_max_bytes=max_bytes, log=messages.append)
+  assert summary['processed'] == 8, messages
+  assert stored_bytes(cache_dir) <= max_bytes
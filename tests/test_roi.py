@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+import bench
+import engine
+import roi
+
+
+@pytest.mark.parametrize('bbox, margin, expected', [
+  ((10, 20, 50, 60), 0, (10, 20, 50, 60)),
+  # Inverted corners
+  ((50, 60, 10, 20), 0, (10, 20, 50, 60)),
+  # Fractional coordinates round to the nearest pixel
+  ((10.4, 19.6, 49.5, 60.2), 0, (10, 20, 50, 60)),
+  ((10, 20, 50, 60), 5, (5, 15, 55, 65)),
+  # Margins past the canvas edge are clipped to it
+  ((3, 2, 98, 79), 16, (0, 0, 100, 80)),
+  ((-40, -10, 30, 200), 0, (0, 0, 30, 80)),
+])
+def test_clip_bbox(bbox, margin, expected):
+  assert roi.clip_bbox(bbox, 100, 80, margin) == expected
+
+
+@pytest.mark.parametrize('bbox, margin', [
+  ((10, 20, 10, 60), 0),
+  ((10, 20, 50, 20), 0),
+  # Rounds to zero width
+  ((10.2, 20, 10.4, 60), 0),
+  # Entirely off the canvas, even with the margin
+  ((120, 10, 150, 40), 4),
+  ((-50, -50, -20, -20), 4),
+])
+def test_clip_bbox_empty(bbox, margin):
+  assert roi.clip_bbox(bbox, 100, 80, margin) is None
+
+
+def test_zero_area_box_grows_by_the_margin():
+  assert roi.clip_bbox((10, 20, 10, 20), 100, 80, margin=3) == (7, 17, 13, 23)
+
+
+def test_bbox_from_geometry():
+  rectangle = {'points': {'exterior': [[10, 20], [49, 59]], 'interior': []}}
+  assert roi.bbox_from_geometry(rectangle) == (10, 20, 50, 60)
+  polygon = {'points': {'exterior': [[30.5, 5.2], [12.1, 40.9], [60.0, 33.3]], 'interior': []}}
+  assert roi.bbox_from_geometry(polygon) == (12, 5, 61, 42)
+  assert roi.bbox_from_geometry({'points': {'exterior': [[7, 8]]}}) == (7, 8, 8, 9)
+  # Bitmaps only carry the origin of their mask
+  assert roi.bbox_from_geometry({'bitmap': {'origin': [3, 4], 'data': '...'}}) is None
+  assert roi.bbox_from_geometry({'points': {'exterior': []}}) is None
+  assert roi.bbox_from_geometry(None) is None
+
+
+def test_region_is_enhanced_on_its_own():
+  frame = bench.synthetic_frame(90, 120)
+  bbox = (30, 10, 100, 70)
+  enhanced = roi.enhance_region(roi.region(frame, bbox), engine.LIGHTNESS_YCRCB, clip_limit=3.0)
+  assert np.array_equal(enhanced, engine.enhance(frame[10:70, 30:100].copy(), engine.LIGHTNESS_YCRCB, clip_limit=3.0))
+
+
+class Canvas:
+  """The pixels of a 2D canvas with ``putImageData``-style region writes"""
+
+  def __init__(self, rgba):
+    self.rgba = rgba.copy()
+
+  def put_region(self, rgba, x, y):
+    self.rgba[y:y + rgba.shape[0], x:x + rgba.shape[1]] = rgba
+
+
+def render_roi(canvas, writes, key, bbox):
+  """What a render in ROI mode does: undo the last ROI, then enhance and write back the new one"""
+  roi.restore(writes.pop(key), canvas.put_region)
+  original = roi.region(canvas.rgba, bbox).copy()
+  canvas.put_region(roi.enhance_region(original), bbox[0], bbox[1])
+  writes.record_roi(key, bbox, original)
+
+
+def test_undo_restores_the_pixels_under_the_roi():
+  frame = bench.synthetic_frame(90, 120)
+  canvas = Canvas(frame)
+  writes = roi.CanvasWrites()
+
+  render_roi(canvas, writes, 'image', (10, 10, 60, 50))
+  assert not np.array_equal(canvas.rgba, frame)
+  assert np.array_equal(canvas.rgba[:, 60:], frame[:, 60:])
+  # An overlapping ROI is taken from the original pixels, not from the previous result
+  render_roi(canvas, writes, 'image', (40, 30, 110, 80))
+  assert np.array_equal(canvas.rgba[10:30, 10:60], frame[10:30, 10:60])
+  assert np.array_equal(canvas.rgba[30:80, 40:110], roi.enhance_region(frame[30:80, 40:110]))
+
+  assert roi.restore(writes.pop('image'), canvas.put_region)
+  assert np.array_equal(canvas.rgba, frame)
+  # Nothing is left to undo
+  assert writes.pop('image') is None
+  assert not roi.restore(None, canvas.put_region)
+
+
+def test_full_write_leaves_the_restore_to_the_caller():
+  writes = roi.CanvasWrites()
+  writes.record_roi('a', (0, 0, 4, 4), np.zeros((4, 4, 4), dtype=np.uint8))
+  writes.record_full('a')
+  writes.record_roi('b', (0, 0, 4, 4), np.zeros((4, 4, 4), dtype=np.uint8))
+  # A whole-image write replaces the ROI of the same canvas; the caller rewrites the original from the pixel cache
+  last_write = writes.pop('a')
+  assert last_write == (None, None)
+  assert not roi.restore(last_write, lambda *args: pytest.fail("nothing to put back"))
+  writes.clear()
+  assert writes.pop('b') is None
@@ -0,0 +1,95 @@
+import asyncio
+
+from scheduler import RenderScheduler
+
+
+class FakeRender:
+  """Render stand-in that records its calls and passes each stage checkpoint after yielding"""
+
+  def __init__(self, stages=('readback', 'equalize', 'write-back')):
+    self.stages = stages
+    self.started = []
+    self.finished = []
+
+  async def __call__(self, mode, token=None):
+    self.started.append(mode)
+    for stage in self.stages:
+      await token.checkpoint(stage)
+    self.finished.append(mode)
+    return mode
+
+
+def test_burst_renders_first_and_latest_only():
+  async def scenario():
+    render = FakeRender()
+    scheduler = RenderScheduler(render)
+    futures = [scheduler.submit(f"r{i}") for i in range(5)]
+    results = await asyncio.gather(*futures)
+    return render, scheduler, results
+
+  render, scheduler, results = asyncio.run(scenario())
+  # The worker only starts once the burst is over: each request replaces the pending one
+  assert render.started == ['r4']
+  assert render.finished == ['r4']
+  assert results == [None, None, None, None, 'r4']
+  assert scheduler.stats()['dropped'] == 4
+  assert scheduler.stats()['cancelled'] == 0
+  assert scheduler.completed == 1
+
+
+def test_running_render_is_cancelled_at_next_checkpoint():
+  async def scenario():
+    render = FakeRender()
+    scheduler = RenderScheduler(render)
+    first = scheduler.submit('first')
+    # Let the first render get past its first checkpoint
+    for _ in range(3):
+      await asyncio.sleep(0)
+    second = scheduler.submit('second')
+    return render, scheduler, await first, await second
+
+  render, scheduler, first, second = asyncio.run(scenario())
+  assert first is None
+  assert second == 'second'
+  assert render.started == ['first', 'second']
+  assert scheduler.cancelled == 1
+  assert scheduler.dropped == 0
+  assert 'readback' not in scheduler.cancelled_at
+
+
+def test_renders_never_overlap():
+  async def scenario():
+    active = []
+    overlaps = []
+
+    async def render(mode, token=None):
+      active.append(mode)
+      overlaps.append(len(active))
+      await asyncio.sleep(0.01)
+      active.remove(mode)
+      return mode
+
+    scheduler = RenderScheduler(render)
+    first = scheduler.submit('a')
+    await asyncio.sleep(0.001)
+    second = scheduler.submit('b')
+    return overlaps, await first, await second
+
+  overlaps, first, second = asyncio.run(scenario())
+  # Without checkpoints nothing is cancelled, the second render waits for the first
+  assert max(overlaps) == 1
+  assert (first, second) == ('a', 'b')
+
+
+def test_errors_propagate_to_the_caller():
+  async def render(mode, token=None):
+    raise RuntimeError(mode)
+
+  async def scenario():
+    scheduler = RenderScheduler(render)
+    try:
+      await scheduler.submit('boom')
+    except RuntimeError as e:
+      return str(e), scheduler.running
+
+  assert asyncio.run(scenario()) == ('boom', False)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import engine
+from temporal import TemporalEqualizer
+
+
+def ramp(low, high, height=120, width=640, offset=0):
+  """Horizontal ramp from ``low`` to ``high``, shifted by ``offset`` levels: a flat histogram that drifts cleanly"""
+  row = np.linspace(low, high, width) + offset
+  return np.ascontiguousarray(np.broadcast_to(np.clip(np.rint(row), 0, 255).astype(np.uint8), (height, width)))
+
+
+@pytest.mark.parametrize('method', engine.METHODS)
+def test_drifting_sequence_reuses_luts(method):
+  equalizer = TemporalEqualizer(method)
+  # Half a level brighter every frame; a one-level shift moves 1/80 of the histogram
+  for frame in range(30):
+    equalizer(ramp(80, 160, offset=frame // 2))
+  # The LUTs are refreshed on the first frame and then every 4 levels, when the distance passes 0.04
+  assert equalizer.stats() == {'frames': 30, 'recomputed': 4, 'reused': 26, 'cuts': 0}
+
+
+@pytest.mark.parametrize('method', engine.METHODS)
+def test_hard_cut_replaces_luts(method):
+  equalizer = TemporalEqualizer(method)
+  dark, bright = ramp(0, 80), ramp(150, 250)
+  for _ in range(10):
+    equalizer(dark)
+  outputs = [equalizer(bright) for _ in range(10)]
+  assert equalizer.stats() == {'frames': 20, 'recomputed': 2, 'reused': 18, 'cuts': 1}
+  # After the cut the LUTs are those of the new scene alone, not a blend with the old one
+  assert np.array_equal(outputs[0], TemporalEqualizer(method)(bright))
+  assert all(np.array_equal(output, outputs[0]) for output in outputs)
+
+
+def test_small_change_blends_luts():
+  shifted = ramp(80, 160, offset=8)
+  equalizer = TemporalEqualizer(engine.METHOD_EQUALIZE, threshold=0.01, cut_threshold=0.9, blend=0.5)
+  equalizer(ramp(80, 160))
+  blended = equalizer(shifted).astype(int)
+  assert equalizer.stats()['recomputed'] == 2
+  assert equalizer.stats()['cuts'] == 0
+
+  # The old LUT (kept by a threshold nothing passes) and the LUT of the shifted frame alone
+  keeps_old = TemporalEqualizer(engine.METHOD_EQUALIZE, threshold=1.0)
+  keeps_old(ramp(80, 160))
+  old = keeps_old(shifted).astype(int)
+  new = TemporalEqualizer(engine.METHOD_EQUALIZE)(shifted).astype(int)
+  assert not np.array_equal(old, new)
+  assert np.abs(blended - (old + new) / 2).max() <= 1
+
+
+def test_unknown_method():
+  with pytest.raises(ValueError):
+    TemporalEqualizer('median')
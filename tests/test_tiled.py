@@ -0,0 +1,111 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import bench
+import clahe
+import engine
+import lightness
+import tiled
+
+
+def peak_bytes(fn):
+  tracemalloc.start()
+  try:
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    fn()
+    return tracemalloc.get_traced_memory()[1] - before
+  finally:
+    tracemalloc.stop()
+
+
+def deep_frame(height, width):
+  """12-bit RGBA frame with more levels than the CLAHE histograms have bins"""
+  rng = np.random.default_rng(1)
+  frame = bench.synthetic_frame(height, width).astype(np.uint16) * 16 + rng.integers(0, 16, (height, width, 4),
+                                                                                         dtype=np.uint16)
+  frame[:, :, 3] = 65535
+  return frame
+
+
+def whole_plane(frame, lab, method, bits=None):
+  """The enhancement of the whole frame in memory, with the CLAHE interpolation of ``IncrementalClahe``"""
+  bits = engine.color_bits(frame, bits)
+  planes = engine.to_planes(frame, lab, bits)
+  plane = engine.luminance_plane(planes, lab)
+  state = clahe.IncrementalClahe(plane, (5, 3), bits) if method == engine.METHOD_CLAHE else None
+  rgba = engine.enhance_planes(planes, frame[:, :, 3], lab, method, 3.0, (5, 3), clahe_state=state, bits=bits)
+  return rgba[:, :, 0] if engine.lightness_space(lab) is None else rgba
+
+
+# Blocks that don't divide the 301x437 frame or its 5x3 tiles
+@pytest.mark.parametrize('lab', [False, engine.LIGHTNESS_LAB, engine.LIGHTNESS_YCRCB, engine.LIGHTNESS_HSV])
+@pytest.mark.parametrize('method', engine.METHODS)
+@pytest.mark.parametrize('deep', [False, True])
+def test_blocks_match_the_whole_plane(lab, method, deep):
+  if deep and lab == engine.LIGHTNESS_LAB and engine.get_backend() != engine.BACKEND_OPENCV:
+    pytest.skip("16-bit LAB needs the OpenCV backend")
+  frame = deep_frame(301, 437) if deep else bench.synthetic_frame(301, 437)
+  dst = np.empty(tiled.output_shape(frame.shape, lab), dtype=frame.dtype)
+  tiled.equalize_tiled(frame, dst, lab, method, 3.0, (5, 3), block_size=(128, 100))
+  expected = whole_plane(frame, lab, method)
+  if deep and lab == engine.LIGHTNESS_LAB:
+    # OpenCV's float LAB to RGB rounds a few pixels differently depending on where they sit in the row
+    assert np.abs(dst.astype(np.int32) - expected).max() <= 1
+  else:
+    assert np.array_equal(dst, expected)
+
+
+def test_rgb_and_single_channel_inputs():
+  frame = bench.synthetic_frame(150, 170)
+  rgb = np.ascontiguousarray(frame[:, :, :3])
+  dst = np.empty_like(rgb)
+  tiled.equalize_tiled(rgb, dst, engine.LIGHTNESS_YCRCB, engine.METHOD_CLAHE, 3.0, (5, 3), block_size=(64, 64))
+  assert np.array_equal(dst, whole_plane(frame, engine.LIGHTNESS_YCRCB, engine.METHOD_CLAHE)[:, :, :3])
+
+  gray = engine.to_gray(frame)
+  dst = np.empty_like(gray)
+  tiled.equalize_tiled(gray, dst, True, block_size=(64, 64))
+  assert np.array_equal(dst, clahe.IncrementalClahe(gray, (8, 8)).apply(engine.DEFAULT_CLIP_LIMIT))
+
+
+def test_given_bit_depth():
+  frame = deep_frame(120, 140) // 2
+  dst = np.empty(frame.shape[:2], dtype=np.uint16)
+  tiled.equalize_tiled(frame, dst, method=engine.METHOD_EQUALIZE, block_size=(64, 64), bits=12)
+  assert np.array_equal(dst, whole_plane(frame, False, engine.METHOD_EQUALIZE, bits=12))
+  assert 2047 < dst.max() <= 4095
+
+
+@pytest.mark.parametrize('deep', [False, True])
+def test_peak_memory_follows_the_block_size(tmp_path, deep):
+  def run(height, width):
+    frame = deep_frame(height, width) if deep else bench.synthetic_frame(height, width)
+    src_path, dst_path = tmp_path / f"{height}.npy", tmp_path / f"{height}-out.npy"
+    np.save(src_path, frame)
+    del frame
+    return peak_bytes(lambda: tiled.equalize_npy(src_path, dst_path, block_size=(128, 128),
+                                                 lab=engine.LIGHTNESS_YCRCB))
+
+  small = run(512, 512)
+  large = run(1536, 1536)
+  # Nine times the pixels; the histograms and LUTs are the same size and the blocks are too
+  assert large <= 1.1 * small
+
+
+def test_invalid_input():
+  with pytest.raises(ValueError):
+    tiled.equalize_tiled(np.zeros((8, 8), dtype=np.float32), np.zeros((8, 8), dtype=np.float32))
+  with pytest.raises(ValueError):
+    tiled.equalize_tiled(np.zeros((8, 8), dtype=np.uint16), np.zeros((8, 8), dtype=np.uint8))
+
+
+def test_cli(tmp_path):
+  frame = bench.synthetic_frame(200, 260)
+  np.save(tmp_path / 'in.npy', frame)
+  assert tiled.main([str(tmp_path / 'in.npy'), str(tmp_path / 'out.npy'), '--lab', 'hsv', '--block-size', '96']) == 0
+  expected = engine.enhance_planes(engine.to_planes(frame, engine.LIGHTNESS_HSV), frame[:, :, 3], engine.LIGHTNESS_HSV,
+                                   clahe_state=clahe.IncrementalClahe(lightness.value_plane(frame), (8, 8)))
+  assert np.array_equal(np.load(tmp_path / 'out.npy'), expected)
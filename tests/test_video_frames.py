@@ -0,0 +1,107 @@
+import asyncio
+import re
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from video_frames import FrameLoader, FramePrefetcher, StrategyMemo, build_frame_urls
+
+
+class FrameServer(BaseHTTPRequestHandler):
+  """Serves frame ``n`` as ``frame-<n>`` at 1-indexed, full-resolution URLs only, like some deployments do"""
+
+  def do_GET(self):
+    match = re.search(r'videoframe/[^/]+/(\d+)/', self.path)
+    if match is None or 'resize:' in self.path:
+      self.send_error(404)
+      return
+    body = f"frame-{int(match.group(1)) - 1}".encode()
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture
+def server():
+  httpd = ThreadingHTTPServer(('127.0.0.1', 0), FrameServer)
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  yield f"http://127.0.0.1:{httpd.server_address[1]}"
+  httpd.shutdown()
+  httpd.server_close()
+
+
+def preview_url(base):
+  return f"{base}/previews/resize:fill:150:0:0/videoframe/33p/1/174515916?token=abc"
+
+
+async def load_url(url):
+  """``load_image_element`` stand-in: the response body, or None on an HTTP error"""
+  def fetch():
+    try:
+      with urllib.request.urlopen(url, timeout=5) as response:
+        return response.read().decode()
+    except urllib.error.HTTPError:
+      return None
+  return await asyncio.to_thread(fetch)
+
+
+def test_build_frame_urls_order():
+  strategies = [strategy for strategy, _ in build_frame_urls(preview_url('http://host'), 7, 1920, 1080)]
+  assert strategies == ['high_res_1indexed', 'high_res_0indexed', 'full_res_1indexed', 'full_res_0indexed',
+                        'original_low_res_fallback']
+  urls = dict(build_frame_urls(preview_url('http://host'), 7, 1920, 1080))
+  assert 'resize:fill:1920:1080:0/videoframe/33p/8/' in urls['high_res_1indexed']
+  assert urls['full_res_0indexed'].endswith('/previews/videoframe/33p/7/174515916?token=abc')
+
+
+def test_loader_remembers_the_working_strategy(server):
+  async def scenario():
+    memo = StrategyMemo()
+    loader = FrameLoader(memo, 'video', preview_url(server), 1920, 1080, load_url)
+    first = await loader(10)
+    attempts_first = loader.attempts
+    second = await loader(11)
+    return memo, first, attempts_first, second, loader.attempts - attempts_first
+
+  memo, first, attempts_first, second, attempts_second = asyncio.run(scenario())
+  assert first == 'frame-10'
+  # Both resized candidates fail before the full-resolution 1-indexed one
+  assert attempts_first == 3
+  assert memo.get('video') == 'full_res_1indexed'
+  assert second == 'frame-11'
+  assert attempts_second == 1
+
+
+def test_prefetcher_serves_neighbours_from_the_ring(server):
+  async def scenario():
+    loader = FrameLoader(StrategyMemo(), 'video', preview_url(server), 640, 360, load_url)
+    prefetcher = FramePrefetcher(loader, capacity=6, ahead=3, behind=1)
+    frames = [await prefetcher.get(frame, frames_count=20) for frame in (5, 6, 7, 8)]
+    return prefetcher, frames
+
+  prefetcher, frames = asyncio.run(scenario())
+  assert frames == ['frame-5', 'frame-6', 'frame-7', 'frame-8']
+  assert (prefetcher.hits, prefetcher.misses) == (3, 1)
+  assert len(prefetcher) <= prefetcher.capacity
+  prefetcher.clear()
+  assert len(prefetcher) == 0
+
+
+def test_every_strategy_failing_forgets_the_memo(server):
+  async def scenario():
+    memo = StrategyMemo()
+    memo.remember('video', 'full_res_0indexed')
+    loader = FrameLoader(memo, 'video', f"{server}/missing/resize:fill:150:0:0/x.jpg", 640, 360, load_url)
+    return memo, await loader(3)
+
+  memo, result = asyncio.run(scenario())
+  assert result is None
+  assert memo.get('video') is None
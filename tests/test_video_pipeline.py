@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import bench
+import engine
+
+cv2 = pytest.importorskip('cv2')
+# Imports cv2 itself
+import video_pipeline
+
+
+FRAMES = 12
+
+
+@pytest.fixture
+def video(tmp_path):
+  """Lossless synthetic video whose frames drift slightly, and its frames as BGR arrays"""
+  path = str(tmp_path / 'in.avi')
+  writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'FFV1'), 10.0, (96, 64))
+  if not writer.isOpened():
+    pytest.skip("no FFV1 encoder in this OpenCV build")
+  frames = []
+  for index in range(FRAMES):
+    frame = cv2.cvtColor(bench.synthetic_frame(64, 96, seed=index), cv2.COLOR_RGBA2BGR)
+    writer.write(frame)
+    frames.append(frame)
+  writer.release()
+  return path, frames
+
+
+def read_frames(path):
+  cap = cv2.VideoCapture(path)
+  frames = []
+  while True:
+    ok, frame = cap.read()
+    if not ok:
+      break
+    frames.append(frame)
+  cap.release()
+  return frames
+
+
+@pytest.mark.parametrize('lab', [False] + list(engine.LIGHTNESS_SPACES))
+def test_pipeline_enhances_the_requested_frames(tmp_path, video, lab):
+  src_path, frames = video
+  dst_path = str(tmp_path / 'out.avi')
+  options = {'method': engine.METHOD_CLAHE, 'clip_limit': 3.0, 'tile_grid': (4, 4)}
+  pipeline = video_pipeline.VideoPipeline(src_path, dst_path, {'lab': lab, **options}, start=3, end=9, fourcc='FFV1',
+                                          queue_size=2)
+  summary = pipeline.run()
+
+  assert summary['frames'] == 6
+  assert all(stage['frames'] == 6 for stage in summary['stages'].values())
+  written = read_frames(dst_path)
+  assert len(written) == 6
+  for index, frame in zip(range(3, 9), written):
+    expected = engine.enhance(cv2.cvtColor(frames[index], cv2.COLOR_BGR2RGBA), lab, **options)
+    assert np.array_equal(frame, cv2.cvtColor(expected, cv2.COLOR_RGBA2BGR))
+
+
+def test_temporal_pipeline_reports_reuse(tmp_path, video):
+  src_path, _ = video
+  pipeline = video_pipeline.VideoPipeline(src_path, str(tmp_path / 'out.avi'), {'lab': engine.LIGHTNESS_YCRCB},
+                                          temporal=True, fourcc='FFV1')
+  summary = pipeline.run()
+  assert summary['frames'] == FRAMES
+  assert summary['temporal']['frames'] == FRAMES
+
+
+def test_space_option():
+  parser = video_pipeline.build_parser()
+  assert parser.parse_args(['in.mp4', 'out.mp4']).space is None
+  assert parser.parse_args(['in.mp4', 'out.mp4', '--space', 'hsv']).space == 'hsv'
+  with pytest.raises(SystemExit):
+    parser.parse_args(['in.mp4', 'out.mp4', '--space', 'xyz'])